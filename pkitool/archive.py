@@ -0,0 +1,534 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+archive.py
+
+    
+"""
+
+__all__ = ['ArchiveWriter', 'ArchiveReader', 'export_ca', 'import_ca',
+           'ArchiveException', 'ChecksumException', 'CAExistsException']
+
+import os
+import sys
+import time
+import errno
+import hashlib
+import tarfile
+import tempfile
+import optparse
+from cStringIO import StringIO
+
+import tracing
+import fileutil
+
+# the pax header holding the SHA-256 digest of each member
+DIGEST_HEADER = 'PKITOOL.sha256'
+
+# the last member, holding the number of members before it and a digest
+# over their names and digests, so a truncated archive is caught
+MANIFEST = 'MANIFEST'
+
+INDEX = 'index.txt'
+CRLS = 'crls.txt'
+RENEWALS = 'renewals.txt'
+REVOCATIONS = 'revocations.txt'
+CERTS_DIR = 'newcerts/'
+PRIVATE_KEY = 'ca.key'
+
+# archive member -> config method returning where the file is kept
+FILES = (('ca.crt', 'get_ca_certificate'),
+         (PRIVATE_KEY, 'get_ca_private_key'),
+         ('serial', 'get_ca_serial'),
+         ('crlnumber', 'get_ca_crlnumber'),
+         ('crl.pem', 'get_ca_crl'),
+         ('delta.crl', 'get_ca_delta_crl'))
+
+# bytes read or written at a time
+CHUNK_SIZE = 64 * 1024
+
+# members bigger than this are spooled to disk while being verified
+SPOOL_SIZE = 1024 * 1024
+
+class ArchiveException(Exception):
+    '''
+    A CA archive that is not well formed
+    '''
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+
+class ChecksumException(ArchiveException):
+    '''
+    An archive member whose contents do not match its recorded digest
+    '''
+    def __init__(self, name):
+        ArchiveException.__init__(self,
+                                  'Member %s is corrupted (checksum '
+                                  'mismatch)' % name)
+
+class CAExistsException(Exception):
+    '''
+    An import into a CA that already has a key, certificate or database
+    '''
+    def __init__(self, ca, path):
+        Exception.__init__(self,
+                           'CA %s already exists (found %s), not importing '
+                           'over it' % (ca, path))
+
+def format_optional(number):
+    '''
+    Formats a number that may be None, for the text members
+    '''
+    if number is None:
+        return '-'
+    return str(number)
+
+def parse_optional(text):
+    if text == '-':
+        return None
+    return int(text)
+
+def copy_file(src, dst, digest=None):
+    '''
+    Copies file object src to dst in chunks, feeding digest (a hashlib
+    object) if given, and returns the number of bytes copied
+    '''
+    size = 0
+    while True:
+        chunk = src.read(CHUNK_SIZE)
+        if not chunk:
+            return size
+        if digest is not None:
+            digest.update(chunk)
+        dst.write(chunk)
+        size += len(chunk)
+
+class ArchiveWriter:
+    '''
+    Writes a CA archive to a file object: a gzip compressed tar stream,
+    written as it goes, so it may be piped (to ssh, say) and memory use
+    does not grow with the number of certificates
+
+    Each member carries its SHA-256 digest in a pax header, and the
+    archive ends with a manifest over all members (see ArchiveReader).
+    '''
+
+    def __init__(self, fileobj):
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|gz',
+                                format=tarfile.PAX_FORMAT,
+                                bufsize=CHUNK_SIZE)
+        self.manifest = hashlib.sha256()
+        self.members = 0
+        self.bytes = 0
+
+    def __add(self, name, fp, size, digest, mtime=None):
+        if mtime is None:
+            mtime = time.time()
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = 0600
+        info.pax_headers = {DIGEST_HEADER : digest}
+        self.tar.addfile(info, fp)
+        # a stream is never read back, so there is no point in tarfile
+        # remembering every member written
+        self.tar.members = []
+
+        self.manifest.update('%s %s\n' % (digest, name))
+        self.members += 1
+        self.bytes += size
+
+    def add_buffer(self, name, buffer, mtime=None):
+        '''
+        Adds a member holding buffer
+        '''
+        self.__add(name, StringIO(buffer), len(buffer),
+                   hashlib.sha256(buffer).hexdigest(), mtime)
+
+    def add_file(self, name, path):
+        '''
+        Adds a member with the contents of the file at path, which is
+        read in chunks
+        '''
+        fp = open(path, 'rb')
+        try:
+            digest = hashlib.sha256()
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+            fp.seek(0)
+            self.__add(name, fp, os.fstat(fp.fileno()).st_size,
+                       digest.hexdigest(), os.path.getmtime(path))
+        finally:
+            fp.close()
+
+    def add_lines(self, name, lines):
+        '''
+        Adds a member made of the given lines, which may be any iterable
+        (they are spooled to a temporary file, as the member size and
+        digest must be known beforehand)
+        '''
+        fp = tempfile.TemporaryFile()
+        try:
+            digest = hashlib.sha256()
+            for line in lines:
+                digest.update(line)
+                fp.write(line)
+            size = fp.tell()
+            fp.seek(0)
+            self.__add(name, fp, size, digest.hexdigest())
+        finally:
+            fp.close()
+
+    def close(self):
+        '''
+        Writes the manifest and ends the archive
+        '''
+        self.add_buffer(MANIFEST, '%d %s\n' % (self.members,
+                                               self.manifest.hexdigest()))
+        self.tar.close()
+
+class ArchiveReader:
+    '''
+    Reads a CA archive written by ArchiveWriter from a file object, as a
+    stream
+
+    Iterating over the reader yields a (name, file object) tuple for each
+    member, whose contents have already been checked against its digest
+    (members are spooled to memory, or to disk if large, to do so). A
+    ChecksumException is raised for a corrupted member, and an
+    ArchiveException if the archive turns out to be truncated or
+    tampered with once its end is reached.
+    '''
+
+    def __init__(self, fileobj):
+        self.tar = tarfile.open(fileobj=fileobj, mode='r|gz',
+                                bufsize=CHUNK_SIZE)
+
+    def __iter__(self):
+        manifest = hashlib.sha256()
+        members = 0
+        complete = False
+
+        for info in self.tar:
+            # streams are read once, see ArchiveWriter.__add()
+            self.tar.members = []
+            if complete:
+                raise ArchiveException('Member %s found after the '
+                                       'manifest' % info.name)
+            if not info.isfile():
+                raise ArchiveException('Member %s is not a regular file' %
+                                       info.name)
+            expected = info.pax_headers.get(DIGEST_HEADER)
+            if expected is None:
+                raise ArchiveException('Member %s has no checksum' %
+                                       info.name)
+
+            fp = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+            digest = hashlib.sha256()
+            copy_file(self.tar.extractfile(info), fp, digest)
+            if digest.hexdigest() != expected:
+                fp.close()
+                raise ChecksumException(info.name)
+            fp.seek(0)
+
+            if info.name == MANIFEST:
+                if fp.read().split() != [str(members),
+                                         manifest.hexdigest()]:
+                    raise ArchiveException('The archive does not match its '
+                                           'manifest')
+                complete = True
+                continue
+
+            manifest.update('%s %s\n' % (expected, info.name))
+            members += 1
+            try:
+                yield info.name, fp
+            finally:
+                fp.close()
+
+        if not complete:
+            raise ArchiveException('The archive is truncated (no manifest '
+                                   'found)')
+
+def export_ca(ca, fileobj, private_key=True, stats=None):
+    '''
+    Writes everything needed to move a CA to another host (its database,
+    certificates, serial and CRL state, and unless private_key is False,
+    its private key, as encrypted on disk) to fileobj, as a CA archive
+    (see ArchiveWriter)
+
+    The database is read in chunks and certificates one at a time, so
+    memory use does not depend on the size of the CA.
+
+    Certificates listed in the database whose file is missing are left
+    out (the database records are kept), and their serials listed in
+    stats, as 'missing'.
+
+    If a dict is given as stats, it is updated with the number of
+    'certificates' and 'bytes' archived (uncompressed), the 'seconds'
+    spent and the resulting 'rate' in certificates per second.
+    '''
+    if stats is None:
+        stats = {}
+    stats.update({'certificates' : 0, 'bytes' : 0, 'seconds' : 0.0,
+                  'rate' : 0.0, 'missing' : []})
+    start = time.time()
+
+    database = ca.get_database()
+    writer = ArchiveWriter(fileobj)
+    with tracing.span('archive.export', ca=ca.ca):
+        writer.add_lines(INDEX, (record.to_index_line()
+                                 for record in database))
+        writer.add_lines(CRLS, ('%d %s %d %s\n' % (number,
+                                                   format_optional(base),
+                                                   this_update,
+                                                   format_optional(sequence))
+                                for number, base, this_update, sequence
+                                in database.iter_crls()))
+        writer.add_lines(REVOCATIONS, ('%d %s\n' % revocation
+                                       for revocation
+                                       in database.iter_revocations()))
+        writer.add_lines(RENEWALS, ('%s %s %d\n' % renewal
+                                    for renewal in database.iter_renewals()))
+
+        for name, getter in FILES:
+            if name == PRIVATE_KEY and not private_key:
+                continue
+            path = getattr(ca.config, getter)(ca.ca)
+            if os.path.exists(path):
+                writer.add_file(name, path)
+
+        for record in database:
+            try:
+                writer.add_file('%s%s.pem' % (CERTS_DIR, record.serial),
+                                ca.find_certificate_path(record.serial))
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                tracing.count('archive.missing', ca=ca.ca)
+                stats['missing'].append(record.serial)
+                continue
+            stats['certificates'] += 1
+        writer.close()
+
+    tracing.count('archive.exported', stats['certificates'], ca=ca.ca)
+    stats['bytes'] = writer.bytes
+    stats['seconds'] = time.time() - start
+    if stats['seconds']:
+        stats['rate'] = stats['certificates'] / stats['seconds']
+    return stats
+
+def find_existing(ca):
+    '''
+    Returns the path of a file showing that a CA already exists (its
+    certificate, key, database or a certificate), or None
+    '''
+    config = ca.config
+    for path in (config.get_ca_certificate(ca.ca),
+                 config.get_ca_private_key(ca.ca),
+                 config.get_ca_index_db(ca.ca)):
+        if os.path.exists(path):
+            return path
+    path = config.get_ca_database(ca.ca)
+    if os.path.exists(path) and os.path.getsize(path):
+        return path
+    path = config.get_ca_new_certs_dir(ca.ca)
+    if os.path.isdir(path) and os.listdir(path):
+        return path
+    return None
+
+def wipe_ca(ca):
+    '''
+    Removes the files an export of a CA holds (see FILES), and all of its
+    certificates, so that nothing of it is left over by an import
+    '''
+    for name, getter in FILES:
+        path = getattr(ca.config, getter)(ca.ca)
+        if os.path.exists(path):
+            os.unlink(path)
+    ca.remove_certificates()
+
+def import_ca(ca, fileobj, stats=None, force=False):
+    '''
+    Sets up a CA from an archive written by export_ca(), read from
+    fileobj as a stream
+
+    The CA directory structure is created anew, where the config says,
+    so the archive may be imported into a different layout. Since that
+    wipes the database, serial and crlnumber files, importing into a CA
+    that already exists raises CAExistsException, unless force is True,
+    in which case the existing CA is wiped first (see wipe_ca()). The
+    database index is rebuilt in bulk (see
+    CertificateDatabase.import_index()), and certificates are written in
+    batches (see fileutil.WriteBatch).
+
+    Every member is checked before use, but as the archive is streamed,
+    the manifest is only checked at the end: if an exception is raised,
+    the CA is left incomplete and should be imported again.
+
+    stats is updated as in export_ca().
+    '''
+    if stats is None:
+        stats = {}
+    stats.update({'certificates' : 0, 'bytes' : 0, 'seconds' : 0.0,
+                  'rate' : 0.0})
+    start = time.time()
+
+    if force:
+        wipe_ca(ca)
+    else:
+        path = find_existing(ca)
+        if path is not None:
+            raise CAExistsException(ca.ca, path)
+
+    paths = {}
+    for name, getter in FILES:
+        paths[name] = getattr(ca.config, getter)(ca.ca)
+
+    ca.create_directory_structure()
+    batch = fileutil.WriteBatch()
+    try:
+        with tracing.span('archive.import', ca=ca.ca):
+            for name, fp in ArchiveReader(fileobj):
+                if name.startswith(CERTS_DIR) and name.endswith('.pem'):
+                    serial = name[len(CERTS_DIR):-len('.pem')]
+                    buffer = fp.read()
+                    batch.write_file(ca.make_certificate_path(serial),
+                                     buffer)
+                    if len(batch) >= ca.commit_interval:
+                        batch.commit()
+                    stats['certificates'] += 1
+                    stats['bytes'] += len(buffer)
+                    continue
+
+                if name == INDEX:
+                    # the database is built from index.txt in bulk the
+                    # first time it is opened
+                    ca.close_database()
+                    path = ca.config.get_ca_database(ca.ca)
+                    mode = 0644
+                elif paths.has_key(name):
+                    path = paths[name]
+                    mode = 0644
+                    if name == PRIVATE_KEY:
+                        mode = fileutil.PRIVATE
+                elif name == CRLS:
+                    ca.get_database().add_crls(
+                        (int(number), parse_optional(base),
+                         int(this_update), parse_optional(sequence))
+                        for number, base, this_update, sequence
+                        in (line.split() for line in fp))
+                    continue
+                elif name == REVOCATIONS:
+                    ca.get_database().add_revocations(
+                        (int(sequence), serial)
+                        for sequence, serial
+                        in (line.split() for line in fp))
+                    continue
+                elif name == RENEWALS:
+                    ca.get_database().add_renewals(
+                        (serial, renewed_by, int(renewed))
+                        for serial, renewed_by, renewed
+                        in (line.split() for line in fp))
+                    continue
+                else:
+                    raise ArchiveException('Unknown member %s' % name)
+
+                out = fileutil.AtomicFile(path, mode)
+                try:
+                    stats['bytes'] += copy_file(fp, out)
+                except:
+                    out.abort()
+                    raise
+                out.commit()
+                if name == INDEX:
+                    ca.get_database()
+            batch.commit()
+    except:
+        batch.abort()
+        raise
+
+    tracing.count('archive.imported', stats['certificates'], ca=ca.ca)
+    stats['seconds'] = time.time() - start
+    if stats['seconds']:
+        stats['rate'] = stats['certificates'] / stats['seconds']
+    return stats
+
+def main(args=None):
+    from configparser import OpenSSLConfigParser
+    from ca import CertificateAuthority
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] export|import CONFIG [ARCHIVE]',
+        description='Exports a CA to a single compressed archive, or '
+                    'imports it from one. ARCHIVE defaults to the standard '
+                    'output or input.')
+    parser.add_option('-c', '--ca', default='',
+                      help='CA section [the default CA]')
+    parser.add_option('-f', '--force', action='store_true', default=False,
+                      help='import over an existing CA, wiping it')
+    parser.add_option('-n', '--no-private-key', action='store_false',
+                      dest='private_key', default=True,
+                      help='leave the CA private key out of the export')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='report how many certificates were handled')
+    options, args = parser.parse_args(args)
+    if len(args) not in (2, 3) or args[0] not in ('export', 'import'):
+        parser.error('an action (export or import) and a config file are '
+                     'required')
+
+    config = OpenSSLConfigParser()
+    config.read_cached(args[1])
+    ca = CertificateAuthority(config, options.ca)
+
+    exporting = args[0] == 'export'
+    if len(args) == 3 and args[2] != '-':
+        fileobj = open(args[2], exporting and 'wb' or 'rb')
+    elif exporting:
+        fileobj = sys.stdout
+    else:
+        fileobj = sys.stdin
+
+    try:
+        if exporting:
+            stats = export_ca(ca, fileobj, options.private_key)
+        else:
+            stats = import_ca(ca, fileobj, force=options.force)
+    finally:
+        if fileobj not in (sys.stdout, sys.stdin):
+            fileobj.close()
+        ca.close()
+
+    for serial in stats.get('missing', ()):
+        print >> sys.stderr, 'Certificate %s is missing, left out' % serial
+    if options.verbose:
+        print >> sys.stderr, '%d certificates, %d bytes in %.1f seconds' % \
+              (stats['certificates'], stats['bytes'], stats['seconds'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+asyncca.py
+
+    
+"""
+
+__all__ = ['AsyncCertificateAuthority', 'AsyncOperation',
+           'TooManyPendingException']
+
+import pickle
+import traceback
+import threading
+import multiprocessing
+from multiprocessing.pool import Pool, ThreadPool
+
+import tracing
+
+class TooManyPendingException(Exception):
+    '''
+    A non blocking operation was requested while max_pending operations
+    were already pending
+    '''
+    def __init__(self, max_pending):
+        Exception.__init__(self,
+                           'Already %d operations pending' % max_pending)
+
+def run_operation(function, args, kwargs):
+    '''
+    Runs an operation in a pool worker, returning a (success, result or
+    exception) tuple, so that the submitting process learns about
+    failures too
+    '''
+    try:
+        return True, function(*args, **kwargs)
+    except Exception, e:
+        return False, e
+
+class AsyncOperation:
+    '''
+    The result of a pending operation, with the ready(), wait() and get()
+    methods of a multiprocessing AsyncResult
+    '''
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__outcome = None
+
+    def set_outcome(self, outcome):
+        self.__outcome = outcome
+        self.__done.set()
+
+    def ready(self):
+        return self.__done.isSet()
+
+    def wait(self, timeout=None):
+        self.__done.wait(timeout)
+
+    def get(self, timeout=None):
+        '''
+        Returns the operation result, or raises its exception (or
+        multiprocessing.TimeoutError if timeout seconds went by)
+        '''
+        if not self.__done.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        success, value = self.__outcome
+        if not success:
+            raise value
+        return value
+
+class AsyncCertificateAuthority:
+    '''
+    Non blocking front end to a CertificateAuthority
+
+    Every operation returns at once with an AsyncOperation, whose get()
+    returns the operation result (or raises its exception). Optionally,
+    callback(result) or errback(exception) are called when the operation
+    is done. They run in a pool thread, so event loop based programs
+    should hand the result over to their loop (as with gobject.idle_add()
+    or reactor.callFromThread()). Exceptions they raise are printed to
+    stderr and counted (as asyncca.callback_errors), as they would
+    otherwise stop the pool from completing any further operation.
+
+    Crypto operations (key generation, signing, CRLs) run on
+    crypto_pool, and file operations on io_pool. Any object with the
+    multiprocessing Pool apply_async(function, args, callback=callback)
+    method can be given as pools: it must call function(*args) once and
+    pass its result to callback. By default, thread pools are used: the
+    OpenSSL bindings release the GIL while doing crypto, so these scale
+    with the number of CPUs. Operations are methods of the CA, bound to
+    its database, key cache and callbacks, which can not be pickled, so a
+    multiprocessing process pool (which pickles what it runs) refuses
+    them at once, with PicklingError.
+
+    At most max_pending operations may be pending at once. When that
+    many are, new operations raise TooManyPendingException, so that an
+    event loop is never blocked, or if blocking is True, wait until one
+    finishes.
+    '''
+
+    def __init__(self, ca, crypto_pool=None, io_pool=None,
+                 crypto_workers=None, io_workers=4, max_pending=1024,
+                 blocking=False):
+        self.ca = ca
+        self.max_pending = max_pending
+        self.blocking = blocking
+        self.__pending = threading.BoundedSemaphore(max_pending)
+
+        self.__own_pools = []
+        if crypto_pool is None:
+            crypto_pool = ThreadPool(crypto_workers)
+            self.__own_pools.append(crypto_pool)
+        if io_pool is None:
+            io_pool = ThreadPool(io_workers)
+            self.__own_pools.append(io_pool)
+        self.crypto_pool = crypto_pool
+        self.io_pool = io_pool
+
+    def __submit(self, pool, function, args=(), kwargs={}, callback=None,
+                 errback=None):
+        if not self.__pending.acquire(self.blocking):
+            raise TooManyPendingException(self.max_pending)
+
+        operation = AsyncOperation()
+        def done(outcome):
+            # runs in the submitting process, whatever the pool
+            self.__pending.release()
+            operation.set_outcome(outcome)
+            success, value = outcome
+            try:
+                if success and callback is not None:
+                    callback(value)
+                elif not success and errback is not None:
+                    errback(value)
+            except Exception:
+                # this is the thread the pool hands results over on, which
+                # dies on uncaught exceptions
+                tracing.count('asyncca.callback_errors')
+                traceback.print_exc()
+
+        try:
+            task = (function, args, kwargs)
+            if isinstance(pool, Pool) and not isinstance(pool, ThreadPool):
+                # a process pool pickles tasks on a thread of its own,
+                # where failures are lost (along with the pending slot)
+                pickle.dumps(task, pickle.HIGHEST_PROTOCOL)
+            pool.apply_async(run_operation, task, callback=done)
+        except:
+            self.__pending.release()
+            raise
+        return operation
+
+    def create_directory_structure(self, callback=None, errback=None):
+        return self.__submit(self.io_pool, self.ca.create_directory_structure,
+                             callback=callback, errback=errback)
+
+    def create_ca_key(self, size=None, password=None, type=None,
+                      callback=None, errback=None):
+        return self.__submit(self.crypto_pool, self.ca.create_ca_key,
+                             (size, password, type), callback=callback,
+                             errback=errback)
+
+    def create_ca_certificate(self, days=None, password=None, callback=None,
+                              errback=None):
+        return self.__submit(self.crypto_pool, self.ca.create_ca_certificate,
+                             (days, password), callback=callback,
+                             errback=errback)
+
+    def init(self, callback=None, errback=None):
+        return self.__submit(self.crypto_pool, self.ca.init,
+                             callback=callback, errback=errback)
+
+    def create_key(self, path, type=None, size=None, password='',
+                   callback=None, errback=None):
+        return self.__submit(self.crypto_pool, self.ca.create_key,
+                             (path, type, size, password), callback=callback,
+                             errback=errback)
+
+    def sign_request(self, request, days=None, password=None, callback=None,
+                     errback=None):
+        '''
+        Signs a PEM encoded certificate request, the result being the PEM
+        encoded certificate
+        '''
+        return self.__submit(self.crypto_pool, self.ca.sign_request,
+                             (request, days, password), callback=callback,
+                             errback=errback)
+
+    def sign_requests(self, requests, days=None, skip_invalid=False,
+                      stats=None, password=None, callback=None, errback=None):
+        '''
+        Signs a batch of requests, the result being a list of (serial,
+        certificate) tuples, see CertificateAuthority.sign_requests()
+        '''
+        def sign():
+            return list(self.ca.sign_requests(requests, days, skip_invalid,
+                                              stats, password))
+        return self.__submit(self.crypto_pool, sign, callback=callback,
+                             errback=errback)
+
+    def revoke(self, serial, reason=None, when=None, callback=None,
+               errback=None):
+        return self.__submit(self.io_pool, self.ca.revoke,
+                             (serial, reason, when), callback=callback,
+                             errback=errback)
+
+    def generate_crl(self, days=None, password=None, callback=None,
+                     errback=None):
+        return self.__submit(self.crypto_pool, self.ca.generate_crl,
+                             (days, password), callback=callback,
+                             errback=errback)
+
+    def generate_delta_crl(self, hours=24, password=None, callback=None,
+                           errback=None):
+        return self.__submit(self.crypto_pool, self.ca.generate_delta_crl,
+                             (hours, password), callback=callback,
+                             errback=errback)
+
+    def export_database(self, callback=None, errback=None):
+        return self.__submit(self.io_pool, self.ca.export_database,
+                             callback=callback, errback=errback)
+
+    def close(self):
+        '''
+        Waits for pending operations, and stops the pools created by this
+        object
+        '''
+        for pool in self.__own_pools:
+            pool.close()
+            pool.join()
+        self.__own_pools = []
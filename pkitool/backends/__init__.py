@@ -27,3 +27,45 @@ __init__.py
 
     
 """
+
+# backend name -> (module, engine class name), in order of preference
+ENGINES = (('pyopenssl', 'pkitool.backends.pyopenssl', 'OpenSSLEngine'),
+           ('cryptography', 'pkitool.backends.pycryptography',
+            'CryptographyEngine'),
+           ('openssl', 'pkitool.backends.openssl', 'OpenSSLEngine'))
+
+class UnknownEngineException(Exception):
+    def __init__(self, name):
+        Exception.__init__(self, 'Unknown engine: %s' % name)
+
+def get_engine_names():
+    '''
+    Returns the names of all known engines, available or not
+    '''
+    return [name for name, module, cls in ENGINES]
+
+def get_engine_class(name=None):
+    '''
+    Returns the engine class registered as name, such as 'cryptography'
+
+    If name is not given, the default engine class is returned. Raises
+    UnknownEngineException for unknown names, and ImportError if the
+    engine is not available on this system.
+    '''
+    if not name:
+        return get_default_engine_class()
+    for engine_name, module, cls in ENGINES:
+        if engine_name == name:
+            return getattr(__import__(module, {}, {}, [cls]), cls)
+    raise UnknownEngineException(name)
+
+def get_default_engine_class():
+    '''
+    Returns the best engine class available on this system
+    '''
+    for name, module, cls in ENGINES[:-1]:
+        try:
+            return get_engine_class(name)
+        except ImportError:
+            pass
+    return get_engine_class(ENGINES[-1][0])
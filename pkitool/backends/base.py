@@ -28,11 +28,45 @@ base.py
     
 """
 
+import time
+import shutil
+import multiprocessing
+
+from pkitool import fileutil
+
+def _generate_private_key_worker(args):
+    '''
+    Process pool entry point: generates a key with the dump function of an
+    engine (see Base.dump_new_private_key), and returns a (path, buffer,
+    seconds) tuple. Only the PEM buffer crosses the process boundary, key
+    objects can not be pickled.
+    '''
+    dump, path, type, size, password = args
+    start = time.time()
+    buffer = dump(type, size, password)
+    return (path, buffer, time.time() - start)
+
 class Base:
 
+    # dump_new_private_key(type, size, password), returning a new private
+    # key PEM encoded (encrypted with password if given). Engines setting
+    # it (as a staticmethod of a module level function, so that it can be
+    # pickled) get keys generated in a process pool, see
+    # create_private_keys()
+    dump_new_private_key = None
+
+    # key types worth generating in a process pool, all of them if None
+    slow_key_types = None
+
     def __init__(self):
         pass
 
+    def close(self):
+        '''
+        Releases any resources (such as helper processes) held by the engine
+        '''
+        pass
+
     def init_database(self):
         '''
         Initializes the database/directory structure for this CA
@@ -44,3 +78,206 @@ class Base:
         Creates a private key.
         '''
         raise NotImplementedError
+
+    def create_private_keys(self, specs, workers=None, progress=None):
+        '''
+        Creates a batch of private keys.
+
+        specs is a sequence of (path, type, size, password) tuples, where
+        trailing items may be left out to get create_private_key() defaults.
+
+        If given, progress is called as progress(path, seconds) after each
+        key is written, seconds being the time spent generating that key.
+        If it returns False, the batch is cancelled and no further keys are
+        written.
+
+        Returns a list of (path, seconds) tuples for the keys written.
+
+        If the engine has a dump_new_private_key function, and the batch
+        holds keys of slow_key_types, keys are generated by a pool of
+        workers processes (by default, as many as CPUs), and each one is
+        written as soon as it is finished, in completion order. Otherwise,
+        keys are created one at a time, ignoring workers; engines that
+        can generate keys in parallel some other way override this.
+        '''
+        specs = [self.normalize_key_spec(spec) for spec in specs]
+        if not specs:
+            return []
+        if self.dump_new_private_key is None or \
+               (self.slow_key_types is not None and
+                not [spec for spec in specs
+                     if spec[1] in self.slow_key_types]):
+            done = []
+            for path, type, size, password in specs:
+                start = time.time()
+                self.create_private_key(path, type, size, password)
+                elapsed = time.time() - start
+                done.append((path, elapsed))
+                if progress is not None and progress(path, elapsed) is False:
+                    break
+            return done
+
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, len(specs))
+
+        done = []
+        pool = multiprocessing.Pool(workers)
+        try:
+            for path, buffer, elapsed in \
+                    pool.imap_unordered(_generate_private_key_worker,
+                                        [(self.dump_new_private_key,) + spec
+                                         for spec in specs]):
+                self.write_private_key(path, buffer)
+                done.append((path, elapsed))
+                if progress is not None and progress(path, elapsed) is False:
+                    break
+        finally:
+            # terminate() also takes care of the cancelled and the
+            # interrupted (KeyboardInterrupt) cases: keys still being
+            # generated are simply thrown away
+            pool.terminate()
+            pool.join()
+        return done
+
+    def normalize_key_spec(self, spec):
+        '''
+        Fills in defaults for a (path, type, size, password) key spec
+        '''
+        if isinstance(spec, basestring):
+            spec = (spec,)
+        defaults = (None, 'rsa', 1024, '')
+        return tuple(spec) + defaults[len(spec):]
+
+    def write_private_key(self, path, buffer):
+        '''
+        Writes an already encoded private key to path, atomically and
+        readable only by its owner (see fileutil.AtomicFile)
+        '''
+        fileutil.write_file(path, buffer, fileutil.PRIVATE)
+
+    def protect_private_key(self, src, path, password=''):
+        '''
+        Moves the unencrypted private key at src to path
+
+        If password is given, the key is encrypted with it on the way.
+        src is removed in any case.
+        '''
+        if password:
+            raise NotImplementedError
+        shutil.move(src, path)
+
+    # Subjects (distinguished names) are handled as lists of
+    # (short name, value) tuples, such as [('C', 'US'), ('CN', 'foo')]
+
+    def load_private_key(self, path, password=''):
+        '''
+        Loads a private key, decrypting it with password if given
+        '''
+        raise NotImplementedError
+
+    def load_certificate(self, path):
+        '''
+        Loads a PEM encoded certificate
+        '''
+        raise NotImplementedError
+
+    def load_request(self, buffer):
+        '''
+        Parses a PEM encoded certificate request
+        '''
+        raise NotImplementedError
+
+    def get_request_subject(self, request):
+        raise NotImplementedError
+
+    def get_request_public_key(self, request):
+        '''
+        Returns the public key of a request, PEM encoded (as a
+        SubjectPublicKeyInfo), to compare with get_certificate_public_key()
+        '''
+        raise NotImplementedError
+
+    def create_request(self, key, subject, digest):
+        '''
+        Creates a certificate request for key (as returned by
+        load_private_key()), returning it PEM encoded
+        '''
+        raise NotImplementedError
+
+    def get_certificate_subject(self, cert):
+        raise NotImplementedError
+
+    def get_certificate_public_key(self, cert):
+        '''
+        Returns the public key of a certificate, PEM encoded (as a
+        SubjectPublicKeyInfo)
+        '''
+        raise NotImplementedError
+
+    def get_certificate_not_after(self, cert):
+        '''
+        Returns the certificate expiry time, in seconds since the epoch
+        '''
+        raise NotImplementedError
+
+    def create_self_signed_certificate(self, key, subject, serial, days,
+                                       digest):
+        '''
+        Creates a CA certificate, signed with its own key
+        '''
+        raise NotImplementedError
+
+    def sign_ca_certificate(self, key, subject, issuer_cert, issuer_key,
+                            serial, days, digest):
+        '''
+        Creates an intermediate CA certificate for key (a private key, as
+        returned by load_private_key()), signed by the issuer
+        '''
+        raise NotImplementedError
+
+    def sign_request(self, request, subject, issuer_cert, issuer_key,
+                     serial, days, digest):
+        '''
+        Issues an end entity certificate for the public key in request
+
+        The certificate subject is the given one, and not necessarily
+        the one found in the request.
+        '''
+        raise NotImplementedError
+
+    def dump_certificate(self, cert):
+        '''
+        Returns a certificate PEM encoded
+        '''
+        raise NotImplementedError
+
+    def create_crl(self, revoked, issuer_cert, issuer_key, number,
+                   last_update, next_update, digest, delta_base=None):
+        '''
+        Creates a CRL, returning it PEM encoded
+
+        revoked is an iterable of (serial, revocation time, reason)
+        tuples, reason being an openssl reason name (such as
+        'keyCompromise') or None. Times are seconds since the epoch.
+
+        If delta_base is given, a delta CRL against the base CRL with that
+        number is created.
+        '''
+        raise NotImplementedError
+
+    def create_ocsp_response(self, cert, issuer_cert, issuer_key, revoked,
+                             reason, this_update, next_update, digest,
+                             cert_id_hash='sha1'):
+        '''
+        Creates a signed OCSP response on the status of cert, returning it
+        DER encoded
+
+        revoked is the revocation time of cert, or None if it is good, and
+        reason an openssl reason name or None. Times are seconds since the
+        epoch. The response is signed by the issuer itself, and identifies
+        cert by a CertID hashed with cert_id_hash (a hashlib name, such as
+        'sha1' or 'sha256'). It has no nonce, so it may be handed out to
+        any number of clients until next_update.
+        '''
+        raise NotImplementedError
@@ -0,0 +1,739 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+openssl.py
+
+    
+"""
+
+import os
+import time
+import Queue
+import shutil
+import calendar
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from pkitool import fileutil
+from pkitool.backends.base import Base
+from pkitool.database import normalize_serial
+
+# req/x509/ca configuration used by the engine
+ENGINE_CONFIG = '''
+[ req ]
+distinguished_name = req_distinguished_name
+
+[ req_distinguished_name ]
+
+[ v3_ca ]
+basicConstraints = critical,CA:TRUE
+subjectKeyIdentifier = hash
+
+[ usr_cert ]
+basicConstraints = CA:FALSE
+subjectKeyIdentifier = hash
+authorityKeyIdentifier = keyid
+
+[ ca ]
+default_ca = engine_ca
+
+[ engine_ca ]
+unique_subject = no
+crl_extensions = crl_ext
+
+[ engine_policy ]
+
+[ crl_ext ]
+authorityKeyIdentifier = keyid:always
+'''
+
+class OpenSSLError(Exception):
+    '''
+    An openssl command failed
+    '''
+    def __init__(self, args, output):
+        Exception.__init__(self, 'openssl %s failed: %s' % (args[0],
+                                                            output.strip()))
+
+class Password(object):
+    '''
+    A password argument, such as the one following -passin
+
+    Command lines can be read by any local user (see ps), so openssl gets
+    passwords from its environment (as env:NAME) when it is spawned, and
+    on its standard input, which is private, in persistent mode.
+    '''
+    def __init__(self, name, password):
+        self.name = name
+        self.password = password
+
+def quote_arg(arg):
+    '''
+    Quotes an argument for the openssl interactive mode command line
+    '''
+    if '\n' in arg:
+        raise ValueError('can not pass %r to openssl' % arg)
+    if arg and not [c for c in arg if c.isspace() or c in '"\'']:
+        return arg
+    if '"' not in arg:
+        return '"%s"' % arg
+    if "'" not in arg:
+        return "'%s'" % arg
+    raise ValueError('can not pass %r to openssl' % arg)
+
+def format_subj(subject):
+    '''
+    Formats a subject for the -subj option
+    '''
+    return ''.join(['/%s=%s' % (field, value.replace('\\', '\\\\').replace('/', '\\/'))
+                    for field, value in subject])
+
+def parse_subject(output):
+    '''
+    Parses a subject printed with -nameopt sep_multiline,sname
+    '''
+    return [tuple(line.strip().split('=', 1)) for line in output.splitlines()
+            if line.startswith('    ')]
+
+def parse_not_after(output):
+    '''
+    Parses the expiry date printed with -enddate, returning it in
+    seconds since the epoch
+    '''
+    for line in output.splitlines():
+        if line.startswith('notAfter='):
+            return calendar.timegm(time.strptime(line[len('notAfter='):],
+                                                 '%b %d %H:%M:%S %Y GMT'))
+    raise OpenSSLError(['x509'], output)
+
+def parse_serial(output):
+    '''
+    Parses the serial number printed with -serial
+    '''
+    for line in output.splitlines():
+        if line.startswith('serial='):
+            return long(line[len('serial='):], 16)
+    raise OpenSSLError(['x509'], output)
+
+def get_version(binary):
+    '''
+    Returns the openssl version, as a tuple of integers
+    '''
+    output = subprocess.Popen([binary, 'version'],
+                              stdout=subprocess.PIPE).communicate()[0]
+    version = output.split()[1]
+    return tuple([int(''.join([c for c in part if c.isdigit()]) or 0)
+                  for part in version.split('.')])
+
+class OpenSSLProcess:
+    '''
+    A long lived openssl process, fed with commands in interactive mode
+    '''
+
+    PROMPT = 'OpenSSL> '
+
+    def __init__(self, binary):
+        self.process = subprocess.Popen([binary], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        close_fds=True)
+        self.__read_output()
+
+    def __read_output(self):
+        output = ''
+        fd = self.process.stdout.fileno()
+        while not output.endswith(self.PROMPT):
+            data = os.read(fd, 65536)
+            if not data:
+                raise OpenSSLError(['interactive mode'], output)
+            output = output + data
+        return output[:-len(self.PROMPT)]
+
+    def run(self, args):
+        self.process.stdin.write(' '.join([quote_arg(arg) for arg in args]) +
+                                 '\n')
+        self.process.stdin.flush()
+        output = self.__read_output()
+        if ('error in %s' % args[0]) in output.splitlines():
+            raise OpenSSLError(args, output)
+        return output
+
+    def close(self):
+        try:
+            self.process.stdin.write('quit\n')
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.wait()
+
+class OpenSSLRunner:
+    '''
+    Runs openssl commands
+
+    If persistent is True, commands are fed to a pool of at most size
+    long lived openssl processes (running in interactive mode), so that
+    no fork/exec is needed per command. Otherwise, a new openssl process
+    is started for every command.
+    '''
+
+    def __init__(self, binary, size, persistent):
+        self.binary = binary
+        self.size = size
+        self.persistent = persistent
+        self.__idle = Queue.Queue()
+        self.__lock = threading.Lock()
+        self.__processes = []
+
+    def __acquire(self):
+        try:
+            return self.__idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self.__lock.acquire()
+        try:
+            if len(self.__processes) < self.size:
+                process = OpenSSLProcess(self.binary)
+                self.__processes.append(process)
+                return process
+        finally:
+            self.__lock.release()
+        return self.__idle.get()
+
+    def run(self, args, spawn=False):
+        '''
+        Runs an openssl command, returning its (merged stdout and stderr)
+        output. Raises OpenSSLError if the command fails.
+
+        If spawn is True, a new process is used even in persistent mode.
+        '''
+        if spawn or not self.persistent:
+            env = None
+            command = [self.binary]
+            for arg in args:
+                if isinstance(arg, Password):
+                    if env is None:
+                        env = dict(os.environ)
+                    env[arg.name] = arg.password
+                    arg = 'env:' + arg.name
+                command.append(arg)
+
+            devnull = open(os.devnull)
+            try:
+                process = subprocess.Popen(command, stdin=devnull,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT,
+                                           close_fds=True, env=env)
+                output = process.communicate()[0]
+            finally:
+                devnull.close()
+            if process.returncode:
+                raise OpenSSLError(args, output)
+            return output
+
+        command = []
+        for arg in args:
+            if isinstance(arg, Password):
+                arg = 'pass:' + arg.password
+            command.append(arg)
+
+        process = self.__acquire()
+        try:
+            output = process.run(command)
+        except OpenSSLError:
+            self.__idle.put(process)
+            raise
+        except:
+            # the process is gone or out of sync, drop it
+            self.__lock.acquire()
+            try:
+                self.__processes.remove(process)
+            finally:
+                self.__lock.release()
+            process.close()
+            raise
+        self.__idle.put(process)
+        return output
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            for process in self.__processes:
+                process.close()
+            self.__processes = []
+            self.__idle = Queue.Queue()
+        finally:
+            self.__lock.release()
+
+class TemporaryFile(object):
+    '''
+    A file in the engine temporary directory, removed with its object
+    '''
+    def __init__(self, dir, suffix='.pem', buffer=None):
+        fd, self.path = tempfile.mkstemp(suffix, dir=dir)
+        try:
+            if buffer is not None:
+                os.write(fd, buffer)
+        finally:
+            os.close(fd)
+
+    def read(self):
+        fp = open(self.path)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def __del__(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class Request(TemporaryFile):
+    '''
+    A certificate request file, and its subject
+    '''
+    subject = None
+
+class PrivateKey(object):
+    '''
+    A private key file, and the password to use it
+    '''
+    def __init__(self, path, password):
+        self.path = path
+        self.password = password
+
+    def passin(self):
+        if self.password:
+            return ['-passin', Password('PKITOOL_PASSIN', self.password)]
+        return []
+
+class Certificate(object):
+    '''
+    A PEM encoded certificate, and a file holding it
+    '''
+    def __init__(self, path, pem, file=None, not_after=None):
+        self.path = path
+        self.pem = pem
+        # keeps a temporary file alive
+        self.file = file
+        self.not_after = not_after
+
+class OpenSSLEngine(Base):
+    '''
+    An engine that runs the openssl command line tool
+
+    By default, the "openssl" binary in the PATH is used (or the one named
+    by the PKITOOL_OPENSSL environment variable). With openssl versions
+    that have an interactive mode (before 3.0), commands are fed to a pool
+    of long lived openssl processes, avoiding a fork/exec per operation.
+    openssl 3.0 dropped the interactive mode, so one process per command
+    is used then.
+
+    Passwords never show up on openssl command lines, see Password.
+    '''
+
+    key_types = ('rsa', 'dsa')
+
+    def __init__(self, binary=None, processes=None, persistent=None):
+        Base.__init__(self)
+        if binary is None:
+            binary = os.environ.get('PKITOOL_OPENSSL', 'openssl')
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.version = get_version(binary)
+        if persistent is None:
+            persistent = self.version < (3,)
+        self.processes = processes
+        self.runner = OpenSSLRunner(binary, processes, persistent)
+
+        self.tmpdir = tempfile.mkdtemp(prefix='pkitool-')
+        self.config_path = os.path.join(self.tmpdir, 'engine.cnf')
+        fp = open(self.config_path, 'w')
+        try:
+            fp.write(ENGINE_CONFIG)
+        finally:
+            fp.close()
+
+    def close(self):
+        self.runner.close()
+        shutil.rmtree(self.tmpdir, True)
+
+    def __cipher_args(self, option, password):
+        if password:
+            return ['-des-ede3-cbc', option,
+                    Password('PKITOOL' + option.replace('-', '_').upper(),
+                             password)]
+        return []
+
+    def __write_private_key(self, path, args):
+        '''
+        Runs an openssl command that writes a private key to its -out file
+
+        The command writes to an already created (and private) temporary
+        file, which then replaces path, see fileutil.AtomicFile.
+        '''
+        fp = fileutil.AtomicFile(path, fileutil.PRIVATE)
+        try:
+            self.runner.run(args + ['-out', fp.tmp_path])
+        except:
+            fp.abort()
+            raise
+        fp.commit()
+
+    def create_private_key(self, path, type='rsa', size=1024, password=''):
+        if type == 'rsa':
+            self.__write_private_key(path,
+                                     ['genpkey', '-algorithm', 'RSA',
+                                      '-pkeyopt',
+                                      'rsa_keygen_bits:%d' % size] +
+                                     self.__cipher_args('-pass', password))
+        elif type == 'dsa':
+            params = TemporaryFile(self.tmpdir)
+            self.runner.run(['genpkey', '-genparam', '-algorithm', 'DSA',
+                             '-pkeyopt', 'dsa_paramgen_bits:%d' % size,
+                             '-out', params.path])
+            self.__write_private_key(path,
+                                     ['genpkey', '-paramfile', params.path] +
+                                     self.__cipher_args('-pass', password))
+        else:
+            raise KeyError(type)
+
+    def create_private_keys(self, specs, workers=None, progress=None):
+        '''
+        Creates a batch of private keys, running up to workers (by default,
+        the number of engine processes) openssl commands at once. See
+        Base.create_private_keys().
+
+        When the batch is cancelled, keys already being generated are
+        still written, but not reported.
+        '''
+        specs = [self.normalize_key_spec(spec) for spec in specs]
+        if not specs:
+            return []
+        if workers is None:
+            workers = self.processes
+
+        def create(spec):
+            start = time.time()
+            self.create_private_key(*spec)
+            return spec[0], time.time() - start
+
+        done = []
+        pool = ThreadPool(min(workers, len(specs)))
+        try:
+            for path, elapsed in pool.imap_unordered(create, specs):
+                done.append((path, elapsed))
+                if progress is not None and progress(path, elapsed) is False:
+                    break
+        finally:
+            pool.terminate()
+        return done
+
+    def protect_private_key(self, src, path, password=''):
+        if not password:
+            return Base.protect_private_key(self, src, path)
+        self.__write_private_key(path, ['pkey', '-in', src] +
+                                 self.__cipher_args('-passout', password))
+        os.unlink(src)
+
+    def load_private_key(self, path, password=''):
+        key = PrivateKey(path, password)
+        # make sure the key (and password) are good
+        self.runner.run(['pkey', '-in', path, '-noout'] + key.passin())
+        return key
+
+    def load_certificate(self, path):
+        fp = open(path)
+        try:
+            return Certificate(path, fp.read())
+        finally:
+            fp.close()
+
+    def load_request(self, buffer):
+        request = Request(self.tmpdir, '.csr', buffer)
+        # checking and parsing the request at once saves a command
+        request.subject = parse_subject(
+            self.runner.run(['req', '-config', self.config_path,
+                             '-in', request.path, '-noout', '-verify',
+                             '-subject', '-nameopt',
+                             'sep_multiline,sname,utf8']))
+        return request
+
+    def get_request_subject(self, request):
+        return request.subject
+
+    def get_request_public_key(self, request):
+        return self.runner.run(['req', '-in', request.path, '-noout',
+                                '-pubkey'])
+
+    def get_certificate_subject(self, cert):
+        return parse_subject(self.runner.run(['x509', '-in', cert.path,
+                                              '-noout', '-subject',
+                                              '-nameopt',
+                                              'sep_multiline,sname,utf8']))
+
+    def get_certificate_public_key(self, cert):
+        return self.runner.run(['x509', '-in', cert.path, '-noout',
+                                '-pubkey'])
+
+    def get_certificate_not_after(self, cert):
+        if cert.not_after is None:
+            cert.not_after = parse_not_after(
+                self.runner.run(['x509', '-in', cert.path, '-noout',
+                                 '-enddate']))
+        return cert.not_after
+
+    def __new_certificate(self, args, spawn=False):
+        out = TemporaryFile(self.tmpdir)
+        self.runner.run(args + ['-out', out.path], spawn)
+        output = out.read()
+        pem = output[output.index('-----BEGIN'):]
+        not_after = None
+        if '-enddate' in args:
+            not_after = parse_not_after(output)
+        return Certificate(out.path, pem, out, not_after)
+
+    def create_self_signed_certificate(self, key, subject, serial, days,
+                                       digest):
+        return self.__new_certificate(['req', '-new', '-x509',
+                                       '-config', self.config_path,
+                                       '-extensions', 'v3_ca',
+                                       '-key', key.path] + key.passin() +
+                                      ['-subj', format_subj(subject),
+                                       '-set_serial', '0x%X' % serial,
+                                       '-days', str(days), '-' + digest])
+
+    def __new_request(self, key, subject, digest='sha256'):
+        request = Request(self.tmpdir, '.csr')
+        self.runner.run(['req', '-new', '-config', self.config_path,
+                         '-key', key.path] + key.passin() +
+                        ['-subj', format_subj(subject), '-' + digest,
+                         '-out', request.path])
+        request.subject = subject
+        return request
+
+    def create_request(self, key, subject, digest):
+        return self.__new_request(key, subject, digest).read()
+
+    def sign_ca_certificate(self, key, subject, issuer_cert, issuer_key,
+                            serial, days, digest):
+        # the request carries the subject, so x509 -req needs no -subj
+        request = self.__new_request(key, subject, digest)
+        return self.__new_certificate(['x509', '-req', '-in', request.path,
+                                       '-CA', issuer_cert.path,
+                                       '-CAkey', issuer_key.path] +
+                                      issuer_key.passin() +
+                                      ['-set_serial', '0x%X' % serial,
+                                       '-days', str(days), '-' + digest,
+                                       '-extfile', self.config_path,
+                                       '-extensions', 'v3_ca', '-enddate'])
+
+    def sign_request(self, request, subject, issuer_cert, issuer_key,
+                     serial, days, digest):
+        args = ['x509', '-req', '-in', request.path,
+                '-CA', issuer_cert.path, '-CAkey', issuer_key.path] + \
+               issuer_key.passin() + \
+               ['-set_serial', '0x%X' % serial, '-days', str(days),
+                '-' + digest, '-extfile', self.config_path,
+                '-extensions', 'usr_cert',
+                # makes openssl print the expiry date ahead of the
+                # certificate, which saves running another command
+                '-enddate']
+        if subject != request.subject:
+            if self.version < (3,):
+                return self.__sign_with_ca(request, subject, issuer_cert,
+                                           issuer_key, serial, days, digest)
+            args = args + ['-subj', format_subj(subject)]
+        return self.__new_certificate(args)
+
+    def __sign_with_ca(self, request, subject, issuer_cert, issuer_key,
+                       serial, days, digest):
+        '''
+        Issues a certificate with a subject other than the one in the
+        request: openssl x509 only has -subj since 3.0, so openssl ca is
+        used instead, on a throw away database
+        '''
+        workdir = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            index_path = os.path.join(workdir, 'index.txt')
+            open(index_path, 'w').close()
+            serial_path = os.path.join(workdir, 'serial')
+            fp = open(serial_path, 'w')
+            try:
+                fp.write(normalize_serial(serial) + '\n')
+            finally:
+                fp.close()
+            config_path = self.__write_ca_config(workdir,
+                                                 'database = %s\n'
+                                                 'serial = %s\n'
+                                                 'new_certs_dir = %s\n'
+                                                 'policy = engine_policy\n' %
+                                                 (index_path, serial_path,
+                                                  workdir))
+            return self.__new_certificate(['ca', '-batch',
+                                           '-config', config_path,
+                                           '-name', 'engine_ca',
+                                           '-in', request.path,
+                                           '-cert', issuer_cert.path,
+                                           '-keyfile', issuer_key.path] +
+                                          issuer_key.passin() +
+                                          ['-subj', format_subj(subject),
+                                           '-preserveDN', '-notext',
+                                           '-days', str(days), '-md', digest,
+                                           '-extfile', self.config_path,
+                                           '-extensions', 'usr_cert'],
+                                          spawn=True)
+        finally:
+            shutil.rmtree(workdir, True)
+
+    def __write_ca_config(self, workdir, options):
+        '''
+        Writes a config for openssl ca, with the given engine_ca options
+        '''
+        config_path = os.path.join(workdir, 'openssl.cnf')
+        fp = open(config_path, 'w')
+        try:
+            fp.write(ENGINE_CONFIG)
+            fp.write('[ engine_ca ]\n' + options)
+        finally:
+            fp.close()
+        return config_path
+
+    def dump_certificate(self, cert):
+        return cert.pem
+
+    def create_crl(self, revoked, issuer_cert, issuer_key, number,
+                   last_update, next_update, digest, delta_base=None):
+        # openssl ca -gencrl works from an openssl database, so a throw
+        # away one is written with the revoked certificates. openssl 1.1
+        # ca crashes when run in a long lived interactive process, so it
+        # always gets a process of its own
+        from pkitool.database import format_time
+
+        workdir = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            index_path = os.path.join(workdir, 'index.txt')
+            fp = open(index_path, 'w')
+            try:
+                for serial, when, reason in revoked:
+                    revocation = format_time(when)
+                    if reason:
+                        revocation = '%s,%s' % (revocation, reason)
+                    fp.write('R\t491231235959Z\t%s\t%s\tunknown\t/CN=%s\n' %
+                             (revocation, normalize_serial(serial),
+                              normalize_serial(serial)))
+            finally:
+                fp.close()
+
+            crlnumber_path = os.path.join(workdir, 'crlnumber')
+            fp = open(crlnumber_path, 'w')
+            try:
+                fp.write(normalize_serial(number) + '\n')
+            finally:
+                fp.close()
+
+            options = 'database = %s\ncrlnumber = %s\n' % (index_path,
+                                                            crlnumber_path)
+            extensions = []
+            if delta_base is not None:
+                # the crl_ext extensions, and the delta CRL indicator
+                # (openssl only takes deltaCRL in its generic form)
+                options = options + ('[ engine_delta_crl_ext ]\n'
+                                     'authorityKeyIdentifier = keyid:always\n'
+                                     'deltaCRL = critical, '
+                                     'ASN1:INTEGER:%d\n' % delta_base)
+                extensions = ['-crlexts', 'engine_delta_crl_ext']
+            config_path = self.__write_ca_config(workdir, options)
+
+            out_path = os.path.join(workdir, 'crl.pem')
+            self.runner.run(['ca', '-gencrl', '-config', config_path,
+                             '-name', 'engine_ca',
+                             '-keyfile', issuer_key.path,
+                             '-cert', issuer_cert.path,
+                             '-md', digest,
+                             '-crlsec', str(next_update - last_update),
+                             '-out', out_path] + extensions +
+                            issuer_key.passin(), spawn=True)
+            fp = open(out_path)
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+        finally:
+            shutil.rmtree(workdir, True)
+
+    def create_ocsp_response(self, cert, issuer_cert, issuer_key, revoked,
+                             reason, this_update, next_update, digest,
+                             cert_id_hash='sha1'):
+        # openssl ocsp answers requests from an openssl database, so a
+        # request for cert and a throw away database holding cert are
+        # written. openssl picks this_update itself
+        from pkitool.database import CertificateRecord
+
+        workdir = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            request_path = os.path.join(workdir, 'request.der')
+            # the digest option must come ahead of -cert
+            self.runner.run(['ocsp', '-issuer', issuer_cert.path,
+                             '-' + cert_id_hash, '-cert', cert.path,
+                             '-no_nonce', '-reqout', request_path])
+
+            output = self.runner.run(['x509', '-in', cert.path, '-noout',
+                                      '-serial', '-enddate'])
+            if revoked is None:
+                status = 'V'
+            else:
+                status = 'R'
+            record = CertificateRecord(parse_serial(output), status,
+                                       parse_not_after(output), revoked,
+                                       reason)
+            index_path = os.path.join(workdir, 'index.txt')
+            fp = open(index_path, 'w')
+            try:
+                fp.write(record.to_index_line())
+            finally:
+                fp.close()
+
+            response_path = os.path.join(workdir, 'response.der')
+            self.runner.run(['ocsp', '-index', index_path,
+                             '-CA', issuer_cert.path,
+                             '-rsigner', issuer_cert.path,
+                             '-rkey', issuer_key.path] + issuer_key.passin() +
+                            ['-rmd', digest, '-resp_key_id',
+                             '-nmin', str(max(1, (next_update - this_update)
+                                                 / 60)),
+                             '-reqin', request_path,
+                             '-respout', response_path], spawn=True)
+            fp = open(response_path, 'rb')
+            try:
+                return fp.read()
+            finally:
+                fp.close()
+        finally:
+            shutil.rmtree(workdir, True)
@@ -0,0 +1,325 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+pycryptography.py
+
+    
+"""
+
+import os
+import time
+import calendar
+import datetime
+
+from cryptography import x509
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, dsa, ec, ed25519
+
+from pkitool.backends.base import Base
+
+KEY_TYPES = ('rsa', 'dsa', 'ec', 'ed25519')
+
+# EC key size -> curve
+EC_CURVES = {256 : ec.SECP256R1,
+             384 : ec.SECP384R1,
+             521 : ec.SECP521R1}
+
+# subject short names, as used by the other engines -> OIDs
+NAME_OIDS = {'C' : NameOID.COUNTRY_NAME,
+             'ST' : NameOID.STATE_OR_PROVINCE_NAME,
+             'L' : NameOID.LOCALITY_NAME,
+             'O' : NameOID.ORGANIZATION_NAME,
+             'OU' : NameOID.ORGANIZATIONAL_UNIT_NAME,
+             'CN' : NameOID.COMMON_NAME,
+             'emailAddress' : NameOID.EMAIL_ADDRESS}
+
+SHORT_NAMES = dict([(oid, name) for name, oid in NAME_OIDS.items()])
+
+# openssl reason names -> CRL entry reason codes
+CRL_REASONS = dict([(flag.value, flag) for flag in x509.ReasonFlags])
+CRL_REASONS['CACompromise'] = x509.ReasonFlags.ca_compromise
+
+def generate_private_key(type='rsa', size=1024):
+    '''
+    Generates a private key. For EC keys, size selects the curve, and it
+    is ignored for Ed25519 keys.
+    '''
+    if type == 'rsa':
+        return rsa.generate_private_key(65537, size, default_backend())
+    elif type == 'dsa':
+        return dsa.generate_private_key(size, default_backend())
+    elif type == 'ec':
+        if not EC_CURVES.has_key(size):
+            raise ValueError('Unsupported EC key size: %s' % size)
+        return ec.generate_private_key(EC_CURVES[size](), default_backend())
+    elif type == 'ed25519':
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError('Unsupported key type: %s' % type)
+
+def dump_private_key(key, password=''):
+    '''
+    Returns a private key PEM encoded (PKCS#8), encrypted with password
+    if given
+    '''
+    if password:
+        encryption = serialization.BestAvailableEncryption(password)
+    else:
+        encryption = serialization.NoEncryption()
+    return key.private_bytes(serialization.Encoding.PEM,
+                             serialization.PrivateFormat.PKCS8,
+                             encryption)
+
+def dump_public_key(key):
+    '''
+    Returns a public key PEM encoded, as a SubjectPublicKeyInfo
+    '''
+    return key.public_bytes(serialization.Encoding.PEM,
+                            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+def get_hash(key, digest):
+    '''
+    Returns the hash algorithm to sign with key. Ed25519 keys have their
+    own, so digest is ignored for them.
+    '''
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        return None
+    return getattr(hashes, digest.upper())()
+
+def to_timestamp(when):
+    return calendar.timegm(when.utctimetuple())
+
+def from_timestamp(when):
+    return datetime.datetime.utcfromtimestamp(when)
+
+def build_crl(revoked, issuer_cert, issuer_key, number, last_update,
+              next_update, digest, delta_base=None):
+    '''
+    Creates a CRL from cryptography certificate and key objects,
+    returning it PEM encoded. See Base.create_crl().
+    '''
+    builder = x509.CertificateRevocationListBuilder()
+    builder = builder.issuer_name(issuer_cert.subject)
+    builder = builder.last_update(from_timestamp(last_update))
+    builder = builder.next_update(from_timestamp(next_update))
+    builder = builder.add_extension(x509.CRLNumber(number), False)
+    builder = builder.add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer_cert.public_key()),
+        False)
+    if delta_base is not None:
+        builder = builder.add_extension(x509.DeltaCRLIndicator(delta_base),
+                                        True)
+
+    for serial, when, reason in revoked:
+        entry = x509.RevokedCertificateBuilder()
+        entry = entry.serial_number(serial)
+        entry = entry.revocation_date(from_timestamp(when))
+        if reason:
+            entry = entry.add_extension(x509.CRLReason(CRL_REASONS[reason]),
+                                        False)
+        builder = builder.add_revoked_certificate(entry.build(default_backend()))
+
+    crl = builder.sign(issuer_key, get_hash(issuer_key, digest),
+                       default_backend())
+    return crl.public_bytes(serialization.Encoding.PEM)
+
+# CertID hash names -> algorithms
+OCSP_HASHES = {'sha1' : hashes.SHA1,
+               'sha256' : hashes.SHA256}
+
+def build_ocsp_response(cert, issuer_cert, issuer_key, revoked, reason,
+                        this_update, next_update, digest, cert_id_hash='sha1'):
+    '''
+    Creates an OCSP response from cryptography certificate and key
+    objects, returning it DER encoded. See Base.create_ocsp_response().
+    '''
+    if revoked is None:
+        status = ocsp.OCSPCertStatus.GOOD
+        revocation_time = revocation_reason = None
+    else:
+        status = ocsp.OCSPCertStatus.REVOKED
+        revocation_time = from_timestamp(revoked)
+        revocation_reason = reason and CRL_REASONS[reason] or None
+
+    builder = ocsp.OCSPResponseBuilder()
+    builder = builder.add_response(cert, issuer_cert,
+                                   OCSP_HASHES[cert_id_hash](), status,
+                                   from_timestamp(this_update),
+                                   from_timestamp(next_update),
+                                   revocation_time, revocation_reason)
+    builder = builder.responder_id(ocsp.OCSPResponderEncoding.HASH,
+                                   issuer_cert)
+    response = builder.sign(issuer_key, get_hash(issuer_key, digest))
+    return response.public_bytes(serialization.Encoding.DER)
+
+def dump_new_private_key(type='rsa', size=1024, password=''):
+    '''
+    Generates a private key and returns it PEM encoded, see
+    dump_private_key()
+    '''
+    return dump_private_key(generate_private_key(type, size), password)
+
+class CryptographyEngine(Base):
+    '''
+    An engine built on the cryptography package
+
+    Besides RSA and DSA, it handles ECDSA (P-256, P-384 and P-521) and
+    Ed25519 keys, which are much cheaper to generate and sign with than
+    RSA keys of comparable strength.
+    '''
+
+    key_types = KEY_TYPES
+    dump_new_private_key = staticmethod(dump_new_private_key)
+
+    # EC and Ed25519 keys take less to generate than to hand over to
+    # another process, so batches of them are generated in place
+    slow_key_types = ('rsa', 'dsa')
+
+    def __init__(self):
+        Base.__init__(self)
+
+    def create_private_key(self, path, type='rsa', size=1024, password=''):
+        self.write_private_key(path, dump_new_private_key(type, size,
+                                                          password))
+
+    def protect_private_key(self, src, path, password=''):
+        if not password:
+            return Base.protect_private_key(self, src, path)
+        self.write_private_key(path,
+                               dump_private_key(self.load_private_key(src),
+                                                password))
+        os.unlink(src)
+
+    def __read(self, path):
+        fp = open(path)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def load_private_key(self, path, password=''):
+        return serialization.load_pem_private_key(self.__read(path),
+                                                  password or None,
+                                                  default_backend())
+
+    def load_certificate(self, path):
+        return x509.load_pem_x509_certificate(self.__read(path),
+                                              default_backend())
+
+    def load_request(self, buffer):
+        request = x509.load_pem_x509_csr(buffer, default_backend())
+        if not request.is_signature_valid:
+            raise ValueError('Bad certificate request signature')
+        return request
+
+    def __get_subject(self, name):
+        return [(SHORT_NAMES.get(attribute.oid, attribute.oid.dotted_string),
+                 attribute.value.encode('utf-8'))
+                for attribute in name]
+
+    def get_request_subject(self, request):
+        return self.__get_subject(request.subject)
+
+    def get_request_public_key(self, request):
+        return dump_public_key(request.public_key())
+
+    def __get_name(self, subject):
+        return x509.Name([x509.NameAttribute(NAME_OIDS[field],
+                                             value.decode('utf-8'))
+                          for field, value in subject])
+
+    def create_request(self, key, subject, digest):
+        builder = x509.CertificateSigningRequestBuilder()
+        builder = builder.subject_name(self.__get_name(subject))
+        request = builder.sign(key, get_hash(key, digest), default_backend())
+        return request.public_bytes(serialization.Encoding.PEM)
+
+    def get_certificate_subject(self, cert):
+        return self.__get_subject(cert.subject)
+
+    def get_certificate_public_key(self, cert):
+        return dump_public_key(cert.public_key())
+
+    def get_certificate_not_after(self, cert):
+        return to_timestamp(cert.not_valid_after)
+
+    def __create_certificate(self, subject, public_key, issuer, serial, days,
+                             ca):
+        name = self.__get_name(subject)
+        now = int(time.time())
+
+        builder = x509.CertificateBuilder()
+        builder = builder.subject_name(name)
+        builder = builder.public_key(public_key)
+        builder = builder.serial_number(serial)
+        builder = builder.not_valid_before(from_timestamp(now))
+        builder = builder.not_valid_after(from_timestamp(now +
+                                                         days * 24 * 60 * 60))
+        builder = builder.add_extension(x509.BasicConstraints(ca, None), True)
+        builder = builder.add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(public_key), False)
+        if issuer is None:
+            return builder.issuer_name(name)
+        builder = builder.issuer_name(issuer.subject)
+        return builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(issuer.public_key()),
+            False)
+
+    def create_self_signed_certificate(self, key, subject, serial, days,
+                                       digest):
+        builder = self.__create_certificate(subject, key.public_key(), None,
+                                            serial, days, True)
+        return builder.sign(key, get_hash(key, digest), default_backend())
+
+    def sign_ca_certificate(self, key, subject, issuer_cert, issuer_key,
+                            serial, days, digest):
+        builder = self.__create_certificate(subject, key.public_key(),
+                                            issuer_cert, serial, days, True)
+        return builder.sign(issuer_key, get_hash(issuer_key, digest),
+                            default_backend())
+
+    def sign_request(self, request, subject, issuer_cert, issuer_key,
+                     serial, days, digest):
+        builder = self.__create_certificate(subject, request.public_key(),
+                                            issuer_cert, serial, days, False)
+        return builder.sign(issuer_key, get_hash(issuer_key, digest),
+                            default_backend())
+
+    def dump_certificate(self, cert):
+        return cert.public_bytes(serialization.Encoding.PEM)
+
+    def create_crl(self, revoked, issuer_cert, issuer_key, number,
+                   last_update, next_update, digest, delta_base=None):
+        return build_crl(revoked, issuer_cert, issuer_key, number,
+                         last_update, next_update, digest, delta_base)
+
+    def create_ocsp_response(self, cert, issuer_cert, issuer_key, revoked,
+                             reason, this_update, next_update, digest,
+                             cert_id_hash='sha1'):
+        return build_ocsp_response(cert, issuer_cert, issuer_key, revoked,
+                                   reason, this_update, next_update, digest,
+                                   cert_id_hash)
@@ -32,10 +32,15 @@ import os
 import OpenSSL
 
 from pkitool.backends.base import Base
+from pkitool.backends.pycryptography import build_crl, build_ocsp_response
 from pkitool.configparser import OpenSSLConfigParser
+from pkitool.database import parse_time
 
 DEFAULT_ROOT_DIR = os.path.expanduser('~/pkitool-ca')
 
+KEY_TYPES = {'rsa' : OpenSSL.crypto.TYPE_RSA,
+             'dsa' : OpenSSL.crypto.TYPE_DSA}
+
 def mkdir_silent_if_isdir(path):
     '''
     Create a directory, bailing out silently if it already exists
@@ -45,10 +50,28 @@ def mkdir_silent_if_isdir(path):
     else:
         os.mkdir(path)
 
+def dump_new_private_key(type='rsa', size=1024, password=''):
+    '''
+    Generates a private key and returns it PEM encoded
+
+    If password is given, the key is encrypted with DES-EDE3-CBC.
+    '''
+    pkey = OpenSSL.crypto.PKey()
+    pkey.generate_key(KEY_TYPES[type], size)
+
+    if password:
+        return OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                              pkey,
+                                              'DES-EDE3-CBC',
+                                              password)
+    else:
+        return OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                              pkey)
+
 class OpenSSLEngine(Base):
 
-    key_types = {'rsa' : OpenSSL.crypto.TYPE_RSA,
-                 'dsa' : OpenSSL.crypto.TYPE_DSA}
+    key_types = KEY_TYPES
+    dump_new_private_key = staticmethod(dump_new_private_key)
     
     def __init__(self):
         Base.__init__(self)
@@ -77,18 +100,147 @@ class OpenSSLEngine(Base):
         # no need to do nothing about the other files and directories
 
     def create_private_key(self, path, type='rsa', size=1024, password=''):
-        pkey = OpenSSL.crypto.PKey()
-        pkey.generate_key(self.key_types[type], size)
+        self.write_private_key(path, dump_new_private_key(type, size, password))
 
+    def protect_private_key(self, src, path, password=''):
+        if not password:
+            return Base.protect_private_key(self, src, path)
+
+        fp = open(src)
+        try:
+            pkey = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                                  fp.read())
+        finally:
+            fp.close()
+        buffer = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                                pkey,
+                                                'DES-EDE3-CBC',
+                                                password)
+        self.write_private_key(path, buffer)
+        os.unlink(src)
+
+    def load_private_key(self, path, password=''):
+        fp = open(path)
+        try:
+            buffer = fp.read()
+        finally:
+            fp.close()
         if password:
-            buffer = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM,
-                                                    pkey,
-                                                    'DES-EDE3-CBC',
-                                                    password)
+            return OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                                  buffer, password)
+        return OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM,
+                                              buffer)
+
+    def load_certificate(self, path):
+        fp = open(path)
+        try:
+            buffer = fp.read()
+        finally:
+            fp.close()
+        return OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM,
+                                               buffer)
+
+    def load_request(self, buffer):
+        request = OpenSSL.crypto.load_certificate_request(OpenSSL.crypto.FILETYPE_PEM,
+                                                          buffer)
+        # proof of possession of the private key
+        try:
+            request.verify(request.get_pubkey())
+        except OpenSSL.crypto.Error:
+            raise ValueError('Bad certificate request signature')
+        return request
+
+    def get_request_subject(self, request):
+        return request.get_subject().get_components()
+
+    def get_request_public_key(self, request):
+        return OpenSSL.crypto.dump_publickey(OpenSSL.crypto.FILETYPE_PEM,
+                                             request.get_pubkey())
+
+    def create_request(self, key, subject, digest):
+        request = OpenSSL.crypto.X509Req()
+        name = request.get_subject()
+        for field, value in subject:
+            setattr(name, field, value)
+        request.set_pubkey(key)
+        request.sign(key, digest)
+        return OpenSSL.crypto.dump_certificate_request(
+            OpenSSL.crypto.FILETYPE_PEM, request)
+
+    def get_certificate_subject(self, cert):
+        return cert.get_subject().get_components()
+
+    def get_certificate_public_key(self, cert):
+        return OpenSSL.crypto.dump_publickey(OpenSSL.crypto.FILETYPE_PEM,
+                                             cert.get_pubkey())
+
+    def get_certificate_not_after(self, cert):
+        return parse_time(cert.get_notAfter())
+
+    def __create_certificate(self, subject, pubkey, issuer, serial, days, ca):
+        cert = OpenSSL.crypto.X509()
+        cert.set_version(2)
+        cert.set_serial_number(serial)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(days * 24 * 60 * 60)
+
+        name = cert.get_subject()
+        for field, value in subject:
+            setattr(name, field, value)
+        if issuer is None:
+            issuer = name
+        cert.set_issuer(issuer)
+        cert.set_pubkey(pubkey)
+
+        if ca:
+            constraints = 'CA:TRUE'
         else:
-            buffer = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_PEM,
-                                                    pkey)
-        fp = open(path, 'w')
-        fp.write(buffer)
-        
-        
+            constraints = 'CA:FALSE'
+        cert.add_extensions([
+            OpenSSL.crypto.X509Extension('basicConstraints', True, constraints),
+            OpenSSL.crypto.X509Extension('subjectKeyIdentifier', False, 'hash',
+                                         subject=cert)])
+        return cert
+
+    def create_self_signed_certificate(self, key, subject, serial, days,
+                                       digest):
+        cert = self.__create_certificate(subject, key, None, serial, days, True)
+        cert.sign(key, digest)
+        return cert
+
+    def sign_ca_certificate(self, key, subject, issuer_cert, issuer_key,
+                            serial, days, digest):
+        cert = self.__create_certificate(subject, key,
+                                         issuer_cert.get_subject(),
+                                         serial, days, True)
+        cert.sign(issuer_key, digest)
+        return cert
+
+    def sign_request(self, request, subject, issuer_cert, issuer_key,
+                     serial, days, digest):
+        cert = self.__create_certificate(subject, request.get_pubkey(),
+                                         issuer_cert.get_subject(),
+                                         serial, days, False)
+        cert.sign(issuer_key, digest)
+        return cert
+
+    def dump_certificate(self, cert):
+        return OpenSSL.crypto.dump_certificate(OpenSSL.crypto.FILETYPE_PEM, cert)
+
+    def create_crl(self, revoked, issuer_cert, issuer_key, number,
+                   last_update, next_update, digest, delta_base=None):
+        # pyOpenSSL can not add CRL extensions, so the CRL is built with
+        # cryptography, which pyOpenSSL is built upon
+        return build_crl(revoked, issuer_cert.to_cryptography(),
+                         issuer_key.to_cryptography_key(), number,
+                         last_update, next_update, digest, delta_base)
+
+    def create_ocsp_response(self, cert, issuer_cert, issuer_key, revoked,
+                             reason, this_update, next_update, digest,
+                             cert_id_hash='sha1'):
+        # pyOpenSSL has no OCSP support either
+        return build_ocsp_response(cert.to_cryptography(),
+                                   issuer_cert.to_cryptography(),
+                                   issuer_key.to_cryptography_key(), revoked,
+                                   reason, this_update, next_update, digest,
+                                   cert_id_hash)
@@ -0,0 +1,504 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+bench.py
+
+    
+"""
+
+__all__ = ['BENCHMARKS', 'run_benchmarks', 'compare_results', 'main']
+
+import os
+import gc
+import sys
+import time
+import json
+import resource
+import shutil
+import platform
+import tempfile
+import optparse
+import subprocess
+
+from configparser import OpenSSLRawConfigParser, OpenSSLConfigParser
+from ca import CertificateAuthority
+from backends import get_engine_class
+
+# key types and sizes benchmarked by default
+KEY_TYPES = (('rsa', 1024), ('rsa', 2048), ('ec', 256), ('ed25519', 256))
+
+# config file sizes, in lines, benchmarked by default
+CONFIG_SIZES = (1000, 10000, 100000)
+
+class Result:
+    '''
+    The samples taken for one measurement, either durations (in seconds)
+    or rates (in operations per second)
+    '''
+    def __init__(self, unit, samples):
+        self.unit = unit
+        self.samples = samples
+
+    def is_rate(self):
+        return self.unit.endswith('/s')
+
+    def best(self):
+        if self.is_rate():
+            return max(self.samples)
+        return min(self.samples)
+
+    def median(self):
+        samples = sorted(self.samples)
+        middle = len(samples) / 2
+        if len(samples) % 2:
+            return samples[middle]
+        return (samples[middle - 1] + samples[middle]) / 2.0
+
+    def as_dict(self):
+        return {'unit' : self.unit,
+                'best' : self.best(),
+                'median' : self.median(),
+                'samples' : self.samples}
+
+def measure(function, repeat):
+    '''
+    Calls function repeat times, returning the durations as a Result
+    '''
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        samples.append(time.time() - start)
+    return Result('s', samples)
+
+def write_config(fp, lines):
+    '''
+    Writes a synthetic openssl config file, about lines long
+    '''
+    fp.write('# synthetic config\nHOME = .\nRANDFILE = $ENV::HOME/.rnd\n\n')
+    written = 4
+    section = 0
+    while written < lines:
+        fp.write('[ CA_%d ]\n' % section)
+        fp.write('dir = /var/lib/pki/CA_%d\t# where everything is kept\n' %
+                 section)
+        fp.write('certs = $dir/certs\n')
+        fp.write('database = $dir/index.txt\n')
+        fp.write('    # an indented comment\n')
+        fp.write('new_certs_dir = $dir/newcerts\n')
+        fp.write('default_days = 365\n')
+        fp.write('preserve = no\n')
+        fp.write('nsComment = "a long\n\tcontinued value"\n')
+        fp.write('\n')
+        written = written + 11
+        section = section + 1
+
+def make_requests(count):
+    '''
+    Returns count PEM encoded certificate requests, made with the
+    cryptography package if available, or else the openssl command
+    '''
+    try:
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+    except ImportError:
+        return make_requests_with_openssl(count)
+
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    requests = []
+    for i in range(count):
+        builder = x509.CertificateSigningRequestBuilder()
+        builder = builder.subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COUNTRY_NAME, u'US'),
+            x509.NameAttribute(NameOID.COMMON_NAME, u'host%d' % i)]))
+        request = builder.sign(key, hashes.SHA256(), default_backend())
+        requests.append(request.public_bytes(serialization.Encoding.PEM))
+    return requests
+
+def make_requests_with_openssl(count):
+    binary = os.environ.get('PKITOOL_OPENSSL', 'openssl')
+    workdir = tempfile.mkdtemp()
+    try:
+        key_path = os.path.join(workdir, 'request.key')
+        subprocess.check_call([binary, 'genpkey', '-algorithm', 'EC',
+                               '-pkeyopt', 'ec_paramgen_curve:P-256',
+                               '-out', key_path])
+        requests = []
+        for i in range(count):
+            process = subprocess.Popen([binary, 'req', '-new',
+                                        '-key', key_path,
+                                        '-subj', '/C=US/CN=host%d' % i],
+                                       stdout=subprocess.PIPE)
+            requests.append(process.communicate()[0])
+        return requests
+    finally:
+        shutil.rmtree(workdir, True)
+
+def new_ca(workdir, engine, type='rsa', size=1024):
+    '''
+    Returns a CertificateAuthority, not yet initialized, kept in workdir
+    '''
+    config = OpenSSLConfigParser()
+    config.create_default_config()
+    ca_name = config.get_default_ca()
+    config.set(ca_name, 'dir', workdir)
+    config.set(ca_name, 'default_md', 'sha256')
+    config.set(ca_name, 'default_key_type', type)
+    config.set(ca_name, 'default_key_size', str(size))
+    ca = CertificateAuthority(config, engine=engine)
+    ca.register_callback('get_ca_key_password', lambda: 'benchmark')
+    return ca
+
+def bench_keys(engine, workdir, options):
+    '''
+    Key generation rate, per key type and size
+    '''
+    results = {}
+    for type, size in options.key_types:
+        if type not in engine.key_types:
+            continue
+        samples = []
+        for i in range(options.repeat):
+            count = 0
+            start = time.time()
+            while count == 0 or time.time() - start < options.seconds:
+                engine.create_private_key(os.path.join(workdir, 'key.pem'),
+                                          type, size)
+                count = count + 1
+            samples.append(count / (time.time() - start))
+        results['%s-%d' % (type, size)] = Result('keys/s', samples)
+    return results
+
+def bench_config(engine, workdir, options):
+    '''
+    Config file parse, get (with variable expansion), write and snapshot
+    load times, per config size
+    '''
+    results = {}
+    for lines in options.config_sizes:
+        path = os.path.join(workdir, '%d.cnf' % lines)
+        fp = open(path, 'w')
+        try:
+            write_config(fp, lines)
+        finally:
+            fp.close()
+
+        def read():
+            parser = OpenSSLRawConfigParser()
+            parser.read(path)
+            return parser
+        results['parse-%d' % lines] = measure(read, options.repeat)
+
+        parser = read()
+        def get():
+            for section in parser.sections():
+                for option in parser.options(section):
+                    parser.get(section, option)
+        results['get-%d' % lines] = measure(get, options.repeat)
+
+        def write():
+            fp = open(os.path.join(workdir, 'written.cnf'), 'w')
+            try:
+                parser.write(fp)
+            finally:
+                fp.close()
+        results['write-%d' % lines] = measure(write, options.repeat)
+
+        # the first read_cached() saves the snapshot the others load
+        snapshot_dir = os.path.join(workdir, 'snapshots')
+        def read_cached():
+            OpenSSLRawConfigParser().read_cached(path, snapshot_dir)
+        read_cached()
+        results['snapshot-%d' % lines] = measure(read_cached, options.repeat)
+    return results
+
+def bench_bootstrap(engine, workdir, options):
+    '''
+    create_directory_structure() and init() latency, per CA key type
+    '''
+    results = {}
+    for type, size in options.key_types:
+        if type not in engine.key_types:
+            continue
+        samples = []
+        for i in range(options.repeat):
+            ca = new_ca(os.path.join(workdir, '%s-%d-%d' % (type, size, i)),
+                        engine, type, size)
+            try:
+                start = time.time()
+                ca.create_directory_structure()
+                ca.init()
+                samples.append(time.time() - start)
+            finally:
+                ca.close()
+        results['%s-%d' % (type, size)] = Result('s', samples)
+    return results
+
+def bench_issuance(engine, workdir, options):
+    '''
+    End to end issuance rate (request parsing, policy, signing, writing
+    the certificate and database record), per CA key type
+    '''
+    requests = make_requests(options.requests)
+    results = {}
+    for type, size in options.key_types:
+        if type not in engine.key_types:
+            continue
+        ca = new_ca(os.path.join(workdir, '%s-%d' % (type, size)), engine,
+                    type, size)
+        try:
+            ca.create_directory_structure()
+            ca.init()
+            samples = []
+            for i in range(options.repeat):
+                stats = {}
+                for serial, pem in ca.sign_requests(requests, stats=stats):
+                    pass
+                samples.append(stats['rate'])
+        finally:
+            ca.close()
+        results['%s-%d' % (type, size)] = Result('certs/s', samples)
+    return results
+
+def get_resident_memory():
+    '''
+    Returns the resident memory of this process, in bytes (Linux only)
+    '''
+    fp = open('/proc/self/statm')
+    try:
+        return int(fp.read().split()[1]) * resource.getpagesize()
+    finally:
+        fp.close()
+
+def measure_config_memory(count, compact, path=None):
+    '''
+    Returns the memory taken per section by count CA sections, either
+    created by create_ca() or, if path is given, read from that file
+    '''
+    gc.collect()
+    before = get_resident_memory()
+    if path is None:
+        parser = OpenSSLConfigParser(compact=compact)
+        parser.create_default_config()
+        for i in xrange(count):
+            parser.create_ca('CA_%d' % i, '/var/lib/pki/CA_%d' % i)
+    else:
+        parser = OpenSSLRawConfigParser(compact=compact)
+        parser.read(path)
+    gc.collect()
+    return (get_resident_memory() - before) / float(count)
+
+def run_memory_probe(count, compact, path=None):
+    '''
+    Runs measure_config_memory() in a new process, so that memory freed
+    by earlier measurements does not skew it
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] +
+                                        [p for p in [env.get('PYTHONPATH')]
+                                         if p])
+    code = ('from pkitool.bench import measure_config_memory\n'
+            'print repr(measure_config_memory(%d, %r, %r))' %
+            (count, compact, path))
+    process = subprocess.Popen([sys.executable, '-c', code], env=env,
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('memory probe failed')
+    return float(output)
+
+def bench_memory(engine, workdir, options):
+    '''
+    Memory taken per CA section, with dict and compact section storage,
+    for sections created by create_ca() and read from a config file
+    '''
+    if not os.path.exists('/proc/self/statm'):
+        return {}
+    path = os.path.join(workdir, 'cas.cnf')
+    fp = open(path, 'w')
+    try:
+        write_config(fp, options.sections * 11)
+    finally:
+        fp.close()
+
+    results = {}
+    for source, source_path in (('create', None), ('read', path)):
+        for mode, compact in (('dict', False), ('compact', True)):
+            samples = [run_memory_probe(options.sections, compact,
+                                        source_path)
+                       for i in range(options.repeat)]
+            results['%s-%s' % (source, mode)] = Result('B/section', samples)
+    return results
+
+BENCHMARKS = (('keys', bench_keys),
+              ('config', bench_config),
+              ('memory', bench_memory),
+              ('bootstrap', bench_bootstrap),
+              ('issuance', bench_issuance))
+
+def run_benchmarks(engine, options, names=None, progress=None):
+    '''
+    Runs the named benchmarks (all of them, if names is not given),
+    returning a dict ready to be dumped as JSON
+
+    If given, progress is called as progress(name, results) after each
+    benchmark.
+    '''
+    report = {'time' : int(time.time()),
+              'python' : platform.python_version(),
+              'platform' : platform.platform(),
+              'engine' : engine.__class__.__module__,
+              'repeat' : options.repeat,
+              'results' : {}}
+    for name, function in BENCHMARKS:
+        if names and name not in names:
+            continue
+        workdir = tempfile.mkdtemp(prefix='pkitool-bench-')
+        try:
+            results = function(engine, workdir, options)
+        finally:
+            shutil.rmtree(workdir, True)
+        for key, result in results.items():
+            report['results']['%s/%s' % (name, key)] = result.as_dict()
+        if progress is not None:
+            progress(name, results)
+    return report
+
+def compare_results(old, new):
+    '''
+    Compares two reports made by run_benchmarks(), returning (name, old
+    best, new best, speedup) tuples for the measurements found in both.
+    A speedup above 1.0 means the new run is faster (or, for memory
+    measurements, smaller).
+    '''
+    comparison = []
+    names = [name for name in new['results'] if name in old['results']]
+    names.sort()
+    for name in names:
+        old_best = old['results'][name]['best']
+        new_best = new['results'][name]['best']
+        if not old_best or not new_best:
+            continue
+        if new['results'][name]['unit'].endswith('/s'):
+            speedup = new_best / old_best
+        else:
+            speedup = old_best / new_best
+        comparison.append((name, old_best, new_best, speedup))
+    return comparison
+
+def parse_key_types(option, opt, value, parser):
+    key_types = []
+    for item in value.split(','):
+        if ':' in item:
+            type, size = item.split(':', 1)
+            key_types.append((type, int(size)))
+        elif item in ('ec', 'ed25519'):
+            key_types.append((item, 256))
+        else:
+            key_types.append((item, 1024))
+    setattr(parser.values, option.dest, key_types)
+
+def parse_sizes(option, opt, value, parser):
+    setattr(parser.values, option.dest,
+            [int(size) for size in value.split(',')])
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [benchmark ...]',
+        description='Runs the pkitool benchmarks (%s), writing the results '
+                    'as JSON' % ', '.join([name for name, f in BENCHMARKS]))
+    parser.add_option('-e', '--engine', default=None,
+                      help='engine (backend) to benchmark')
+    parser.add_option('-o', '--output', default=None,
+                      help='write the JSON results to this file, instead '
+                           'of the standard output')
+    parser.add_option('-c', '--compare', default=None, metavar='FILE',
+                      help='compare the results with a previous run')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='samples taken per measurement [%default]')
+    parser.add_option('-s', '--seconds', type='float', default=1.0,
+                      help='time spent per key generation sample '
+                           '[%default]')
+    parser.add_option('-n', '--requests', type='int', default=500,
+                      help='requests signed per issuance sample [%default]')
+    parser.add_option('-k', '--key-types', type='string',
+                      action='callback', callback=parse_key_types,
+                      default=KEY_TYPES, metavar='TYPE:SIZE,...',
+                      help='key types and sizes, such as rsa:2048,ec:384')
+    parser.add_option('-m', '--sections', type='int', default=10000,
+                      help='CA sections per memory sample [%default]')
+    parser.add_option('-l', '--config-sizes', type='string',
+                      action='callback', callback=parse_sizes,
+                      default=CONFIG_SIZES, metavar='LINES,...',
+                      help='config file sizes, in lines')
+    options, names = parser.parse_args(args)
+
+    known = [name for name, function in BENCHMARKS]
+    for name in names:
+        if name not in known:
+            parser.error('unknown benchmark: %s' % name)
+
+    def progress(name, results):
+        keys = results.keys()
+        keys.sort()
+        for key in keys:
+            result = results[key]
+            sys.stderr.write('%-28s %12.4f %s\n' % ('%s/%s' % (name, key),
+                                                    result.best(),
+                                                    result.unit))
+
+    engine = get_engine_class(options.engine)()
+    try:
+        report = run_benchmarks(engine, options, names, progress)
+    finally:
+        engine.close()
+
+    if options.output:
+        fp = open(options.output, 'w')
+    else:
+        fp = sys.stdout
+    try:
+        json.dump(report, fp, indent=1, sort_keys=True)
+        fp.write('\n')
+    finally:
+        if options.output:
+            fp.close()
+
+    if options.compare:
+        fp = open(options.compare)
+        try:
+            old = json.load(fp)
+        finally:
+            fp.close()
+        for name, old_best, new_best, speedup in compare_results(old, report):
+            sys.stderr.write('%-28s %12.4f -> %12.4f  %5.2fx\n' %
+                             (name, old_best, new_best, speedup))
+
+if __name__ == '__main__':
+    main()
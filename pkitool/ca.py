@@ -33,8 +33,13 @@ __all__ = ['CertificateAuthority']
 
 import os
 import sys
+import time
+import shutil
 import optparse
 
+import tracing
+import fileutil
+
 def mkdir_silent_if_isdir(path):
     if os.path.isdir(path):
         return
@@ -49,6 +54,63 @@ class UnknownCallbackException(Exception):
         Exception.__init__(self,
                            'Callback %s is not a known callback' % name)
 
+class PolicyViolationException(Exception):
+    '''
+    A certificate request that does not satisfy the CA match policy
+    '''
+    def __init__(self, field, rule):
+        Exception.__init__(self,
+                           'Field %s does not satisfy the "%s" policy' % \
+                           (field, rule))
+
+class NotRenewableException(Exception):
+    '''
+    A renewal request that matches no valid certificate of the CA
+    '''
+    def __init__(self, subject):
+        Exception.__init__(self,
+                           'No valid certificate of %s has the key of the '
+                           'request' % format_subject(subject))
+
+class UnknownLayoutException(Exception):
+    '''
+    A new certs layout other than those in LAYOUTS
+    '''
+    def __init__(self, layout):
+        Exception.__init__(self,
+                           'New certs layout %s is not a known layout' % \
+                           layout)
+
+class NoBaseCRLException(Exception):
+    '''
+    A delta CRL was requested before any full CRL was issued
+    '''
+    def __init__(self, ca):
+        Exception.__init__(self,
+                           'CA %s has not issued a full CRL yet' % ca)
+
+# the ways certificates may be laid out in the new certs directory, see
+# CertificateAuthority.get_certificate_path()
+LAYOUTS = ('flat', 'sharded')
+
+# distinguished name fields, as named in the config file, in the order
+# they appear in a subject, and their short names
+DN_FIELDS = (('countryName', 'C'),
+             ('stateOrProvinceName', 'ST'),
+             ('localityName', 'L'),
+             ('organizationName', 'O'),
+             ('organizationalUnitName', 'OU'),
+             ('commonName', 'CN'),
+             ('emailAddress', 'emailAddress'))
+
+DN_SHORT_NAMES = dict(DN_FIELDS)
+
+def format_subject(subject):
+    '''
+    Formats a subject as found in the openssl database, as in /C=US/CN=foo
+    '''
+    return ''.join(['/%s=%s' % (field, value) for field, value in subject])
+
 class CertificateAuthority:
     '''
     This represents a instance of a CA
@@ -68,25 +130,51 @@ class CertificateAuthority:
         'get_req_distinguished_name'
         )
 
-    def __init__(self, config, ca=''):
+    # when signing in bulk, commit database records every commit_interval
+    # certificates
+    commit_interval = 256
+
+    def __init__(self, config, ca='', engine=None, key_cache=None):
+        '''
+        engine may be shared by many CAs. If not given, a new instance of
+        the engine named by the CA backend option (or else, the default
+        engine) is created.
+
+        key_cache (a keycache.KeyCache) may also be shared by many CAs. If
+        not given, the CA gets its own.
+        '''
         self.config = config
         if not ca:
             ca = config.get_default_ca()
         self.ca = ca
 
-        try:
-            from backends.pyopenssl import OpenSSLEngine
-        except ImportError:
-            from backends.openssl import OpenSSLEngine
-
-        self.engine = OpenSSLEngine()
+        if engine is None:
+            from backends import get_engine_class
+            engine = get_engine_class(config.get_ca_backend(ca))()
+        self.engine = engine
 
+        if key_cache is None:
+            from keycache import KeyCache
+            key_cache = KeyCache()
+        self.key_cache = key_cache
 
         # callbacks should only be accessed by register_callback_methods*
         # the reason is only to catch some bugs and make things more
         # consistent project-wise
         self.__callbacks = { }
 
+        # (type, size) -> KeyPool, see enable_key_pool()
+        self.__key_pools = { }
+
+        # see get_database()
+        self.__database = None
+
+        # see get_serial_allocator()
+        self.__serial_allocator = None
+
+        # certificate directories known to exist, see
+        # make_certificate_path()
+        self.__certificate_dirs = set()
 
     def register_callback(self, name, function, *args, **kwargs):
         '''
@@ -120,53 +208,631 @@ class CertificateAuthority:
         mkdir_silent_if_isdir(self.config.get_ca_certs(self.ca))
         mkdir_silent_if_isdir(self.config.get_ca_crl_dir(self.ca))
 
-        ca_private_path = self.config.get_ca_private()
+        ca_private_path = self.config.get_ca_private(self.ca)
         mkdir_silent_if_isdir(ca_private_path)
         os.chmod(ca_private_path, 0700)
         
-        # create empty database file
-        open(self.config.get_ca_database(self.ca), 'w')
-
-        mkdir_silent_if_isdir(self.config.get_ca_new_certs_dir(self.ca))
+        # create empty database file, and drop the index built from any
+        # previous one
+        fileutil.write_file(self.config.get_ca_database(self.ca), '')
+        self.close_database()
+        index_db_path = self.config.get_ca_index_db(self.ca)
+        if os.path.exists(index_db_path):
+            os.unlink(index_db_path)
+
+        new_certs_dir = self.config.get_ca_new_certs_dir(self.ca)
+        mkdir_silent_if_isdir(new_certs_dir)
+        if self.get_certificate_layout() == 'sharded':
+            for shard in range(256):
+                mkdir_silent_if_isdir(os.path.join(new_certs_dir,
+                                                   '%02X' % shard))
+            fileutil.fsync_dir(new_certs_dir)
 
         # write '01' into serial
-        serial_file = open(self.config.get_ca_serial(self.ca), 'w')
-        serial_file.write('01\n')
-        serial_file.close()
+        fileutil.write_file(self.config.get_ca_serial(self.ca), '01\n')
+
+        # and into crlnumber
+        fileutil.write_file(self.config.get_ca_crlnumber(self.ca), '01\n')
         
         # no need to do nothing about the other files and directories
 
-    def create_ca_key(self, size=1024):
+    def get_database(self):
+        '''
+        Returns the indexed certificate database of this CA
+
+        The first time it is opened, the database is populated from the
+        openssl database file (index.txt).
+        '''
+        if self.__database is None:
+            from database import CertificateDatabase
+
+            path = self.config.get_ca_index_db(self.ca)
+            is_new = not os.path.exists(path)
+            self.__database = CertificateDatabase(path)
+
+            index_path = self.config.get_ca_database(self.ca)
+            if is_new and os.path.exists(index_path):
+                self.__database.import_index(index_path)
+        return self.__database
+
+    def close(self):
+        '''
+        Releases the resources held by this CA: the database connection
+        and the key pool threads
+        '''
+        self.disable_key_pools()
+        self.close_database()
+        self.key_cache.flush(self.ca)
+
+    def close_database(self):
+        if self.__database is not None:
+            self.__database.close()
+            self.__database = None
+
+    def export_database(self):
+        '''
+        Rewrites the openssl database file (index.txt) from the indexed
+        certificate database, for use by the openssl command line tools
+        '''
+        self.get_database().export_index(self.config.get_ca_database(self.ca))
+
+    def get_serial_allocator(self):
+        '''
+        Returns the object that hands out serial numbers for this CA
+
+        Unless set_serial_allocator() was used, serials come from the CA
+        serial file, reserved in blocks (see serial.SerialAllocator).
+        '''
+        if self.__serial_allocator is None:
+            from serial import SerialAllocator
+            self.__serial_allocator = \
+                SerialAllocator(self.config.get_ca_serial(self.ca))
+        return self.__serial_allocator
+
+    def set_serial_allocator(self, allocator):
+        '''
+        Sets the object that hands out serial numbers for this CA, such as
+        a serial.RandomSerialAllocator. It must have a next() method.
+        '''
+        self.__serial_allocator = allocator
+
+    def get_key_type(self, type=None, size=None):
+        '''
+        Fills in the CA default key type and size (see
+        OpenSSLConfigParser.get_ca_default_key_type()), returning a (type,
+        size) tuple
+        '''
+        if type is None:
+            type = self.config.get_ca_default_key_type(self.ca)
+        if size is None:
+            if type == self.config.get_ca_default_key_type(self.ca):
+                size = self.config.get_ca_default_key_size(self.ca)
+            elif type in ('ec', 'ed25519'):
+                size = 256
+            else:
+                size = 1024
+        return type, size
+
+    def get_key_pool_dir(self, type=None, size=None):
+        '''
+        Returns the directory holding the pre-generated keys of a given
+        type and size
+        '''
+        type, size = self.get_key_type(type, size)
+        return os.path.join(self.config.get_ca_private(self.ca), 'keypool',
+                            '%s-%d' % (type, size))
+
+    def enable_key_pool(self, type=None, size=None, low_water=16,
+                        high_water=64, workers=None, start=True):
+        '''
+        Serves keys of the given type and size (the CA defaults, if not
+        given) from a pool of pre-generated keys, kept under the CA
+        private directory
+
+        Unless start is False, a background thread keeps the pool filled.
+        '''
+        from keypool import KeyPool
+
+        key = type, size = self.get_key_type(type, size)
+        if not self.__key_pools.has_key(key):
+            self.__key_pools[key] = KeyPool(self.engine,
+                                            self.get_key_pool_dir(type, size),
+                                            type, size,
+                                            low_water, high_water, workers)
+        if start:
+            self.__key_pools[key].start()
+        return self.__key_pools[key]
+
+    def disable_key_pools(self):
+        '''
+        Stops all key pool refill threads. Keys already in the pools are
+        kept for later use.
+        '''
+        for pool in self.__key_pools.values():
+            pool.stop()
+        self.__key_pools = { }
+
+    def create_key(self, path, type=None, size=None, password=''):
+        '''
+        Creates a private key at path, of the given type and size or else
+        of the CA defaults
+
+        The key is taken from the matching key pool, if one is enabled and
+        not empty, and only generated on the spot otherwise.
+        '''
+        type, size = self.get_key_type(type, size)
+        pool = self.__key_pools.get((type, size))
+        if pool is not None and pool.take(path, password):
+            tracing.count('keys.pooled', ca=self.ca)
+            return
+        with tracing.span('engine.create_private_key', ca=self.ca,
+                          type=type, size=size):
+            self.engine.create_private_key(path, type, size, password)
+        tracing.count('keys.generated', ca=self.ca)
+
+    def __get_ca_key_password(self):
+        if self.__callbacks.has_key('get_ca_key_password'):
+            func, args, kwargs = self.__callbacks['get_ca_key_password']
+            return func(*args, **kwargs)
+        else:
+            return ''
+
+    def create_ca_key(self, size=None, password=None, type=None):
         '''
         Creates the Certificate Authority keypair
 
         openssl genresa does not look into a config file.So, we have to put
         it into the *right* place, which is defined in the private_key option
         of the chosen CA section.
+
+        Unless password is given, the get_ca_key_password callback is used.
+        The key type and size default to the CA default_key_type and
+        default_key_size options.
         '''
+        if password is None:
+            password = self.__get_ca_key_password()
 
-        if self.__callbacks.has_key('get_ca_key_password'):
-            func, args, kwargs = self.__callbacks['get_ca_key_password']
-            pwd = func(*args, **kwargs)
+        self.key_cache.flush(self.ca)
+        self.create_key(self.config.get_ca_private_key(self.ca),
+                        type=type,
+                        size=size,
+                        password=password)
+
+    def load_ca_key(self, password=None):
+        '''
+        Returns the CA private key, loaded by the engine
+
+        Loaded keys are cached (see keycache.KeyCache), so the key is only
+        read and decrypted again, and the get_ca_key_password callback
+        called, when the cached one has expired or the file has changed.
+        '''
+        path = self.config.get_ca_private_key(self.ca)
+
+        def load():
+            if password is None:
+                key_password = self.__get_ca_key_password()
+            else:
+                key_password = password
+            with tracing.span('engine.load_private_key', ca=self.ca):
+                return self.engine.load_private_key(path, key_password)
+
+        return self.key_cache.get(self.ca, path, load)
+
+    def load_ca_certificate(self):
+        '''
+        Returns the CA certificate, loaded by the engine (and cached as the
+        CA key is)
+        '''
+        path = self.config.get_ca_certificate(self.ca)
+        return self.key_cache.get(self.ca, path,
+                                  lambda: self.engine.load_certificate(path))
+
+    def create_ca_certificate(self, days=None, password=None, parent=None,
+                              parent_password=None):
+        '''
+        Creates the Certificate Authority certificate
+
+        The subject is built from the req distinguished name defaults,
+        updated with the dict returned by the get_req_distinguished_name
+        callback, if any.
+
+        The certificate is self signed, unless parent (another
+        CertificateAuthority, sharing this CA engine) is given, in which
+        case this becomes an intermediate CA, issued by the parent (see
+        issue_ca_certificate()) and parent_password is used for its key.
+
+        The certificate file is written atomically (see fileutil), so it
+        either exists complete or not at all.
+        '''
+        if days is None:
+            days = self.config.get_ca_default_days(self.ca)
+
+        dn = self.config.get_req_dn_defaults()
+        dn.setdefault('commonName', self.ca.strip())
+        if self.__callbacks.has_key('get_req_distinguished_name'):
+            func, args, kwargs = self.__callbacks['get_req_distinguished_name']
+            dn.update(func(*args, **kwargs))
+        subject = [(short, dn[name]) for name, short in DN_FIELDS
+                   if dn.get(name)]
+
+        key = self.load_ca_key(password)
+        if parent is None:
+            with tracing.span('engine.create_self_signed_certificate',
+                              ca=self.ca):
+                cert = self.engine.create_self_signed_certificate(
+                    key, subject, self.get_serial_allocator().next(), days,
+                    self.config.get_ca_default_md(self.ca))
+            with tracing.span('engine.dump_certificate', ca=self.ca):
+                pem = self.engine.dump_certificate(cert)
         else:
-            pwd = ''
+            serial, pem = parent.issue_ca_certificate(key, subject, days,
+                                                      parent_password)
+
+        with tracing.span('file.write', ca=self.ca):
+            fileutil.write_file(self.config.get_ca_certificate(self.ca), pem)
+
+    def issue_ca_certificate(self, key, subject, days=None, password=None):
+        '''
+        Issues an intermediate CA certificate for key (a private key loaded
+        by this CA engine), returning a (serial, certificate) tuple, the
+        certificate being PEM encoded
+
+        Just like end entity certificates, it is saved to the new certs
+        directory and recorded in the CA database.
+        '''
+        from database import CertificateRecord
+
+        if days is None:
+            days = self.config.get_ca_default_days(self.ca)
+
+        serial = self.get_serial_allocator().next()
+        with tracing.span('engine.sign_ca_certificate', ca=self.ca):
+            cert = self.engine.sign_ca_certificate(
+                key, subject, self.load_ca_certificate(),
+                self.load_ca_key(password), serial, days,
+                self.config.get_ca_default_md(self.ca))
+        with tracing.span('engine.dump_certificate', ca=self.ca):
+            pem = self.engine.dump_certificate(cert)
+
+        with tracing.span('file.write', ca=self.ca):
+            fileutil.write_file(self.make_certificate_path(serial), pem)
+        with tracing.span('database.add', ca=self.ca):
+            self.get_database().add(CertificateRecord(
+                serial, 'V', self.engine.get_certificate_not_after(cert),
+                subject=format_subject(subject)))
+        tracing.count('certificates.signed', ca=self.ca)
+        return serial, pem
+
+    def apply_policy(self, subject, ca_subject, policy, preserve=False):
+        '''
+        Checks a request subject against a match policy (see
+        OpenSSLConfigParser.get_ca_policy()), returning the subject to use
+        in the certificate
 
-        if pwd:
-            self.engine.create_private_key(self.config.get_ca_private_key(self.ca),
-                                           size=size,
-                                           password=pwd)
+        Raises PolicyViolationException if the subject is not acceptable.
+        Unless preserve is True, fields not listed in the policy are
+        dropped, and the others are ordered as in the policy.
+        '''
+        values = {}
+        for field, value in subject:
+            values.setdefault(field, value)
+        ca_values = dict(ca_subject)
+
+        issued = []
+        for name, rule in policy:
+            field = DN_SHORT_NAMES.get(name, name)
+            if rule == 'match':
+                if field not in values or values[field] != ca_values.get(field):
+                    raise PolicyViolationException(name, rule)
+            elif rule == 'supplied':
+                if not values.get(field):
+                    raise PolicyViolationException(name, rule)
+            elif rule != 'optional':
+                raise PolicyViolationException(name, rule)
+            issued.extend([i for i in subject if i[0] == field])
+
+        if preserve:
+            return subject
+        return issued
+
+    def find_renewed_certificate(self, buffer):
+        '''
+        Returns the serial of the certificate a PEM encoded renewal request
+        is for: a valid one with the same subject (once the CA policy is
+        applied) and public key, so the request is signed with the key of
+        that certificate
+
+        Raises NotRenewableException if there is none, or the exception
+        that signing the request would raise.
+        '''
+        request = self.engine.load_request(buffer)
+        subject = self.apply_policy(
+            self.engine.get_request_subject(request),
+            self.engine.get_certificate_subject(self.load_ca_certificate()),
+            self.config.get_ca_policy(self.ca),
+            self.config.get_ca_preserve(self.ca))
+        public_key = self.engine.get_request_public_key(request)
+
+        now = time.time()
+        for record in self.get_database().find_by_subject(
+                format_subject(subject), 'V'):
+            if record.expires < now:
+                continue
+            cert = self.engine.load_certificate(
+                self.find_certificate_path(record.serial))
+            if self.engine.get_certificate_public_key(cert) == public_key:
+                return record.serial
+        raise NotRenewableException(subject)
+
+    def get_certificate_layout(self):
+        '''
+        Returns the configured new certs layout, one of LAYOUTS
+        '''
+        layout = self.config.get_ca_new_certs_layout(self.ca)
+        if layout not in LAYOUTS:
+            raise UnknownLayoutException(layout)
+        return layout
+
+    def get_certificate_path(self, serial, layout=None):
+        '''
+        Returns where the certificate with a given serial is kept in a
+        layout (by default, the configured one)
+
+        In the flat layout, certificates sit right in the new certs
+        directory, as <serial>.pem, as openssl keeps them. Directories
+        holding millions of files are slow to look up, back up and list,
+        so the sharded layout spreads certificates over two levels of
+        subdirectories named after the last two bytes of the serial:
+        serial 12ABCD is kept as CD/AB/12ABCD.pem. The last bytes, rather
+        than the first, as serials from the serial file are sequential.
+        '''
+        from database import normalize_serial
+
+        serial = normalize_serial(serial)
+        directory = self.config.get_ca_new_certs_dir(self.ca)
+        if layout is None:
+            layout = self.get_certificate_layout()
+        if layout == 'sharded':
+            digits = serial.rjust(4, '0')
+            directory = os.path.join(directory, digits[-2:], digits[-4:-2])
+        elif layout != 'flat':
+            raise UnknownLayoutException(layout)
+        return os.path.join(directory, '%s.pem' % serial)
+
+    def find_certificate_path(self, serial):
+        '''
+        Returns where the certificate with a given serial is found,
+        looking in the configured layout first and then in the other one,
+        so certificates are found before, during and after a layout
+        migration (see pkitool.layout). If it is found in neither, the
+        path in the configured layout is returned.
+        '''
+        layout = self.get_certificate_layout()
+        path = self.get_certificate_path(serial, layout)
+        other = [name for name in LAYOUTS if name != layout][0]
+        # the configured layout is looked at again, as a certificate may
+        # be moved into it in between (it is linked into place before
+        # being removed from the other layout, so it is always somewhere)
+        for candidate in (path, self.get_certificate_path(serial, other),
+                          path):
+            if os.path.exists(candidate):
+                return candidate
+        return path
+
+    def make_certificate_path(self, serial):
+        '''
+        Returns where a new certificate with a given serial is to be
+        written, in the configured layout, creating its directory if
+        needed
+        '''
+        path = self.get_certificate_path(serial)
+        directory = os.path.dirname(path)
+        if directory not in self.__certificate_dirs:
+            fileutil.make_dirs(directory)
+            self.__certificate_dirs.add(directory)
+        return path
+
+    def remove_certificates(self):
+        '''
+        Removes the new certs directory, with every certificate file (in
+        either layout) in it
+        '''
+        new_certs_dir = self.config.get_ca_new_certs_dir(self.ca)
+        if os.path.isdir(new_certs_dir):
+            shutil.rmtree(new_certs_dir)
+            fileutil.fsync_dir(os.path.dirname(new_certs_dir))
+        self.__certificate_dirs.clear()
+
+    def sign_requests(self, requests, days=None, skip_invalid=False,
+                      stats=None, password=None, rejected=None):
+        '''
+        Signs PEM encoded certificate requests, yielding a (serial,
+        certificate) tuple, the certificate being PEM encoded, for each one
+
+        requests may be any iterable, and is consumed lazily, so requests
+        can be streamed through. The CA key is loaded (and decrypted) at
+        most once per batch, and usually not at all, see load_ca_key().
+        Every certificate is saved to the new certs directory and recorded
+        in the CA database. Both are made durable together, every
+        commit_interval certificates and at the end of the batch, so
+        certificate files only show up at those points.
+
+        Requests that can not be parsed or violate the CA policy raise an
+        exception, unless skip_invalid is True, in which case they are
+        counted and skipped. If given, rejected is then called as
+        rejected(request, exception) for each one skipped.
+
+        If a dict is given as stats, it is kept updated with the number
+        of 'signed' and 'rejected' requests, the 'seconds' spent and the
+        resulting 'rate' in certificates per second.
+        '''
+        from database import CertificateRecord
+
+        if days is None:
+            days = self.config.get_ca_default_days(self.ca)
+        if stats is None:
+            stats = {}
+        stats.update({'signed' : 0, 'rejected' : 0, 'seconds' : 0.0,
+                      'rate' : 0.0})
+
+        start = time.time()
+        digest = self.config.get_ca_default_md(self.ca)
+        policy = self.config.get_ca_policy(self.ca)
+        preserve = self.config.get_ca_preserve(self.ca)
+        key = self.load_ca_key(password)
+        cert = self.load_ca_certificate()
+        ca_subject = self.engine.get_certificate_subject(cert)
+        serials = self.get_serial_allocator()
+        database = self.get_database()
+        batch = fileutil.WriteBatch()
+
+        try:
+            for buffer in requests:
+                try:
+                    with tracing.span('engine.load_request', ca=self.ca):
+                        request = self.engine.load_request(buffer)
+                    subject = self.apply_policy(
+                        self.engine.get_request_subject(request),
+                        ca_subject, policy, preserve)
+                except Exception, e:
+                    tracing.count('requests.rejected', ca=self.ca)
+                    if not skip_invalid:
+                        raise
+                    stats['rejected'] += 1
+                    if rejected is not None:
+                        rejected(buffer, e)
+                    continue
+
+                serial = serials.next()
+                with tracing.span('engine.sign_request', ca=self.ca):
+                    issued = self.engine.sign_request(request, subject, cert,
+                                                      key, serial, days,
+                                                      digest)
+                with tracing.span('engine.dump_certificate', ca=self.ca):
+                    pem = self.engine.dump_certificate(issued)
+
+                with tracing.span('file.write', ca=self.ca):
+                    batch.write_file(self.make_certificate_path(serial),
+                                     pem)
+                with tracing.span('database.add', ca=self.ca):
+                    database.add(CertificateRecord(
+                        serial, 'V',
+                        self.engine.get_certificate_not_after(issued),
+                        subject=format_subject(subject)), commit=False)
+                tracing.count('certificates.signed', ca=self.ca)
+
+                stats['signed'] += 1
+                if stats['signed'] % self.commit_interval == 0:
+                    with tracing.span('database.commit', ca=self.ca):
+                        batch.commit()
+                        database.commit()
+                stats['seconds'] = time.time() - start
+                stats['rate'] = stats['signed'] / stats['seconds']
+
+                yield serial, pem
+        finally:
+            # certificate files first, so that no committed record ever
+            # refers to a missing file
+            batch.commit()
+            database.commit()
+
+    def sign_request(self, request, days=None, password=None):
+        '''
+        Signs a single PEM encoded certificate request, returning the PEM
+        encoded certificate
+        '''
+        signed = list(self.sign_requests([request], days, password=password))
+        return signed[0][1]
+
+    def revoke(self, serial, reason=None, when=None):
+        '''
+        Revokes a certificate
+
+        reason is an openssl reason name, such as 'keyCompromise' or
+        'superseded'. Only the database is updated: the revocation shows
+        up in the next CRL or delta CRL.
+        '''
+        self.get_database().revoke(serial, when, reason)
+
+    def __create_crl(self, path, revoked, next_update, delta_base, password,
+                     sequence):
+        from serial import SerialAllocator
+
+        # crlnumber holds the next number to use, just like serial
+        number = SerialAllocator(self.config.get_ca_crlnumber(self.ca),
+                                 block_size=1).next()
+        now = int(time.time())
+        cert = self.load_ca_certificate()
+        key = self.load_ca_key(password)
+        with tracing.span('engine.create_crl', ca=self.ca,
+                          delta=delta_base is not None):
+            crl = self.engine.create_crl([(long(record.serial, 16),
+                                           record.revoked, record.reason)
+                                          for record in revoked],
+                                         cert, key, number, now, next_update,
+                                         self.config.get_ca_default_md(self.ca),
+                                         delta_base)
+
+        with tracing.span('file.write', ca=self.ca):
+            fileutil.write_file(path, crl)
+
+        self.get_database().add_crl(number, now, delta_base, sequence)
+        return number
+
+    def generate_crl(self, days=None, password=None):
+        '''
+        Issues a full CRL, valid for days (default_crl_days by default),
+        returning its number
+
+        Revoked certificates are kept indexed by revocation time in the CA
+        database, so they are streamed straight from the index.
+        '''
+        if days is None:
+            days = self.config.get_ca_default_crl_days(self.ca)
+        database = self.get_database()
+        # read ahead of the revoked certificates, so that revocations
+        # recorded meanwhile end up in the next delta CRL too
+        sequence = database.get_revocation_sequence()
+        return self.__create_crl(self.config.get_ca_crl(self.ca),
+                                 database.find_revoked(),
+                                 int(time.time()) + days * 24 * 60 * 60,
+                                 None, password, sequence)
+
+    def generate_delta_crl(self, hours=24, password=None):
+        '''
+        Issues a delta CRL (RFC 5280, 5.2.4), listing the certificates
+        revoked since the last full CRL, and returns its number
+
+        Only the certificates whose revocation was recorded since then are
+        read from the database (going by the revocation log, so back dated
+        revocations are not missed), so delta CRLs can be issued often and
+        cheaply, leaving full CRLs to the default_crl_days schedule.
+        '''
+        database = self.get_database()
+        base = database.get_last_base_crl()
+        if base is None:
+            raise NoBaseCRLException(self.ca)
+        base_number, base_time, base_sequence = base
+        sequence = database.get_revocation_sequence()
+        if base_sequence is None:
+            # a base CRL issued before revocations were logged
+            revoked = database.find_revoked(base_time)
         else:
-            self.engine.create_private_key(self.config.get_ca_private_key(self.ca),
-                                           size=size)
+            revoked = database.find_revoked_after(base_sequence)
+        return self.__create_crl(self.config.get_ca_delta_crl(self.ca),
+                                 revoked, int(time.time()) + hours * 60 * 60,
+                                 base_number, password, sequence)
 
     def init(self):
         # First, dump the config file in memory somewhere
 
         self.dumped_config_path = os.path.join(self.config.get_ca_dir(self.ca),
                                                'openssl.cnf')
-        self.config.write(open(self.dumped_config_path, 'w'))
+        self.config.write_file(self.dumped_config_path)
 
-        self.create_ca_key()
+        password = self.__get_ca_key_password()
+        self.create_ca_key(password=password)
+        self.create_ca_certificate(password=password)
 
 
 if __name__ == '__main__':
@@ -33,9 +33,27 @@ __all__ = ['OpenSSLConfigParser']
 import os
 import sys
 import re
+import marshal
+import hashlib
+import threading
 
 from ConfigParser import RawConfigParser, DEFAULTSECT, \
-     NoSectionError, NoOptionError
+     NoSectionError, NoOptionError, InterpolationError, ParsingError
+
+import tracing
+import fileutil
+from sectionstore import CompactSection
+
+# bumped whenever the snapshot layout changes, see save_snapshot()
+SNAPSHOT_VERSION = 2
+
+def get_snapshot_dir():
+    '''
+    Returns where config snapshots are cached: $PKITOOL_CACHE_DIR, or
+    else ~/.cache/pkitool
+    '''
+    return os.environ.get('PKITOOL_CACHE_DIR',
+                          os.path.expanduser('~/.cache/pkitool'))
 
 class OpenSSLRawConfigParser(RawConfigParser):
 
@@ -49,9 +67,31 @@ class OpenSSLRawConfigParser(RawConfigParser):
         r'(?P<value>[^#]*)'
         )
 
-    def __init__(self, defaults=None):
+    # SECTCRE and OPTCRE in a single expression, used by _read()
+    LINECRE = re.compile(
+        r'\[(?P<header>[^]]+)\]'
+        r'|(?P<option>[^:=\s][^:=]*)'
+        r'[:=]'
+        r'(?P<value>[^#]*)'
+        )
+
+    # $var, ${var}, $(var), and the same with section::var
+    VARCRE = re.compile(
+        r'\$(?:\{(?P<braced>[^}]*)\}'
+        r'|\((?P<parenthesized>[^)]*)\)'
+        r'|(?P<name>\w+(?:::\w+)?))'
+        )
+
+    def __init__(self, defaults=None, compact=False):
+        '''
+        If compact is True, sections are kept as sectionstore.CompactSection
+        objects instead of dicts, which takes much less memory when many
+        similar sections (or configs) are loaded.
+        '''
         RawConfigParser.__init__(self, defaults)
 
+        self.__compact = compact
+
         # Protect global_options (may be temporary)
         self.__global_options = {}
 
@@ -59,7 +99,48 @@ class OpenSSLRawConfigParser(RawConfigParser):
         # ca section would be represented as [ ca ] in the config file
         self.__spaces_in_section_names = True
 
+        # raw value -> list of literal strings and (section, name) variable
+        # references, see __compile_value()
+        self.__compiled = {}
+
+        # (section, option) -> expanded value
+        self.__expanded = {}
 
+        # (section, option) -> set of (section, option) whose expanded
+        # value depends on it
+        self.__dependents = {}
+
+        # (section, option) being expanded by each thread, to catch
+        # circular references (see __get_expanding())
+        self.__local = threading.local()
+
+
+
+    def is_compact(self):
+        return self.__compact
+
+    def __new_section(self, section):
+        if self.__compact:
+            return CompactSection(section)
+        return {'__name__': section}
+
+    def add_section(self, section, template=None):
+        '''
+        Adds a section
+
+        Works just as ConfigParser.RawConfigParser.add_section(). In
+        compact mode, if template (a CompactSection) is given, the section
+        starts with its options, sharing their values until changed.
+        '''
+        RawConfigParser.add_section(self, section)
+        if not self.__compact:
+            return
+        if template is None:
+            self._sections[section] = CompactSection(section)
+        else:
+            self._sections[section] = template.clone(section)
+            for option in template:
+                self.__invalidate((section, option))
 
     def optionxform(self, optionstr):
         '''
@@ -70,32 +151,135 @@ class OpenSSLRawConfigParser(RawConfigParser):
         '''
         return optionstr
 
+    def __compile_value(self, value):
+        '''
+        Splits a raw value into literal strings and variable references,
+        which are (section, name) tuples, section being None for plain
+        $name references
+        '''
+        try:
+            return self.__compiled[value]
+        except KeyError:
+            pass
+
+        parts = []
+        pos = 0
+        for mo in self.VARCRE.finditer(value):
+            if mo.start() > pos:
+                parts.append(value[pos:mo.start()])
+            name = mo.group('braced') or mo.group('parenthesized') or \
+                   mo.group('name')
+            if '::' in name:
+                parts.append(tuple(name.split('::', 1)))
+            else:
+                parts.append((None, name))
+            pos = mo.end()
+        if pos < len(value):
+            parts.append(value[pos:])
+
+        self.__compiled[value] = parts
+        return parts
+
+    def __resolve(self, section, reference, dependent):
+        '''
+        Returns the expanded value of a variable reference, recording that
+        dependent depends on it
+        '''
+        ref_section, name = reference
+        if ref_section == 'ENV':
+            # tracked too, so that snapshots leave environment dependent
+            # values out
+            if dependent is not None:
+                self.__dependents.setdefault(('ENV', name),
+                                             set()).add(dependent)
+            return os.environ[name]
+
+        if ref_section is not None:
+            candidates = (ref_section,)
+        elif section:
+            # openssl looks into the current section, then into the
+            # global (default) one
+            candidates = (section, '')
+        else:
+            candidates = ('',)
+
+        for candidate in candidates:
+            if dependent is not None:
+                self.__dependents.setdefault((candidate, name),
+                                             set()).add(dependent)
+            if self.__has_raw_option(candidate, name):
+                return self.get(candidate, name)
+        raise NoOptionError(name, section or 'global')
+
+    def __has_raw_option(self, section, option):
+        if not section:
+            return option in self.__global_options
+        sectdict = self._sections.get(section)
+        return sectdict is not None and option in sectdict
+
     def parse_value(self, section, value):
         '''
         Parse a openssl configuration variable
 
-        This is a very simplistic (lame?) implementation, that only deals
-        with the very simple cases found in the stock openssl config file.
+        Expands $var, ${var} and $(var) references (looked up in the
+        given section, and then in the global options), $section::var
+        references and $ENV::var environment variables. Referenced values
+        are expanded themselves.
         '''
-        if value.startswith('$'):
-            slash_pos = value.find('/')
-            if  slash_pos > 0:
-                var_to_parse = value[1:slash_pos]
-                if var_to_parse.startswith('ENV::'):
-                    environ_var_name = var_to_parse[5:]
-                    environ_var_value = os.environ[environ_var_name]
-
-                    len_environ_var_name = len(environ_var_name)
+        return self.__expand(section, value, None)
 
-                    return environ_var_value + value[6+len_environ_var_name:]
-                else:
-                    var_value = self.get(section, var_to_parse, False)
-                    len_var_name = len(var_to_parse)
+    def __get_expanding(self):
+        '''
+        Returns the keys being expanded by the current thread. Threads
+        may well expand the same key at once, which is no circular
+        reference.
+        '''
+        try:
+            return self.__local.expanding
+        except AttributeError:
+            self.__local.expanding = {}
+            return self.__local.expanding
 
-                    return var_value + value[1+len_var_name:]
-        else:
+    def __expand(self, section, value, key):
+        if '$' not in value:
             return value
 
+        expanding = self.__get_expanding()
+        if key is not None:
+            if key in expanding:
+                raise InterpolationError(key[1], section or 'global',
+                                         'circular variable reference')
+            expanding[key] = True
+        try:
+            parts = []
+            for part in self.__compile_value(value):
+                if isinstance(part, tuple):
+                    part = self.__resolve(section, part, key)
+                parts.append(part)
+        finally:
+            if key is not None:
+                del expanding[key]
+        return ''.join(parts)
+
+    def __invalidate(self, key):
+        '''
+        Drops the expanded value of key, and of everything depending on it
+        '''
+        self.__expanded.pop(key, None)
+        for dependent in self.__dependents.pop(key, ()):
+            self.__invalidate(dependent)
+
+    def clear_cache(self):
+        '''
+        Drops all expanded values
+
+        Values are expanded once and then cached until they (or a value
+        they depend on) are changed by set(). $ENV::var references are
+        not tracked, so this must be called if the environment changes.
+        '''
+        self.__expanded.clear()
+        self.__dependents.clear()
+
     def get(self, section, option, parse=True):
         '''
         Retrieve a option value
@@ -109,13 +293,15 @@ class OpenSSLRawConfigParser(RawConfigParser):
         '''
         opt = self.optionxform(option)
 
+        if parse:
+            try:
+                return self.__expanded[(section, opt)]
+            except KeyError:
+                pass
+
         if not section:
             if opt in self.__global_options:
                 value = self.__global_options[opt]
-                if not parse:
-                    return value
-                else:
-                    return self.parse_value(section, value)
             else:
                 raise NoOptionError(option, 'global')
 
@@ -123,24 +309,26 @@ class OpenSSLRawConfigParser(RawConfigParser):
             if section != DEFAULTSECT:
                 raise NoSectionError(section)
             if opt in self._defaults:
-                if not parse:
-                    return self._defaults[opt]
-                else:
-                    return self.parse_value(section, self._defaults[option])
+                value = self._defaults[opt]
             else:
                 raise NoOptionError(option, section)
             
         elif opt in self._sections[section]:
-            if not parse:
-                return self._sections[section][opt]
-            else:
-                return self.parse_value(section, self._sections[section][opt])
+            value = self._sections[section][opt]
         
         elif opt in self._defaults:
             return self._defaults[opt]
         else:
             raise NoOptionError(option, section)
 
+        if not parse:
+            return value
+        key = (section, opt)
+        with tracing.span('config.expand', section=section, option=opt):
+            value = self.__expand(section, value, key)
+        self.__expanded[key] = value
+        return value
+
 
     def set(self, section, option, value):
         '''
@@ -157,133 +345,397 @@ class OpenSSLRawConfigParser(RawConfigParser):
                 sectdict = self._sections[section]
             except KeyError:
                 raise NoSectionError(section)
-        sectdict[self.optionxform(option)] = value
+        option = self.optionxform(option)
+        sectdict[option] = value
+        self.__invalidate((section, option))
 
+    def remove_option(self, section, option):
+        if not section:
+            option = self.optionxform(option)
+            existed = option in self.__global_options
+            if existed:
+                del self.__global_options[option]
+        else:
+            existed = RawConfigParser.remove_option(self, section, option)
+        self.__invalidate((section, self.optionxform(option)))
+        return existed
+
+    def remove_section(self, section):
+        existed = RawConfigParser.remove_section(self, section)
+        for key in self.__expanded.keys() + self.__dependents.keys():
+            if key[0] == section:
+                self.__invalidate(key)
+        return existed
+
+    @tracing.traced('config.read')
     def _read(self, fp, fpname):
+        '''
+        Parses a config file
+
+        The whole file is read at once and scanned in a single pass. Most
+        lines are classified by their first character, leaving a single
+        regular expression match for section headers and options.
+        '''
+        self.clear_cache()
+        sections = self._sections
+        global_options = self.__global_options
+        linematch = self.LINECRE.match
         cursect = None                            # None, or a dictionary
         optname = None
-        lineno = 0
         e = None                                  # None, or an exception
-        while True:
-            line = fp.readline()
-            if not line:
-                break
+        lineno = 0
+        for line in fp.read().split('\n'):
             lineno = lineno + 1
-            # comment or blank line?
-            if line.strip() == '' or line[0] in '#;':
+            if not line:
                 continue
-            if self.COMMENTCRE.match(line):
+            first = line[0]
+            # comment line?
+            if first in '#;':
                 continue
-            # continuation line?
-            if line[0].isspace() and cursect is not None and optname:
+            if first in ' \t\r\f\v':
                 value = line.strip()
-                if value:
+                # blank or comment line?
+                if not value or value[0] == '#':
+                    continue
+                # continuation line?
+                if cursect is not None and optname:
                     cursect[optname] = "%s\n%s" % (cursect[optname], value)
-            # a section header or option header?
+                    continue
+            mo = linematch(line)
+            if mo is None:
+                # a non-fatal parsing error occurred.  set up the
+                # exception but keep going. the exception will be
+                # raised at the end of the file and will contain a
+                # list of all bogus lines
+                if not e:
+                    e = ParsingError(fpname)
+                e.append(lineno, repr(line))
+                continue
+            sectname, optname, optval = mo.groups()
+            # a section header?
+            if sectname is not None:
+                # internally, the sections names are always stripped of spaces
+                # you can control how this is written to a file with
+                # __spaces_in_section_names 
+                sectname = sectname.strip()
+                if sectname in sections:
+                    cursect = sections[sectname]
+                else:
+                    cursect = self.__new_section(sectname)
+                    sections[sectname] = cursect
+                # So sections can't start with a continuation line
+                optname = None
+            # an option line
             else:
-                # is it a section header?
-                mo = self.SECTCRE.match(line)
-                if mo:
-                    sectname = mo.group('header')
-                    # internally, the sections names are always stripped of spaces
-                    # you can control how this is written to a file with
-                    # __spaces_in_section_names 
-                    sectname = sectname.strip()
-                    if sectname in self._sections:
-                        cursect = self._sections[sectname]
-                    else:
-                        cursect = {'__name__': sectname}
-                        self._sections[sectname] = cursect
-                    # So sections can't start with a continuation line
-                    optname = None
-                # an option line?
+                optname = optname.strip()
+                optval = optval.strip()
+                # allow empty values
+                if optval == '""':
+                    optval = ''
+                # treat global options
+                if cursect is None:
+                    global_options[optname] = optval
                 else:
-                    mo = self.OPTCRE.match(line)
-                    if mo:
-                        optname, optval = mo.group('option', 'value')
-                        optname = optname.strip()
-                        optval = optval.strip()
-                        # allow empty values
-                        if optval == '""':
-                            optval = ''
-                        # treat global options
-                        if cursect == None:
-                            self.__global_options[optname] = optval
-                        else:
-                            cursect[optname] = optval
-                    else:
-                        # a non-fatal parsing error occurred.  set up the
-                        # exception but keep going. the exception will be
-                        # raised at the end of the file and will contain a
-                        # list of all bogus lines
-                        if not e:
-                            e = ParsingError(fpname)
-                        e.append(lineno, repr(line))
+                    cursect[optname] = optval
         # if any parsing errors occurred, raise an exception
         if e:
             raise e
 
-    def __value_needs_evalution(self, value):
+    def __get_references(self, options):
         '''
-        Whether a given value needs evaluation
+        Returns a dict mapping the names of the options (of a section, or
+        the global ones) that reference variables to their (section, name)
+        references
         '''
-        if value[0] != '$':
-            return False
-        return True
+        references = {}
+        compile = self.__compile_value
+        for name, value in options.iteritems():
+            if isinstance(value, str):
+                if '$' not in value:
+                    continue
+            else:
+                value = str(value)
+            refs = [part for part in compile(value) if isinstance(part, tuple)]
+            if refs:
+                references[name] = refs
+        return references
+
+    def __plan_options(self, section, options, references):
+        '''
+        Orders the options of a section (the global options, if section
+        is '') so that every option comes after the options of the same
+        section it references, keeping the original order otherwise
+        '''
+        planned = []
+        visited = {}
+
+        def visit(name):
+            # marked before visiting the references, so that circular
+            # references do not loop
+            visited[name] = True
+            for ref_section, ref_name in references.get(name, ()):
+                if ref_section is None or ref_section == section:
+                    if ref_name in options and ref_name not in visited:
+                        visit(ref_name)
+            planned.append(name)
+
+        for name in options:
+            if name not in visited and name != '__name__':
+                if name in references:
+                    visit(name)
+                else:
+                    visited[name] = True
+                    planned.append(name)
+        return planned
 
-    def __option_needs_evaluation(self, section, option):
+    def __plan_sections(self, references):
         '''
-        Whether a given option value needs evalution
+        Orders the sections so that every section comes after the
+        sections it references (as in $section::var), keeping the original
+        order otherwise
         '''
-        return self.__value_needs_evalution(self.get(section, option, False))
+        planned = []
+        visited = {}
+
+        def visit(section):
+            visited[section] = True
+            for refs in references[section].itervalues():
+                for ref_section, ref_name in refs:
+                    if ref_section not in (None, section) and \
+                       ref_section in self._sections and \
+                       ref_section not in visited:
+                        visit(ref_section)
+            planned.append(section)
 
+        for section in self._sections:
+            if section not in visited:
+                visit(section)
+        return planned
+
+    def __format_options(self, lines, section, options, references):
+        for name in self.__plan_options(section, options, references):
+            lines.append('%s = %s\n' % (name,
+                                        str(options[name]).replace('\n',
+                                                                  '\n\t')))
+
+    @tracing.traced('config.write')
     def write(self, fp):
         '''
         Writes a text representation of the configuration into fp
 
-        Lines that define options that are 'parseable', such as 'dir'
-        have to come first. The openssl parser reads the file sequentially and
-        expects to have these values defined prior to use.
-        
+        The openssl parser reads the file sequentially, and expects
+        variables to be defined prior to use. So options are written after
+        the options they reference ($var), and sections after the sections
+        they reference ($section::var).
+
+        The text is built in memory and written with a single call.
         '''
+        lines = []
         if self.__global_options:
-            for (key, value) in self.__global_options.items():
-                fp.write("%s = %s\n" % (key, str(value).replace('\n', '\n\t')))
-            fp.write("\n")
-        for section in self._sections:
+            self.__format_options(lines, '', self.__global_options,
+                                  self.__get_references(self.__global_options))
+            lines.append('\n')
 
-            if self.__spaces_in_section_names:
-                section_fmt = "[ %s ]\n"
-            else:
-                section_fmt = "[%s]\n"
-            
-            fp.write(section_fmt % section)
+        references = {}
+        for section, options in self._sections.iteritems():
+            references[section] = self.__get_references(options)
+
+        if self.__spaces_in_section_names:
+            section_fmt = '[ %s ]\n'
+        else:
+            section_fmt = '[%s]\n'
+        for section in self.__plan_sections(references):
+            lines.append(section_fmt % section)
+            self.__format_options(lines, section, self._sections[section],
+                                  references[section])
+            lines.append('\n')
+
+        fp.write(''.join(lines))
+
+    def write_file(self, path, mode=0644):
+        '''
+        Writes the configuration to path atomically
 
-            need_eval = [opt for opt in self._sections[section].keys() \
-                         if self.__option_needs_evaluation(section, opt)]
+        The configuration is written to a temporary file in the same
+        directory, flushed to disk and then renamed over path, so readers
+        see either the old or the new file, never a partial one.
+        '''
+        fp = fileutil.AtomicFile(path, mode)
+        try:
+            self.write(fp)
+        except:
+            fp.abort()
+            raise
+        fp.commit()
 
-            for (key, value) in self._sections[section].items():
-                # First, skip options that need eval
-                if key in need_eval:
+    def __get_environment_dependents(self):
+        '''
+        Returns the keys whose expanded value depends, directly or not, on
+        an environment variable
+        '''
+        found = {}
+        pending = [key for key in self.__dependents if key[0] == 'ENV']
+        while pending:
+            for dependent in self.__dependents.get(pending.pop(), ()):
+                if dependent not in found:
+                    found[dependent] = True
+                    pending.append(dependent)
+        return found
+
+    def expand_all(self):
+        '''
+        Expands (and caches) every option value. Values that can not be
+        expanded, such as those referencing missing variables, are skipped
+        '''
+        for section in [''] + self._sections.keys():
+            if section:
+                options = self._sections[section]
+            else:
+                options = self.__global_options
+            for option in options.keys():
+                if option == '__name__':
                     continue
-                else:
-                    if key != "__name__":
-                        fp.write("%s = %s\n" %
-                                 (key, str(value).replace('\n', '\n\t')))
+                try:
+                    self.get(section, option)
+                except (KeyError, NoSectionError, NoOptionError,
+                        InterpolationError):
+                    pass
+
+    def save_snapshot(self, path, source=None):
+        '''
+        Saves the parsed configuration to path, as a marshal snapshot to be
+        loaded by load_snapshot()
+
+        Besides the sections and global options, the snapshot holds every
+        expanded value (but the ones depending on environment variables),
+        so that a loaded config needs no parsing or expansion at all. If
+        source is given, it is the path of the config file the snapshot
+        is valid for, as long as its modification time and size do not
+        change.
+        '''
+        self.expand_all()
+        volatile = self.__get_environment_dependents()
+        expanded = dict([(key, value)
+                         for key, value in self.__expanded.iteritems()
+                         if key not in volatile])
+        dependents = dict([(key, set(value))
+                           for key, value in self.__dependents.iteritems()
+                           if key[0] != 'ENV'])
+        if source is not None:
+            st = os.stat(source)
+            source = (os.path.abspath(source), st.st_mtime, st.st_size)
+
+        snapshot = marshal.dumps((SNAPSHOT_VERSION, sys.version_info[:2],
+                                  source,
+                                  dict(self.__global_options),
+                                  dict(self._defaults),
+                                  [(section, list(options.iteritems())) for
+                                   section, options in self._sections.items()],
+                                  expanded,
+                                  dependents))
+
+        # a snapshot is only a cache: it must not be seen half written,
+        # but need not be flushed to disk
+        fp = fileutil.AtomicFile(path, sync=False)
+        try:
+            fp.write(snapshot)
+        except:
+            fp.abort()
+            raise
+        fp.commit()
+
+    def load_snapshot(self, path, source=None):
+        '''
+        Loads a snapshot saved by save_snapshot(), replacing the current
+        configuration, and returns True
+
+        Returns False, leaving the configuration untouched, if there is no
+        usable snapshot at path: if it is missing, damaged, was saved by
+        another version of pkitool or Python, or (when source is given)
+        if it was not saved for the current version of the source file.
+        '''
+        try:
+            fp = open(path, 'rb')
+            try:
+                snapshot = marshal.loads(fp.read())
+            finally:
+                fp.close()
+            (version, python, snapshot_source, global_options, defaults,
+             sections, expanded, dependents) = snapshot
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if version != SNAPSHOT_VERSION or python != sys.version_info[:2]:
+            return False
+        if source is not None:
+            try:
+                st = os.stat(source)
+            except OSError:
+                return False
+            if snapshot_source != (os.path.abspath(source), st.st_mtime,
+                                   st.st_size):
+                return False
+
+        self.__global_options = global_options
+        self._defaults = defaults
+        self._sections = self._dict()
+        for section, options in sections:
+            if self.__compact:
+                sectdict = CompactSection(section)
+            else:
+                sectdict = {}
+            for option, value in options:
+                if option != '__name__' or not self.__compact:
+                    sectdict[option] = value
+            self._sections[section] = sectdict
+        self.__expanded = expanded
+        self.__dependents = dependents
+        self.__local = threading.local()
+        return True
 
-            # Write skiped keys (the ones that need eval)
-            for key in need_eval:
-                fp.write("%s = %s\n" %
-                         (key, str(self._sections[section][key]).replace('\n', '\n\t')))
-                
-            fp.write("\n")
+    def read_cached(self, path, snapshot_dir=None):
+        '''
+        Reads a config file through a snapshot cache
 
+        The snapshot of path, kept in snapshot_dir (see
+        get_snapshot_dir()), is loaded if it is up to date. Otherwise the
+        file is parsed and a new snapshot is saved, failures to save it
+        being ignored. Returns True if the snapshot was used.
+        '''
+        if snapshot_dir is None:
+            snapshot_dir = get_snapshot_dir()
+        name = hashlib.sha1(os.path.abspath(path)).hexdigest()
+        snapshot_path = os.path.join(snapshot_dir, name + '.snapshot')
+        with tracing.span('config.load_snapshot'):
+            if self.load_snapshot(snapshot_path, path):
+                return True
+
+        st = os.stat(path)
+        fp = open(path)
+        try:
+            self._read(fp, path)
+        finally:
+            fp.close()
+        # a file changed while being read gets no snapshot
+        after = os.stat(path)
+        if (st.st_mtime, st.st_size) != (after.st_mtime, after.st_size):
+            return False
+        try:
+            if not os.path.isdir(snapshot_dir):
+                os.makedirs(snapshot_dir, 0700)
+            self.save_snapshot(snapshot_path, path)
+        except (IOError, OSError):
+            pass
+        return False
 
 
 class OpenSSLConfigParser(OpenSSLRawConfigParser):
 
-    def __init__(self):
-        OpenSSLRawConfigParser.__init__(self)
+    def __init__(self, compact=False):
+        OpenSSLRawConfigParser.__init__(self, compact=compact)
+
+        # in compact mode, the section new CAs are copied from, see
+        # create_ca()
+        self.__ca_template = None
 
     def create_default_config(self, rootdir=None):
         '''
@@ -331,8 +783,9 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
         by openssl.
         '''
         
-        # [ca_name]
-        self.add_section(ca_name)
+        # [ca_name]. In compact mode, CA sections start as copies of the
+        # first one, so only the values specific to each CA take memory
+        self.add_section(ca_name, self.__ca_template)
         
         # dir = /path/to/ca
         self.set(ca_name, 'dir', ca_dir)
@@ -360,6 +813,9 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
 
         self.set(ca_name, 'policy_match', 'policy_anything')
 
+        if self.is_compact() and self.__ca_template is None:
+            self.__ca_template = self._sections[ca_name].clone(None)
+
     def create_policy(self, policy_name, **overrides):
         '''
         Creates a match policy
@@ -371,7 +827,7 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
 
         valid_values = ('optional', 'match', 'supplied')
 
-        defaults = {'country_name' : 'optional',
+        defaults = {'countryName' : 'optional',
                     'stateOrProvinceName' : 'optional',
                     'localityName' : 'optional',
                     'organizationName' : 'optional',
@@ -384,9 +840,14 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
                 if value in valid_values:
                     defaults[key] = value
 
+        # openssl orders the subject fields as in the policy
+        order = ('countryName', 'stateOrProvinceName', 'localityName',
+                 'organizationName', 'organizationalUnitName', 'commonName',
+                 'emailAddress')
+
         self.add_section(policy_name)
-        for key, value in defaults.items():
-            self.set(policy_name, key, value)
+        for key in order:
+            self.set(policy_name, key, defaults[key])
 
     def create_req(self):
         section_name = 'req'
@@ -411,8 +872,19 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
 
 
     def get_default_ca(self):
+        # section names read back from a file lose their spaces
+        if not self.has_section(' ca ') and self.has_section('ca'):
+            return self.get('ca', 'default_ca')
         return self.get(' ca ', 'default_ca')
 
+    def get_cas(self):
+        '''
+        Returns the names of all CA sections, that is, sections defining
+        at least a database and a private key
+        '''
+        return [name for name, options in self._sections.items()
+                if 'database' in options and 'private_key' in options]
+
     def get_default_ca_dir(self):
         return self.get_ca_dir(self.get_default_ca())
 
@@ -454,6 +926,13 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
             ca = self.get_default_ca()
         return self.get(ca, 'database')
 
+    def get_ca_index_db(self, ca=''):
+        '''
+        Returns the path of the indexed (SQLite) certificate database,
+        which sits next to the openssl database file
+        '''
+        return os.path.splitext(self.get_ca_database(ca))[0] + '.db'
+
     def get_ca_new_certs_dir(self, ca=''):
         '''
         Returns the dfault place for new certs issued by a CA.
@@ -465,6 +944,19 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
             ca = self.get_default_ca()
         return self.get(ca, 'new_certs_dir')
 
+    def get_ca_new_certs_layout(self, ca=''):
+        '''
+        Returns how certificates are laid out in the new certs directory:
+        'flat' (the default, as openssl does) or 'sharded' (see
+        pkitool.ca.CertificateAuthority.get_certificate_path())
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return self.get(ca, 'new_certs_layout')
+        except NoOptionError:
+            return 'flat'
+
     def get_ca_certificate(self, ca=''):
         '''
         Returns ...
@@ -497,6 +989,18 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
             ca = self.get_default_ca()
         return self.get(ca, 'crl')
 
+    def get_ca_delta_crl(self, ca=''):
+        '''
+        Returns where the delta CRL of a CA is written: the delta_crl
+        option if set, or else a file next to the CRL
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return self.get(ca, 'delta_crl')
+        except NoOptionError:
+            return os.path.splitext(self.get_ca_crl(ca))[0] + '-delta.crl'
+
     def get_ca_private_key(self, ca=''):
         '''
         Returns ...
@@ -511,6 +1015,114 @@ class OpenSSLConfigParser(OpenSSLRawConfigParser):
         '''
         return os.path.dirname(self.get_ca_private_key(ca))
 
+    def get_ca_default_days(self, ca=''):
+        '''
+        Returns how many days certificates issued by a CA are valid for
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        return int(self.get(ca, 'default_days'))
+
+    def get_ca_default_crl_days(self, ca=''):
+        '''
+        Returns how many days until the next CRL is due
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        return int(self.get(ca, 'default_crl_days'))
+
+    def get_ca_default_md(self, ca=''):
+        '''
+        Returns the message digest used to sign certificates
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        return self.get(ca, 'default_md')
+
+    def get_ca_backend(self, ca=''):
+        '''
+        Returns the name of the engine a CA should use (see
+        pkitool.backends.get_engine_class()), or None for the default one
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return self.get(ca, 'backend')
+        except NoOptionError:
+            return None
+
+    def get_ca_default_key_type(self, ca=''):
+        '''
+        Returns the type of the keys created for a CA: 'rsa' (the
+        default), 'dsa', 'ec' or 'ed25519'
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return self.get(ca, 'default_key_type')
+        except NoOptionError:
+            return 'rsa'
+
+    def get_ca_default_key_size(self, ca=''):
+        '''
+        Returns the size of the keys created for a CA, in bits. For EC
+        keys, this selects the curve (256 for P-256, 384 for P-384).
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return int(self.get(ca, 'default_key_size'))
+        except NoOptionError:
+            if self.get_ca_default_key_type(ca) in ('ec', 'ed25519'):
+                return 256
+            return 1024
+
+    def get_ca_preserve(self, ca=''):
+        '''
+        Returns whether the subject order and fields of a request should be
+        kept as is when issuing a certificate
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            return self.get(ca, 'preserve').lower() == 'yes'
+        except NoOptionError:
+            return False
+
+    def get_ca_policy(self, ca=''):
+        '''
+        Returns the match policy of a CA as a list of (field, rule) tuples,
+        rule being one of 'optional', 'match' or 'supplied'
+
+        openssl names the option "policy", pkitool writes "policy_match".
+        Both are understood.
+        '''
+        if not ca:
+            ca = self.get_default_ca()
+        try:
+            policy = self.get(ca, 'policy')
+        except NoOptionError:
+            policy = self.get(ca, 'policy_match')
+        return self.items(policy)
+
+    def get_req_dn_defaults(self):
+        '''
+        Returns the default distinguished name values, from the section
+        pointed by the distinguished_name option of the req section, as
+        a dict (with keys such as 'countryName')
+        '''
+        dn_section = self.get('req', 'distinguished_name')
+        defaults = {}
+        for key, value in self.items(dn_section):
+            if not key.endswith('_default'):
+                continue
+            key = key[:-len('_default')]
+            # openssl allows multiple fields as in 0.organizationName
+            if '.' in key:
+                key = key.split('.', 1)[1]
+            defaults[key] = value
+        return defaults
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,565 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+database.py
+
+    
+"""
+
+__all__ = ['CertificateDatabase', 'CertificateRecord']
+
+import time
+import hashlib
+import calendar
+import sqlite3
+import threading
+
+import fileutil
+
+def parse_time(text):
+    '''
+    Converts an openssl index.txt date (UTCTime or GeneralizedTime, as in
+    '301231235959Z') to seconds since the epoch
+    '''
+    # time.strptime() is far too slow for bulk imports
+    if len(text) == 13:
+        year = int(text[:2])
+        if year < 50:
+            year = year + 2000
+        else:
+            year = year + 1900
+        text = text[2:]
+    else:
+        year = int(text[:4])
+        text = text[4:]
+    return calendar.timegm((year, int(text[0:2]), int(text[2:4]),
+                            int(text[4:6]), int(text[6:8]), int(text[8:10])))
+
+def format_time(seconds):
+    '''
+    Converts seconds since the epoch to the date format used by openssl
+    '''
+    text = time.strftime('%Y%m%d%H%M%SZ', time.gmtime(seconds))
+    if 1950 <= int(text[:4]) < 2050:
+        return text[2:]
+    return text
+
+def normalize_serial(serial):
+    '''
+    Returns a serial number (an integer or an hex string) in the format
+    used by openssl: upper case hex with an even number of digits
+    '''
+    if isinstance(serial, basestring):
+        serial = long(serial, 16)
+    text = '%X' % serial
+    if len(text) % 2:
+        text = '0' + text
+    return text
+
+def subject_hash(subject):
+    '''
+    A short digest of a subject, used to index subjects
+    '''
+    return hashlib.sha1(subject).hexdigest()[:16]
+
+class CertificateRecord(object):
+    '''
+    One certificate entry, as found in a line of index.txt
+
+    expires and revoked are seconds since the epoch, revoked being None
+    for certificates that have not been revoked.
+    '''
+
+    __slots__ = ('serial', 'status', 'expires', 'revoked', 'reason',
+                 'filename', 'subject')
+
+    def __init__(self, serial, status, expires, revoked=None, reason=None,
+                 filename='unknown', subject=''):
+        self.serial = normalize_serial(serial)
+        self.status = status
+        self.expires = expires
+        self.revoked = revoked
+        self.reason = reason
+        self.filename = filename
+        self.subject = subject
+
+    def __repr__(self):
+        return '<CertificateRecord %s %s %s>' % (self.serial, self.status,
+                                                 self.subject)
+
+    def from_index_line(cls, line):
+        '''
+        Builds a record from a line of an openssl index.txt file
+        '''
+        status, expires, revocation, serial, filename, subject = \
+                line.rstrip('\n').split('\t', 5)
+        revoked = reason = None
+        if revocation:
+            if ',' in revocation:
+                revocation, reason = revocation.split(',', 1)
+            revoked = parse_time(revocation)
+        return cls(serial, status, parse_time(expires), revoked, reason,
+                   filename, subject)
+    from_index_line = classmethod(from_index_line)
+
+    def to_index_line(self):
+        '''
+        Returns the openssl index.txt line for this record
+        '''
+        revocation = ''
+        if self.revoked is not None:
+            revocation = format_time(self.revoked)
+            if self.reason:
+                revocation = '%s,%s' % (revocation, self.reason)
+        return '\t'.join((self.status, format_time(self.expires), revocation,
+                          self.serial, self.filename, self.subject)) + '\n'
+
+    def as_row(self):
+        return (self.serial, self.status, self.expires, self.revoked,
+                self.reason, self.filename, self.subject,
+                subject_hash(self.subject))
+
+class CertificateDatabase:
+    '''
+    An indexed store of the certificates issued by a CA
+
+    Records live in a SQLite database, indexed by serial, subject and
+    expiry date, so lookups do not need to scan the whole index. The
+    openssl index.txt file can be bulk imported, and is exported (one way)
+    for compatibility with the openssl command line tools.
+
+    A database may be shared by threads.
+    '''
+
+    COLUMNS = 'serial, status, expires, revoked, reason, filename, subject'
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS certificates ('
+        ' serial TEXT PRIMARY KEY,'
+        ' status TEXT NOT NULL,'
+        ' expires INTEGER NOT NULL,'
+        ' revoked INTEGER,'
+        ' reason TEXT,'
+        ' filename TEXT NOT NULL,'
+        ' subject TEXT NOT NULL,'
+        ' subject_hash TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS crls ('
+        ' number INTEGER PRIMARY KEY,'
+        ' base INTEGER,'
+        ' this_update INTEGER NOT NULL,'
+        ' sequence INTEGER)',
+        # every revocation recorded, in order, whatever its revocation
+        # time (see find_revoked_after())
+        'CREATE TABLE IF NOT EXISTS revocations ('
+        ' sequence INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' serial TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS renewals ('
+        ' serial TEXT PRIMARY KEY,'
+        ' renewed_by TEXT NOT NULL,'
+        ' renewed INTEGER NOT NULL)',
+        )
+
+    # index name -> indexed column
+    INDEXES = {'certificates_subject_hash' : 'subject_hash',
+               'certificates_expires' : 'expires',
+               'certificates_revoked' : 'revoked'}
+
+    # rows fetched at a time when iterating over query results
+    fetch_size = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.RLock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.text_factory = str
+        # with write ahead logging, a commit takes a single flush to disk
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        for statement in self.SCHEMA:
+            self.__db.execute(statement)
+        self.__upgrade()
+        self.__create_indexes()
+        self.__db.commit()
+
+    def __upgrade(self):
+        '''
+        Adds the columns missing from databases created by older versions
+        '''
+        columns = [row[1] for row in
+                   self.__db.execute('PRAGMA table_info(crls)')]
+        if 'sequence' not in columns:
+            self.__db.execute('ALTER TABLE crls ADD COLUMN sequence INTEGER')
+
+    def __create_indexes(self):
+        for name, column in self.INDEXES.items():
+            self.__db.execute('CREATE INDEX IF NOT EXISTS %s ON '
+                              'certificates (%s)' % (name, column))
+
+    def close(self):
+        self.__lock.acquire()
+        try:
+            self.__db.close()
+        finally:
+            self.__lock.release()
+
+    def commit(self):
+        '''
+        Commits records added or changed with commit=False
+        '''
+        self.__lock.acquire()
+        try:
+            self.__db.commit()
+        finally:
+            self.__lock.release()
+
+    def __execute(self, query, args=(), commit=False):
+        self.__lock.acquire()
+        try:
+            cursor = self.__db.execute(query, args)
+            if commit:
+                self.__db.commit()
+            return cursor
+        finally:
+            self.__lock.release()
+
+    def __iterate_rows(self, query, args=()):
+        cursor = self.__execute(query, args)
+        while True:
+            self.__lock.acquire()
+            try:
+                rows = cursor.fetchmany(self.fetch_size)
+            finally:
+                self.__lock.release()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def __iterate(self, query, args=()):
+        for row in self.__iterate_rows(query, args):
+            yield CertificateRecord(*row)
+
+    def __insert_many(self, table, columns, rows):
+        self.__lock.acquire()
+        try:
+            self.__db.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' %
+                                  (table, ', '.join('?' * columns)), rows)
+            self.__db.commit()
+        finally:
+            self.__lock.release()
+
+    def __len__(self):
+        return self.__execute('SELECT COUNT(*) FROM certificates').fetchone()[0]
+
+    def add(self, record, commit=True):
+        '''
+        Adds a certificate record, replacing any record with the same serial
+
+        When adding many records, pass commit=False and call commit() at
+        the end (or use add_many()).
+        '''
+        self.__execute('INSERT OR REPLACE INTO certificates VALUES '
+                       '(?, ?, ?, ?, ?, ?, ?, ?)', record.as_row(), commit)
+
+    def add_many(self, records):
+        '''
+        Adds any number of records in a single transaction
+        '''
+        self.__insert_many('certificates', 8,
+                           (record.as_row() for record in records))
+
+    def get(self, serial):
+        '''
+        Returns the record with the given serial, or None
+        '''
+        row = self.__execute('SELECT %s FROM certificates WHERE serial = ?'
+                             % self.COLUMNS,
+                             (normalize_serial(serial),)).fetchone()
+        if row is None:
+            return None
+        return CertificateRecord(*row)
+
+    def find_by_subject(self, subject, status=None):
+        '''
+        Returns the records issued to subject, optionally with a given status
+        '''
+        query = ('SELECT %s FROM certificates WHERE subject_hash = ? '
+                 'AND subject = ?' % self.COLUMNS)
+        args = (subject_hash(subject), subject)
+        if status is not None:
+            query += ' AND status = ?'
+            args += (status,)
+        return list(self.__iterate(query, args))
+
+    def find_expiring(self, before, after=None, status='V'):
+        '''
+        Iterates over the records expiring before a given time (and, if
+        given, after another), soonest first
+
+        Only records in the given status are returned, unless status is None.
+        '''
+        query = 'SELECT %s FROM certificates WHERE expires < ?' % self.COLUMNS
+        args = (before,)
+        if after is not None:
+            query += ' AND expires >= ?'
+            args += (after,)
+        if status is not None:
+            query += ' AND status = ?'
+            args += (status,)
+        return self.__iterate(query + ' ORDER BY expires', args)
+
+    def count_expiring(self, after, before, bucket=24 * 60 * 60,
+                       status='V'):
+        '''
+        Returns how many certificates expire in each bucket (by default,
+        each day) from after to before, as a list of (bucket start, count)
+        tuples, buckets with no certificates being left out
+
+        Only records in the given status are counted, unless status is
+        None. Like find_expiring(), this only reads the index entries of
+        the certificates in range.
+        '''
+        query = ('SELECT expires - expires %% %d, COUNT(*) FROM certificates '
+                 'WHERE expires >= ? AND expires < ?' % bucket)
+        args = (after, before)
+        if status is not None:
+            query += ' AND status = ?'
+            args += (status,)
+        return self.__execute(query + ' GROUP BY 1 ORDER BY 1',
+                              args).fetchall()
+
+    def find_renewable(self, before, after=None, start=None, limit=None):
+        '''
+        Iterates over the valid certificates expiring before a given time
+        (and, if given, after another), soonest first, leaving out those
+        already renewed (see add_renewal())
+
+        To go through them a page at a time, pass the (expires, serial) of
+        the last record of the previous page as start, and the page size
+        as limit.
+        '''
+        query = ('SELECT %s FROM certificates WHERE expires < ? AND '
+                 'status = ? AND NOT EXISTS (SELECT 1 FROM renewals WHERE '
+                 'renewals.serial = certificates.serial)' % self.COLUMNS)
+        args = (before, 'V')
+        if after is not None:
+            query += ' AND expires >= ?'
+            args += (after,)
+        if start is not None:
+            expires, serial = start
+            query += ' AND (expires > ? OR (expires = ? AND serial > ?))'
+            args += (expires, expires, normalize_serial(serial))
+        query += ' ORDER BY expires, serial'
+        if limit is not None:
+            query += ' LIMIT %d' % limit
+        return self.__iterate(query, args)
+
+    def add_renewal(self, serial, renewed_by, when=None, commit=True):
+        '''
+        Records that the certificate with the given serial was renewed by
+        the one with serial renewed_by
+        '''
+        if when is None:
+            when = int(time.time())
+        self.__execute('INSERT OR REPLACE INTO renewals VALUES (?, ?, ?)',
+                       (normalize_serial(serial), normalize_serial(renewed_by),
+                        when), commit)
+
+    def get_renewal(self, serial):
+        '''
+        Returns the serial of the certificate that renewed the one with
+        the given serial, or None
+        '''
+        row = self.__execute('SELECT renewed_by FROM renewals WHERE '
+                             'serial = ?', (normalize_serial(serial),)
+                             ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def iter_renewals(self):
+        '''
+        Iterates over all renewals, as (serial, renewed_by, renewed) tuples
+        '''
+        return self.__iterate_rows('SELECT serial, renewed_by, renewed FROM '
+                                   'renewals ORDER BY rowid')
+
+    def add_renewals(self, renewals):
+        '''
+        Adds any number of (serial, renewed_by, renewed) tuples, as
+        returned by iter_renewals(), in a single transaction
+        '''
+        self.__insert_many('renewals', 3, renewals)
+
+    def revoke(self, serial, when=None, reason=None):
+        '''
+        Marks a certificate as revoked
+
+        The revocation is also logged, with a sequence number, so that it
+        shows up in the next delta CRL even if when is in the past (see
+        find_revoked_after()).
+        '''
+        if when is None:
+            when = int(time.time())
+        serial = normalize_serial(serial)
+        self.__lock.acquire()
+        try:
+            cursor = self.__db.execute('UPDATE certificates SET status = ?, '
+                                       'revoked = ?, reason = ? WHERE '
+                                       'serial = ?',
+                                       ('R', when, reason, serial))
+            if not cursor.rowcount:
+                raise KeyError(serial)
+            self.__db.execute('INSERT INTO revocations (serial) VALUES (?)',
+                              (serial,))
+            self.__db.commit()
+        finally:
+            self.__lock.release()
+
+    def get_revocation_sequence(self):
+        '''
+        Returns the sequence number of the last revocation recorded, or 0
+        '''
+        return self.__execute('SELECT MAX(sequence) FROM revocations'
+                              ).fetchone()[0] or 0
+
+    def find_revoked_after(self, sequence):
+        '''
+        Iterates over the certificates whose revocation was recorded after
+        the one with the given sequence number (see
+        get_revocation_sequence()), in revocation time order
+
+        Unlike find_revoked(since), this does not go by revocation time,
+        so back dated revocations are not missed.
+        '''
+        return self.__iterate('SELECT %s FROM certificates WHERE revoked IS '
+                              'NOT NULL AND serial IN (SELECT serial FROM '
+                              'revocations WHERE sequence > ?) ORDER BY '
+                              'revoked' % self.COLUMNS, (sequence,))
+
+    def iter_revocations(self):
+        '''
+        Iterates over the revocation log, as (sequence, serial) tuples
+        '''
+        return self.__iterate_rows('SELECT sequence, serial FROM revocations '
+                                   'ORDER BY sequence')
+
+    def add_revocations(self, revocations):
+        '''
+        Adds any number of (sequence, serial) tuples, as returned by
+        iter_revocations(), to the revocation log in a single transaction
+        '''
+        self.__insert_many('revocations', 2, revocations)
+
+    def find_revoked(self, since=None):
+        '''
+        Iterates over the revoked certificates (optionally, only those
+        revoked at or after a given time), in revocation order
+        '''
+        query = ('SELECT %s FROM certificates WHERE revoked IS NOT NULL'
+                 % self.COLUMNS)
+        args = ()
+        if since is not None:
+            query += ' AND revoked >= ?'
+            args = (since,)
+        return self.__iterate(query + ' ORDER BY revoked', args)
+
+    def add_crl(self, number, this_update, base=None, sequence=None):
+        '''
+        Records that a CRL was issued. base is the number of the base CRL,
+        for delta CRLs, and sequence the revocation sequence number (see
+        get_revocation_sequence()) the CRL is up to date with.
+        '''
+        self.__execute('INSERT OR REPLACE INTO crls VALUES (?, ?, ?, ?)',
+                       (number, base, this_update, sequence), True)
+
+    def iter_crls(self):
+        '''
+        Iterates over the CRLs issued, as (number, base, this_update,
+        sequence) tuples
+        '''
+        return self.__iterate_rows('SELECT number, base, this_update, '
+                                   'sequence FROM crls ORDER BY number')
+
+    def add_crls(self, crls):
+        '''
+        Adds any number of (number, base, this_update, sequence) tuples, as
+        returned by iter_crls(), in a single transaction
+        '''
+        self.__insert_many('crls', 4, crls)
+
+    def get_last_base_crl(self):
+        '''
+        Returns the (number, this_update, sequence) of the last full CRL
+        issued, or None. sequence is None for CRLs recorded by older
+        versions.
+        '''
+        return self.__execute('SELECT number, this_update, sequence FROM '
+                              'crls WHERE base IS NULL ORDER BY number DESC '
+                              'LIMIT 1').fetchone()
+
+    def __iter__(self):
+        return self.__iterate('SELECT %s FROM certificates ORDER BY rowid'
+                              % self.COLUMNS)
+
+    def import_index(self, path):
+        '''
+        Bulk imports the records of an openssl index.txt file
+
+        The whole file goes in a single transaction, and the secondary
+        indexes are rebuilt once at the end instead of being updated for
+        every row.
+        '''
+        fp = open(path)
+        self.__lock.acquire()
+        try:
+            for name in self.INDEXES:
+                self.__db.execute('DROP INDEX IF EXISTS %s' % name)
+            try:
+                self.__db.executemany('INSERT OR REPLACE INTO certificates '
+                                      'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (CertificateRecord.from_index_line(line).as_row()
+                                       for line in fp if line.strip()))
+            except:
+                self.__db.rollback()
+                self.__create_indexes()
+                raise
+            self.__create_indexes()
+            self.__db.commit()
+        finally:
+            self.__lock.release()
+            fp.close()
+
+    def export_index(self, path):
+        '''
+        Writes all records to path, in the openssl index.txt format
+        '''
+        fp = fileutil.AtomicFile(path)
+        try:
+            for record in self:
+                fp.write(record.to_index_line())
+        except:
+            fp.abort()
+            raise
+        fp.commit()
@@ -0,0 +1,277 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+fileutil.py
+
+    
+"""
+
+__all__ = ['AtomicFile', 'WriteBatch', 'write_file', 'create_file', 'rename',
+           'make_dirs', 'fsync_dir']
+
+import os
+import errno
+import itertools
+
+# mode of files holding private keys
+PRIVATE = 0600
+
+_counter = itertools.count()
+
+def get_temp_path(path):
+    '''
+    Returns an unused name for a temporary file next to path, so it can
+    be renamed over path atomically
+    '''
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.%s.%d-%d.tmp' % (name, os.getpid(),
+                                                      _counter.next()))
+
+def fsync_dir(path):
+    '''
+    Flushes a directory to disk, making renames and new entries in it
+    durable
+    '''
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        try:
+            os.fsync(fd)
+        except OSError, e:
+            # some filesystems do not support syncing directories
+            if e.errno != errno.EINVAL:
+                raise
+    finally:
+        os.close(fd)
+
+def fsync_files(paths):
+    '''
+    Flushes the data of files to disk, one fsync() per file, so that only
+    those files are flushed and any write error is reported for them
+    '''
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class AtomicFile(object):
+    '''
+    A file written under a temporary name, that replaces path only once
+    complete
+
+    Nothing is seen at path until commit(), which flushes the file to
+    disk, renames it over path and flushes the directory, so after a crash
+    path holds either the old or the new contents, never a truncated
+    file. abort() throws the temporary file away.
+
+    The temporary file is created with the given mode from the start, so
+    a private key file (mode PRIVATE) is never readable by others, not
+    even while being written. tmp_path may also be handed to an external
+    command (such as openssl) that writes the contents itself.
+
+    If batch (a WriteBatch) is given, commit() leaves flushing and
+    renaming to the batch. With sync False, the file is replaced
+    atomically but not flushed, which suits caches.
+    '''
+
+    def __init__(self, path, mode=0644, batch=None, sync=True):
+        self.path = path
+        self.tmp_path = get_temp_path(path)
+        self.batch = batch
+        self.sync = sync
+
+        fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     mode)
+        try:
+            # the exact mode, whatever the umask
+            os.fchmod(fd, mode)
+            self.file = os.fdopen(fd, 'wb')
+        except:
+            os.close(fd)
+            os.unlink(self.tmp_path)
+            raise
+
+    def write(self, buffer):
+        self.file.write(buffer)
+
+    def writelines(self, lines):
+        self.file.writelines(lines)
+
+    def commit(self):
+        '''
+        Replaces path with the file written so far
+        '''
+        try:
+            self.file.flush()
+            if self.sync and self.batch is None:
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+
+        if self.batch is not None:
+            self.batch.add(self.tmp_path, self.path)
+            return
+        os.rename(self.tmp_path, self.path)
+        if self.sync:
+            fsync_dir(os.path.dirname(self.path))
+
+    def abort(self):
+        '''
+        Throws away the file written so far, leaving path untouched
+        '''
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+class WriteBatch:
+    '''
+    Groups the commits of many AtomicFile objects
+
+    Files committed to the batch stay under their temporary names until
+    commit(), which flushes each of them (see fsync_files()), renames
+    them into place and flushes each directory involved once. Every file
+    still takes an fsync of its own: those are only deferred to commit(),
+    out of the way of writing, while the directory flushes are shared, so
+    writing n files into a directory costs n + 1 flushes instead of 2n.
+    None of the files are visible until commit().
+    '''
+
+    def __init__(self):
+        self.__pending = []
+
+    def __len__(self):
+        return len(self.__pending)
+
+    def open(self, path, mode=0644):
+        '''
+        Returns an AtomicFile for path, committed with this batch
+        '''
+        return AtomicFile(path, mode, self)
+
+    def write_file(self, path, buffer, mode=0644):
+        write_file(path, buffer, mode, self)
+
+    def add(self, tmp_path, path):
+        '''
+        Schedules the complete file at tmp_path to replace path
+        '''
+        self.__pending.append((tmp_path, path))
+
+    def commit(self):
+        '''
+        Makes all files written to the batch durable and visible
+        '''
+        if not self.__pending:
+            return
+        pending = self.__pending
+        self.__pending = []
+
+        fsync_files([tmp_path for tmp_path, path in pending])
+        directories = set()
+        for tmp_path, path in pending:
+            os.rename(tmp_path, path)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fsync_dir(directory)
+
+    def abort(self):
+        '''
+        Throws away all files written to the batch since the last commit
+        '''
+        pending = self.__pending
+        self.__pending = []
+        for tmp_path, path in pending:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+def write_file(path, buffer, mode=0644, batch=None):
+    '''
+    Replaces the contents of path with buffer, atomically and durably (see
+    AtomicFile)
+    '''
+    fp = AtomicFile(path, mode, batch)
+    try:
+        fp.write(buffer)
+    except:
+        fp.abort()
+        raise
+    fp.commit()
+
+def create_file(path, buffer='', mode=0644):
+    '''
+    Creates a file holding buffer, unless path already exists
+
+    Just like write_file(), the file is never seen half written, but an
+    existing file is never replaced. Returns whether it was created.
+    '''
+    if os.path.exists(path):
+        return False
+    fp = AtomicFile(path, mode)
+    try:
+        fp.write(buffer)
+        fp.file.flush()
+        os.fsync(fp.file.fileno())
+        fp.file.close()
+        try:
+            os.link(fp.tmp_path, path)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        fsync_dir(os.path.dirname(path))
+    finally:
+        fp.abort()
+    return True
+
+def make_dirs(path, mode=0755):
+    '''
+    Creates directory path and any missing parents, flushing the
+    directory each one is created in, so they survive a crash
+
+    Returns whether path was created.
+    '''
+    if os.path.isdir(path):
+        return False
+    parent = os.path.dirname(path)
+    if parent and parent != path:
+        make_dirs(parent, mode)
+    try:
+        os.mkdir(path, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    fsync_dir(parent)
+    return True
+
+def rename(src, dst):
+    '''
+    Renames src to dst durably
+    '''
+    os.rename(src, dst)
+    fsync_dir(os.path.dirname(dst))
+    if os.path.dirname(src) != os.path.dirname(dst):
+        fsync_dir(os.path.dirname(src))
@@ -0,0 +1,151 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+keycache.py
+
+    
+"""
+
+__all__ = ['KeyCache']
+
+import os
+import time
+import threading
+from collections import OrderedDict
+
+class KeyCache:
+    '''
+    An in-memory cache of loaded (decrypted) CA keys and certificates
+
+    Entries are keyed by CA name and file path, and are only reused while
+    the file keeps the same modification time, size and inode, and for at
+    most ttl seconds. At most max_entries entries are kept, the least
+    recently used one being evicted first.
+
+    The password callback is only called when a key has to be (re)loaded,
+    but cached key objects hold the key in the clear, and with the openssl
+    engine (whose keys are a file and the password to decrypt it, handed
+    to every openssl command) the password itself. Nothing is wiped when
+    an entry is evicted or flushed: the cache just drops its reference,
+    leaving the key object to the garbage collector, so keep ttl short
+    where this matters, and do not keep keys around elsewhere.
+
+    Keys are loaded without holding the cache lock, so a slow password
+    callback only holds up the callers wanting that same key, which wait
+    for it to be loaded instead of loading it again.
+    '''
+
+    def __init__(self, ttl=300, max_entries=32):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+
+        # (ca, path) -> (stat signature, load time, object), least
+        # recently used first
+        self.__entries = OrderedDict()
+        # (ca, path) -> threading.Event set once it is loaded (or failed
+        # to load), for the keys being loaded
+        self.__loading = {}
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, ca, path, loader):
+        '''
+        Returns the object loaded from path for ca, calling loader() to
+        load it if it is not cached, has expired or the file has changed
+        '''
+        st = os.stat(path)
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        now = time.time()
+        key = (ca, path)
+
+        while True:
+            self.__lock.acquire()
+            try:
+                entry = self.__entries.pop(key, None)
+                if entry is not None and entry[0] == signature and \
+                       now - entry[1] < self.ttl:
+                    self.__entries[key] = entry
+                    return entry[2]
+                loading = self.__loading.get(key)
+                if loading is None:
+                    loading = self.__loading[key] = threading.Event()
+                    break
+            finally:
+                self.__lock.release()
+            # being loaded by another caller: once done, it is cached, or
+            # failed to load and is loaded here
+            loading.wait()
+
+        try:
+            obj = loader()
+        except:
+            self.__lock.acquire()
+            try:
+                del self.__loading[key]
+            finally:
+                self.__lock.release()
+            loading.set()
+            raise
+
+        self.__lock.acquire()
+        try:
+            del self.__loading[key]
+            self.__entries[key] = (signature, now, obj)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        finally:
+            self.__lock.release()
+        loading.set()
+        return obj
+
+    def expire(self):
+        '''
+        Evicts all entries older than ttl
+        '''
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            for key, entry in self.__entries.items():
+                if now - entry[1] >= self.ttl:
+                    del self.__entries[key]
+        finally:
+            self.__lock.release()
+
+    def flush(self, ca=None):
+        '''
+        Evicts all entries, or only those of a given CA
+        '''
+        self.__lock.acquire()
+        try:
+            if ca is None:
+                self.__entries.clear()
+            else:
+                for key in self.__entries.keys():
+                    if key[0] == ca:
+                        del self.__entries[key]
+        finally:
+            self.__lock.release()
@@ -0,0 +1,225 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+keypool.py
+
+    
+"""
+
+__all__ = ['KeyPool']
+
+import os
+import time
+import errno
+import threading
+import itertools
+import traceback
+from collections import deque
+
+import tracing
+
+def mkdir_private(path):
+    '''
+    Creates a directory only accessible by its owner (if needed)
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path, 0700)
+    os.chmod(path, 0700)
+
+class KeyPool:
+    '''
+    A directory of pre-generated, unencrypted private keys
+
+    Keys of a single type and size are kept in a 0700 directory. take()
+    hands out a ready key in O(1), and a background thread (see start())
+    refills the pool up to high_water whenever it drops below low_water.
+    Failures to refill are printed and counted (as keypool.fill_errors),
+    and retried after a growing delay.
+
+    Several processes may share the same pool directory: a key is claimed
+    by atomically renaming it, so it is never handed out twice.
+    '''
+
+    suffix = '.pem'
+
+    def __init__(self, engine, path, type='rsa', size=1024,
+                 low_water=16, high_water=64, workers=None):
+        self.engine = engine
+        self.path = path
+        self.type = type
+        self.size = size
+        self.low_water = low_water
+        self.high_water = high_water
+        self.workers = workers
+
+        self.__keys = deque()
+        self.__counter = itertools.count()
+        self.__wakeup = threading.Event()
+        self.__stopping = False
+        self.__thread = None
+
+        mkdir_private(self.path)
+        self.rescan()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def __new_name(self, prefix=''):
+        return os.path.join(self.path, '%s%d-%d%s' % (prefix, os.getpid(),
+                                                      self.__counter.next(),
+                                                      self.suffix))
+
+    def rescan(self):
+        '''
+        Picks up keys present in the pool directory
+
+        Needed only when other processes also fill this pool.
+        '''
+        known = set(self.__keys)
+        for name in os.listdir(self.path):
+            if name.startswith('.') or not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.path, name)
+            if path not in known:
+                self.__keys.append(path)
+
+    def take(self, path, password=''):
+        '''
+        Moves a pooled key to path, encrypting it with password if given
+
+        Returns False if the pool is empty, in which case the caller is
+        expected to generate the key itself.
+        '''
+        claimed = self.__new_name('.claimed-')
+        try:
+            while True:
+                try:
+                    pooled = self.__keys.popleft()
+                except IndexError:
+                    self.rescan()
+                    if not self.__keys:
+                        return False
+                    continue
+                try:
+                    os.rename(pooled, claimed)
+                except OSError, e:
+                    # taken by another process sharing this pool
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                break
+        finally:
+            if len(self.__keys) < self.low_water:
+                self.__wakeup.set()
+
+        self.engine.protect_private_key(claimed, path, password)
+        return True
+
+    def __add_key(self, tmp_path, seconds):
+        if self.__stopping:
+            os.unlink(tmp_path)
+            return False
+        path = self.__new_name()
+        os.rename(tmp_path, path)
+        self.__keys.append(path)
+        tracing.count('keypool.generated', type=self.type, size=self.size)
+
+    def fill(self, count=None):
+        '''
+        Generates keys until the pool holds high_water keys (or count keys
+        more, if count is given)
+        '''
+        if count is None:
+            count = self.high_water - len(self.__keys)
+        if count <= 0:
+            return
+        # keys are generated under a dot name, so a partially written key
+        # is never picked up by rescan()
+        specs = [(self.__new_name('.new-'), self.type, self.size)
+                 for i in xrange(count)]
+        try:
+            with tracing.span('keypool.fill', type=self.type, size=self.size,
+                              count=count):
+                self.engine.create_private_keys(specs, self.workers,
+                                                self.__add_key)
+        finally:
+            for spec in specs:
+                if os.path.exists(spec[0]):
+                    os.unlink(spec[0])
+
+    def __refill_loop(self):
+        # seconds to wait after a failed fill(), doubled on each failure in
+        # a row, up to a minute
+        backoff = 0
+        while not self.__stopping:
+            if len(self.__keys) < self.low_water:
+                try:
+                    self.fill()
+                    backoff = 0
+                except Exception:
+                    # a full disk, a pool that can not fork... claims keep
+                    # generating keys inline meanwhile
+                    tracing.count('keypool.fill_errors', type=self.type,
+                                  size=self.size)
+                    traceback.print_exc()
+                    backoff = min(max(2 * backoff, 1), 60)
+            if backoff:
+                self.__sleep(backoff)
+            else:
+                self.__wakeup.wait(60)
+                self.__wakeup.clear()
+
+    def __sleep(self, seconds):
+        '''
+        Waits for seconds, or until stop(), whatever claims happen
+        meanwhile
+        '''
+        deadline = time.time() + seconds
+        while not self.__stopping and time.time() < deadline:
+            self.__wakeup.wait(deadline - time.time())
+            self.__wakeup.clear()
+
+    def start(self):
+        '''
+        Starts the background refill thread
+        '''
+        if self.__thread is not None:
+            return
+        self.__stopping = False
+        self.__thread = threading.Thread(target=self.__refill_loop,
+                                         name='KeyPool %s' % self.path)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def stop(self):
+        '''
+        Stops the background refill thread, waiting for it to finish
+        '''
+        if self.__thread is None:
+            return
+        self.__stopping = True
+        self.__wakeup.set()
+        self.__thread.join()
+        self.__thread = None
@@ -0,0 +1,192 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+layout.py
+
+    
+"""
+
+__all__ = ['migrate']
+
+import os
+import sys
+import time
+import errno
+import optparse
+
+import tracing
+import fileutil
+from ca import LAYOUTS
+
+def remove_empty_dirs(directories, top):
+    '''
+    Removes the given directories, and their parents up to top, where
+    empty
+    '''
+    for directory in sorted(directories, reverse=True):
+        while directory != top and directory.startswith(top):
+            try:
+                os.rmdir(directory)
+            except OSError, e:
+                if e.errno in (errno.ENOTEMPTY, errno.EEXIST):
+                    break
+                if e.errno != errno.ENOENT:
+                    raise
+            directory = os.path.dirname(directory)
+
+def migrate(ca, batch_size=1024, rate=None, stats=None):
+    '''
+    Moves the certificates of a CA kept in the other layout into the
+    configured one (see CertificateAuthority.get_certificate_path())
+
+    The CA may keep issuing certificates and answering queries meanwhile:
+    each certificate is first linked into its new place, and only
+    removed from the old one once a whole batch of links has been made
+    durable, so it can always be found under one name or the other (see
+    CertificateAuthority.find_certificate_path()), even after a crash.
+    Certificates are looked up from the CA database, so running again
+    after an interruption (or after processes still using the old layout
+    wrote more certificates) just moves what is left.
+
+    If rate is given, no more than rate certificates per second are
+    moved, to spare the disks of a busy CA. If a dict is given as stats,
+    it is updated with the number of certificates 'moved' and 'skipped'
+    (not in the old layout), the 'seconds' spent and the resulting
+    'rate' in certificates per second.
+    '''
+    from renewal import RateLimiter
+
+    if stats is None:
+        stats = {}
+    stats.update({'moved' : 0, 'skipped' : 0, 'seconds' : 0.0,
+                  'rate' : 0.0})
+    start = time.time()
+
+    layout = ca.get_certificate_layout()
+    old_layout = [name for name in LAYOUTS if name != layout][0]
+    limiter = None
+    if rate is not None:
+        limiter = RateLimiter(rate, batch_size)
+    old_dirs = set()
+
+    def move(batch):
+        if limiter is not None:
+            limiter.acquire(len(batch))
+        new_dirs = set()
+        for src, dst in batch:
+            try:
+                os.link(src, dst)
+            except OSError, e:
+                # linked by an interrupted run
+                if e.errno != errno.EEXIST:
+                    raise
+            new_dirs.add(os.path.dirname(dst))
+        for directory in new_dirs:
+            fileutil.fsync_dir(directory)
+
+        batch_dirs = set()
+        for src, dst in batch:
+            os.unlink(src)
+            batch_dirs.add(os.path.dirname(src))
+        for directory in batch_dirs:
+            fileutil.fsync_dir(directory)
+        old_dirs.update(batch_dirs)
+
+        tracing.count('layout.moved', len(batch), ca=ca.ca)
+        stats['moved'] += len(batch)
+        stats['seconds'] = time.time() - start
+        stats['rate'] = stats['moved'] / stats['seconds']
+
+    batch = []
+    with tracing.span('layout.migrate', ca=ca.ca, layout=layout):
+        for record in ca.get_database():
+            src = ca.get_certificate_path(record.serial, old_layout)
+            if not os.path.exists(src):
+                stats['skipped'] += 1
+                continue
+            batch.append((src, ca.make_certificate_path(record.serial)))
+            if len(batch) >= batch_size:
+                move(batch)
+                batch = []
+        if batch:
+            move(batch)
+
+    if old_layout == 'sharded':
+        remove_empty_dirs(old_dirs, ca.config.get_ca_new_certs_dir(ca.ca))
+    stats['seconds'] = time.time() - start
+    return stats
+
+def main(args=None):
+    from configparser import OpenSSLConfigParser
+    from ca import CertificateAuthority
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] CONFIG',
+        description='Moves the certificates of a CA into the new certs '
+                    'layout set in an openssl config (new_certs_layout), '
+                    'while the CA stays in use. The config is never '
+                    'changed: set new_certs_layout first.')
+    parser.add_option('-c', '--ca', default='',
+                      help='CA section [the default CA]')
+    parser.add_option('-l', '--layout', type='choice', choices=LAYOUTS,
+                      default=None,
+                      help='the layout to migrate to (one of %s), which '
+                           'the config must already set' % ', '.join(LAYOUTS))
+    parser.add_option('-b', '--batch-size', type='int', default=1024,
+                      help='certificates moved per batch [%default]')
+    parser.add_option('-r', '--rate', type='float', default=None,
+                      help='certificates moved per second at most')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='report how many certificates were moved')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('a config file is required')
+
+    config = OpenSSLConfigParser()
+    config.read_cached(args[0])
+    ca = CertificateAuthority(config, options.ca)
+    if options.layout is not None and \
+           options.layout != ca.get_certificate_layout():
+        ca.close()
+        print >> sys.stderr, 'The config sets the %s layout for CA %s. To ' \
+              'migrate to the %s layout, add\n\n    new_certs_layout = %s\n' \
+              '\nto its [ %s ] section in %s, restart the programs ' \
+              'issuing certificates, and run this again.' % \
+              (ca.get_certificate_layout(), ca.ca, options.layout,
+               options.layout, ca.ca, args[0])
+        sys.exit(1)
+
+    try:
+        stats = migrate(ca, options.batch_size, options.rate)
+    finally:
+        ca.close()
+
+    if options.verbose:
+        print >> sys.stderr, '%d certificates moved, %d skipped in %.1f ' \
+              'seconds' % (stats['moved'], stats['skipped'],
+                           stats['seconds'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+manager.py
+
+    
+"""
+
+__all__ = ['CAManager']
+
+import threading
+from collections import OrderedDict
+
+from ca import CertificateAuthority
+from keycache import KeyCache
+
+class CAManager:
+    '''
+    Manages all the CAs defined in a config
+
+    CertificateAuthority instances are only created when first used, and
+    all of them share a key cache, and an engine per backend (see the CA
+    backend option) unless engine is given. At most max_loaded CAs are kept
+    loaded: when that many are, the least recently used one not in use is
+    closed and dropped (it is transparently loaded again if needed later).
+    CAs used from several threads must be taken with acquire() and given
+    back with release(), so they are never closed while in use: one
+    dropped by unload() meanwhile is only closed by its last release().
+
+    The CA names are read from the config once, when the manager is
+    created.
+
+    Callbacks registered with the manager are registered with every CA
+    it loads.
+    '''
+
+    def __init__(self, config, max_loaded=64, engine=None):
+        self.config = config
+        self.max_loaded = max_loaded
+        self.__engine = engine
+        # backend name -> engine, see get_engine()
+        self.__engines = {}
+        self.__callbacks = []
+        self.key_cache = KeyCache(max_entries=2 * max_loaded)
+        self.__lock = threading.RLock()
+        self.__names = frozenset(config.get_cas())
+
+        # name -> CertificateAuthority, least recently used first
+        self.__loaded = OrderedDict()
+        # CertificateAuthority -> number of acquire() not yet released
+        self.__users = {}
+
+    def get_engine(self, backend=None):
+        '''
+        Returns the engine shared by all CAs using backend (the default
+        one, if not given)
+        '''
+        if self.__engine is not None:
+            return self.__engine
+        self.__lock.acquire()
+        try:
+            if not self.__engines.has_key(backend):
+                from backends import get_engine_class
+                self.__engines[backend] = get_engine_class(backend)()
+            return self.__engines[backend]
+        finally:
+            self.__lock.release()
+
+    def get_ca_names(self):
+        '''
+        Returns the names of all CAs defined in the config
+        '''
+        return list(self.__names)
+
+    def register_callback(self, name, function, *args, **kwargs):
+        '''
+        Registers a callback with every CA, see
+        CertificateAuthority.register_callback()
+        '''
+        self.__lock.acquire()
+        try:
+            self.__callbacks.append((name, function, args, kwargs))
+            for ca in self.__loaded.values():
+                ca.register_callback(name, function, *args, **kwargs)
+        finally:
+            self.__lock.release()
+
+    def get(self, name=''):
+        '''
+        Returns the CertificateAuthority for a CA section, loading it if
+        needed. If name is not given, the default CA is returned.
+
+        The CA may be closed once other CAs are loaded: use acquire()
+        instead where other threads use the manager.
+        '''
+        if not name:
+            name = self.config.get_default_ca()
+
+        self.__lock.acquire()
+        try:
+            ca = self.__loaded.pop(name, None)
+            if ca is None:
+                if name not in self.__names:
+                    raise KeyError(name)
+                self.__evict(self.max_loaded - 1)
+                engine = self.get_engine(self.config.get_ca_backend(name))
+                ca = CertificateAuthority(self.config, name, engine,
+                                          self.key_cache)
+                for cb_name, function, args, kwargs in self.__callbacks:
+                    ca.register_callback(cb_name, function, *args, **kwargs)
+            # (re)inserting moves it to the most recently used end
+            self.__loaded[name] = ca
+            return ca
+        finally:
+            self.__lock.release()
+
+    __getitem__ = get
+
+    def acquire(self, name=''):
+        '''
+        Like get(), but the CA is not closed until given back with
+        release()
+        '''
+        self.__lock.acquire()
+        try:
+            ca = self.get(name)
+            self.__users[ca] = self.__users.get(ca, 0) + 1
+            return ca
+        finally:
+            self.__lock.release()
+
+    def release(self, ca):
+        '''
+        Gives back a CA taken with acquire(), closing it if it was
+        dropped meanwhile and this was its last user
+        '''
+        self.__lock.acquire()
+        try:
+            users = self.__users.pop(ca) - 1
+            if users:
+                self.__users[ca] = users
+            elif self.__loaded.get(ca.ca) is not ca:
+                ca.close()
+        finally:
+            self.__lock.release()
+
+    def __evict(self, count):
+        '''
+        Closes and drops the least recently used CAs not in use until at
+        most count are loaded (or all those left are in use)
+        '''
+        for name, ca in self.__loaded.items():
+            if len(self.__loaded) <= count:
+                break
+            if not self.__users.has_key(ca):
+                del self.__loaded[name]
+                ca.close()
+
+    def __contains__(self, name):
+        return name in self.__names
+
+    def __iter__(self):
+        return iter(self.get_ca_names())
+
+    def get_loaded(self):
+        '''
+        Returns the names of the CAs currently loaded, least recently used
+        first
+        '''
+        return self.__loaded.keys()
+
+    def unload(self, name):
+        '''
+        Closes and drops a loaded CA, or only drops it if in use (see
+        release())
+        '''
+        self.__lock.acquire()
+        try:
+            ca = self.__loaded.pop(name, None)
+            if ca is not None and not self.__users.has_key(ca):
+                ca.close()
+        finally:
+            self.__lock.release()
+
+    def close(self):
+        '''
+        Closes and drops all loaded CAs, even those in use, and closes the
+        engines created for them
+        '''
+        self.__lock.acquire()
+        try:
+            while self.__loaded:
+                self.__loaded.popitem()[1].close()
+            # those in use are closed again by their last release(),
+            # which does nothing more
+            for ca in self.__users.keys():
+                ca.close()
+            for engine in self.__engines.values():
+                engine.close()
+            self.__engines = {}
+        finally:
+            self.__lock.release()
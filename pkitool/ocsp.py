@@ -0,0 +1,436 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+ocsp.py
+
+    
+"""
+
+__all__ = ['OCSPResponder', 'parse_request', 'get_issuer_hashes']
+
+import time
+import heapq
+import marshal
+import hashlib
+import threading
+
+import tracing
+import fileutil
+from pkcs7 import pem_to_der
+from database import normalize_serial
+
+# CertID hash algorithms (hashlib names), by DER encoded OID
+HASH_OIDS = {'\x2b\x0e\x03\x02\x1a' : 'sha1',
+             '\x60\x86\x48\x01\x65\x03\x04\x02\x01' : 'sha256'}
+
+# unsigned responses, carrying just an error status
+MALFORMED_REQUEST = '\x30\x03\x0a\x01\x01'
+INTERNAL_ERROR = '\x30\x03\x0a\x01\x02'
+UNAUTHORIZED = '\x30\x03\x0a\x01\x06'
+
+SNAPSHOT_VERSION = 1
+
+def read_tlv(der, offset=0):
+    '''
+    Reads the DER TLV at offset, returning (tag, start, end), the
+    contents being der[start:end]
+    '''
+    if offset + 2 > len(der):
+        raise ValueError('Truncated DER')
+    tag = ord(der[offset])
+    length = ord(der[offset + 1])
+    start = offset + 2
+    if length & 0x80:
+        count = length & 0x7f
+        if not 0 < count <= 4:
+            raise ValueError('Bad DER length')
+        length = int(der[start:start + count].encode('hex'), 16)
+        start += count
+    end = start + length
+    if end > len(der):
+        raise ValueError('Truncated DER')
+    return tag, start, end
+
+def read_children(der, start, end):
+    '''
+    Returns the (tag, start, end, offset) of each TLV between start and
+    end, offset being where the whole TLV starts
+    '''
+    children = []
+    while start < end:
+        tag, child_start, child_end = read_tlv(der, start)
+        children.append((tag, child_start, child_end, start))
+        start = child_end
+    return children
+
+def parse_request(der):
+    '''
+    Parses a DER encoded OCSP request, returning a (hash name, issuer
+    name hash, issuer key hash, serial) tuple for each certificate asked
+    about. The hash name is None for unknown hash algorithms.
+
+    Raises ValueError if the request can not be parsed.
+    '''
+    try:
+        tag, start, end = read_tlv(der)
+        tbs_request = read_children(der, start, end)[0]
+        # version, requestorName, requestList, requestExtensions, only
+        # requestList being a SEQUENCE
+        for tag, start, end, offset in read_children(der, tbs_request[1],
+                                                     tbs_request[2]):
+            if tag == 0x30:
+                break
+        else:
+            raise ValueError('No requestList')
+
+        certificates = []
+        for tag, start, end, offset in read_children(der, start, end):
+            cert_id = read_children(der, start, end)[0]
+            algorithm, name_hash, key_hash, serial = \
+                read_children(der, cert_id[1], cert_id[2])
+            oid = read_children(der, algorithm[1], algorithm[2])[0]
+            certificates.append((HASH_OIDS.get(der[oid[1]:oid[2]]),
+                                 der[name_hash[1]:name_hash[2]],
+                                 der[key_hash[1]:key_hash[2]],
+                                 long(der[serial[1]:serial[2]].encode('hex')
+                                      or '0', 16)))
+        return certificates
+    except (IndexError, TypeError), e:
+        raise ValueError('Malformed OCSP request: %s' % e)
+
+def get_issuer_hashes(der, hash_name='sha1'):
+    '''
+    Returns the (issuer name hash, issuer key hash) identifying, in OCSP
+    requests, certificates issued by the DER encoded CA certificate
+    '''
+    tag, start, end = read_tlv(der)
+    tbs_certificate = read_children(der, start, end)[0]
+    fields = read_children(der, tbs_certificate[1], tbs_certificate[2])
+    if fields[0][0] == 0xa0:
+        # explicit version
+        fields = fields[1:]
+    # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo
+    subject = fields[4]
+    public_key = read_children(der, fields[5][1], fields[5][2])[1]
+    # the key hash leaves out the BIT STRING unused bits octet
+    key = der[public_key[1] + 1:public_key[2]]
+    return (hashlib.new(hash_name, der[subject[3]:subject[2]]).digest(),
+            hashlib.new(hash_name, key).digest())
+
+class OCSPResponder:
+    '''
+    Answers OCSP requests on the certificates issued by the CAs of a
+    manager (see manager.CAManager), from a cache of pre-signed responses
+
+    Responses are valid for hours, carry no nonce (as in the RFC 5019
+    lightweight profile) and are kept in memory, keyed by the request
+    CertID, so a cached answer takes parsing the request and a dict
+    lookup. Only cache misses (certificates issued since the responses
+    were computed, or CertIDs hashed with other algorithms) are signed
+    while answering.
+
+    A background thread (see start()) re-signs responses refresh_margin
+    seconds before they expire, and picks up revocations from the CA
+    databases every poll_interval seconds. revoke() updates the response
+    right away.
+
+    Requests on unknown CAs or serials are answered with the unsigned
+    "unauthorized" status, and those asking about more than one
+    certificate with "malformedRequest".
+    '''
+
+    def __init__(self, manager, hours=24, refresh_margin=None,
+                 poll_interval=5, hashes=('sha1',)):
+        '''
+        hashes are the CertID hash algorithms responses are computed for
+        in advance, see precompute().
+        '''
+        self.manager = manager
+        self.validity = hours * 60 * 60
+        if refresh_margin is None:
+            refresh_margin = self.validity / 4
+        self.refresh_margin = refresh_margin
+        self.poll_interval = poll_interval
+        self.hashes = hashes
+
+        # (hash name, issuer name hash, issuer key hash) -> CA name
+        self.__issuers = {}
+        # CertID -> (response, next update, revoked)
+        self.__responses = {}
+        # (refresh time, CertID) heap
+        self.__refresh = []
+        # CA name -> revocation sequence number (see
+        # CertificateDatabase.get_revocation_sequence()) revocations were
+        # last picked up to, or None if never
+        self.__polled = {}
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__thread = None
+
+        for name in manager.get_ca_names():
+            self.add_ca(name)
+
+    def __len__(self):
+        return len(self.__responses)
+
+    def add_ca(self, name):
+        '''
+        Starts answering for the CA with the given name
+        '''
+        fp = open(self.manager.config.get_ca_certificate(name))
+        try:
+            der = pem_to_der(fp.read())[0]
+        finally:
+            fp.close()
+        for hash_name in HASH_OIDS.values():
+            self.__issuers[(hash_name,) +
+                           get_issuer_hashes(der, hash_name)] = name
+        self.__polled.setdefault(name, None)
+
+    def __get_cert_ids(self, name, serial, hashes=None):
+        '''
+        Returns the CertIDs of a CA serial, for the given hash algorithms
+        (by default, all of them)
+        '''
+        return [issuer + (serial,) for issuer, ca in self.__issuers.items()
+                if ca == name and (hashes is None or issuer[0] in hashes)]
+
+    def __sign(self, cert_id):
+        '''
+        Signs and caches the response for a CertID, returning it
+        '''
+        name = self.__issuers.get(cert_id[:3])
+        if name is None:
+            return UNAUTHORIZED
+        ca = self.manager.acquire(name)
+        try:
+            record = ca.get_database().get(cert_id[3])
+            now = int(time.time())
+            if record is None or record.expires < now:
+                self.__responses.pop(cert_id, None)
+                return UNAUTHORIZED
+
+            next_update = now + self.validity
+            with tracing.span('engine.create_ocsp_response', ca=name):
+                cert = ca.engine.load_certificate(
+                    ca.find_certificate_path(cert_id[3]))
+                response = ca.engine.create_ocsp_response(
+                    cert, ca.load_ca_certificate(), ca.load_ca_key(),
+                    record.revoked, record.reason, now, next_update,
+                    ca.config.get_ca_default_md(name), cert_id[0])
+        finally:
+            self.manager.release(ca)
+
+        self.__lock.acquire()
+        try:
+            self.__responses[cert_id] = response, next_update, record.revoked
+            heapq.heappush(self.__refresh,
+                           (next_update - self.refresh_margin, cert_id))
+        finally:
+            self.__lock.release()
+        return response
+
+    def get_response(self, request):
+        '''
+        Answers a DER encoded OCSP request, returning the DER encoded
+        response
+        '''
+        try:
+            cert_ids = parse_request(request)
+        except ValueError:
+            return MALFORMED_REQUEST
+        if len(cert_ids) != 1:
+            return MALFORMED_REQUEST
+
+        entry = self.__responses.get(cert_ids[0])
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+        tracing.count('ocsp.misses')
+        try:
+            return self.__sign(cert_ids[0])
+        except Exception:
+            # the certificate file missing, the CA key not loading...
+            # clients still get an answer, which is not cached
+            tracing.count('ocsp.errors')
+            return INTERNAL_ERROR
+
+    def precompute(self, name=None):
+        '''
+        Signs responses for every certificate of a CA (or all CAs) not
+        yet expired and not already cached, returning how many were
+        signed
+        '''
+        if name is None:
+            names = self.manager.get_ca_names()
+        else:
+            names = [name]
+
+        count = 0
+        now = time.time()
+        for name in names:
+            ca = self.manager.acquire(name)
+            try:
+                for record in ca.get_database():
+                    if record.expires < now or self.__stopping.isSet():
+                        continue
+                    for cert_id in self.__get_cert_ids(
+                            name, long(record.serial, 16), self.hashes):
+                        if not self.__responses.has_key(cert_id):
+                            self.__sign(cert_id)
+                            count += 1
+            finally:
+                self.manager.release(ca)
+        return count
+
+    def revoke(self, name, serial, reason=None, when=None):
+        '''
+        Revokes a certificate of the named CA (see
+        CertificateAuthority.revoke()), and re-signs its cached responses
+        '''
+        ca = self.manager.acquire(name)
+        try:
+            ca.revoke(serial, reason, when)
+        finally:
+            self.manager.release(ca)
+        # CertIDs hold serials as numbers, serial may be an hex string
+        serial = long(normalize_serial(serial), 16)
+        for cert_id in self.__get_cert_ids(name, serial):
+            if self.__responses.has_key(cert_id):
+                self.__sign(cert_id)
+
+    def refresh(self):
+        '''
+        Re-signs the responses that are about to expire, or whose
+        certificates were revoked since the last call, returning how many
+        were signed
+        '''
+        count = 0
+        for name, polled in self.__polled.items():
+            ca = self.manager.acquire(name)
+            try:
+                database = ca.get_database()
+                # revocations go by the order they were recorded in, not
+                # by revocation time, which may be in the past. The
+                # sequence is read first, so those recorded meanwhile are
+                # seen again next time. Never polled, every revocation is
+                # checked
+                sequence = database.get_revocation_sequence()
+                serials = [long(record.serial, 16) for record
+                           in database.find_revoked_after(polled or 0)]
+            finally:
+                self.manager.release(ca)
+            for serial in serials:
+                for cert_id in self.__get_cert_ids(name, serial):
+                    entry = self.__responses.get(cert_id)
+                    if entry is not None and entry[2] is None:
+                        self.__sign(cert_id)
+                        count += 1
+            self.__polled[name] = sequence
+
+        now = time.time()
+        while True:
+            self.__lock.acquire()
+            try:
+                if not self.__refresh or self.__refresh[0][0] > now:
+                    break
+                refresh_time, cert_id = heapq.heappop(self.__refresh)
+                entry = self.__responses.get(cert_id)
+            finally:
+                self.__lock.release()
+            # entries re-signed since they were queued are skipped
+            if entry is not None and \
+                   entry[1] - self.refresh_margin == refresh_time:
+                self.__sign(cert_id)
+                count += 1
+        return count
+
+    def __run(self):
+        self.precompute()
+        while not self.__stopping.isSet():
+            with tracing.span('ocsp.refresh'):
+                self.refresh()
+            self.__stopping.wait(self.poll_interval)
+
+    def start(self):
+        '''
+        Starts the background thread, which first computes the responses
+        of all certificates (see precompute()) and then keeps them fresh
+        '''
+        if self.__thread is None:
+            self.__stopping.clear()
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='pkitool-ocsp')
+            self.__thread.setDaemon(True)
+            self.__thread.start()
+
+    def stop(self):
+        '''
+        Stops the background thread
+        '''
+        if self.__thread is not None:
+            self.__stopping.set()
+            self.__thread.join()
+            self.__thread = None
+
+    def save(self, path):
+        '''
+        Saves the cached responses to path, so that a restarted responder
+        does not have to sign them all again (see load())
+        '''
+        self.__lock.acquire()
+        try:
+            snapshot = marshal.dumps((SNAPSHOT_VERSION, time.time(),
+                                      self.__responses.items()))
+        finally:
+            self.__lock.release()
+        fileutil.write_file(path, snapshot)
+
+    def load(self, path):
+        '''
+        Loads the responses saved by save(), dropping those expired or on
+        unknown CAs. The next refresh() checks them against every
+        revocation recorded, so those made since they were saved are
+        picked up.
+        '''
+        fp = open(path, 'rb')
+        try:
+            version, saved, responses = marshal.load(fp)
+        finally:
+            fp.close()
+        if version != SNAPSHOT_VERSION:
+            return
+
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            for cert_id, entry in responses:
+                if entry[1] > now and self.__issuers.has_key(cert_id[:3]):
+                    self.__responses[cert_id] = entry
+                    heapq.heappush(self.__refresh,
+                                   (entry[1] - self.refresh_margin, cert_id))
+            for name in self.__polled.keys():
+                self.__polled[name] = None
+        finally:
+            self.__lock.release()
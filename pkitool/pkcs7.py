@@ -0,0 +1,93 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+pkcs7.py
+
+    
+"""
+
+__all__ = ['pem_to_der', 'der_to_pem', 'certs_only']
+
+import re
+import base64
+
+PEM_RE = re.compile('-----BEGIN ([A-Z0-9 ]+)-----(.*?)-----END \\1-----',
+                    re.DOTALL)
+
+# DER encoded object identifiers
+OID_DATA = '\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x01'
+OID_SIGNED_DATA = '\x06\x09\x2a\x86\x48\x86\xf7\x0d\x01\x07\x02'
+
+def pem_to_der(pem):
+    '''
+    Returns the DER encoded contents of every PEM block in pem, in order
+    '''
+    return [base64.b64decode(''.join(body.split()))
+            for label, body in PEM_RE.findall(pem)]
+
+def der_to_pem(der, label='CERTIFICATE'):
+    '''
+    Returns a DER encoded object PEM encoded, with the given label
+    '''
+    text = base64.b64encode(der)
+    lines = [text[i:i + 64] for i in range(0, len(text), 64)]
+    return '-----BEGIN %s-----\n%s\n-----END %s-----\n' % \
+           (label, '\n'.join(lines), label)
+
+def encode_length(length):
+    if length < 0x80:
+        return chr(length)
+    octets = ''
+    while length:
+        octets = chr(length & 0xff) + octets
+        length = length >> 8
+    return chr(0x80 | len(octets)) + octets
+
+def encode(tag, content):
+    '''
+    Returns a DER encoded TLV with the given tag octet
+    '''
+    return chr(tag) + encode_length(len(content)) + content
+
+def certs_only(certificates):
+    '''
+    Returns a DER encoded, degenerate (unsigned) PKCS#7 SignedData
+    holding certificates, as used to convey certificate chains (RFC 2315
+    and RFC 5652, the "certs-only" smime-type)
+
+    certificates are DER encoded.
+    '''
+    signed_data = encode(0x30,
+                         # version
+                         '\x02\x01\x01' +
+                         # digestAlgorithms, empty
+                         encode(0x31, '') +
+                         # contentInfo, with no content
+                         encode(0x30, OID_DATA) +
+                         # [0] IMPLICIT certificates
+                         encode(0xa0, ''.join(certificates)) +
+                         # signerInfos, empty
+                         encode(0x31, ''))
+    return encode(0x30, OID_SIGNED_DATA + encode(0xa0, signed_data))
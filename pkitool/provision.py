@@ -0,0 +1,273 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+provision.py
+
+    
+"""
+
+__all__ = ['CAProvisioner']
+
+import os
+import errno
+import time
+
+import tracing
+import fileutil
+
+# a CA provisioning goes through these states, in order. Each one is told
+# apart by what is found on disk, so an interrupted run just resumes
+STATES = ('missing', 'configured', 'directories', 'key', 'done')
+
+def mkdir_if_missing(path, mode=0755):
+    '''
+    Creates a directory, returning False if it already existed
+    '''
+    try:
+        os.mkdir(path, mode)
+    except OSError, e:
+        if e.errno == errno.EEXIST and os.path.isdir(path):
+            return False
+        raise
+    return True
+
+class CAProvisioner:
+    '''
+    Creates many CAs at once: their config sections, directory trees,
+    keys and certificates
+
+    Bootstrapping a CA one at a time (OpenSSLConfigParser.create_ca(),
+    CertificateAuthority.create_directory_structure() and init()) dumps
+    the whole config and generates a key per CA. Here, all new sections
+    are added to config and written to config_path once, directories and
+    files are created in a single pass, and all missing keys are
+    generated in one engine batch, in parallel.
+
+    Provisioning is idempotent: nothing that already exists is recreated
+    or overwritten. Since every step only creates files complete (keys
+    and certificates are written under temporary names and renamed), a
+    run interrupted at any point is resumed by just running it again.
+
+    For large numbers of CAs, config should be in compact mode (see
+    OpenSSLConfigParser).
+    '''
+
+    def __init__(self, config, config_path, engine=None, workers=None,
+                 key_cache=None):
+        '''
+        engine and key_cache are shared by all CAs, see
+        CertificateAuthority. workers is the number of processes generating
+        keys (by default, one per CPU).
+        '''
+        self.config = config
+        self.config_path = config_path
+
+        if engine is None:
+            from backends import get_engine_class
+            engine = get_engine_class()()
+        self.engine = engine
+        self.workers = workers
+
+        if key_cache is None:
+            from keycache import KeyCache
+            key_cache = KeyCache()
+        self.key_cache = key_cache
+
+    def get_state(self, name):
+        '''
+        Returns how far provisioning the CA with the given name got, one
+        of STATES
+        '''
+        if not self.config.has_section(name):
+            return 'missing'
+        if os.path.exists(self.config.get_ca_certificate(name)):
+            return 'done'
+        if os.path.exists(self.config.get_ca_private_key(name)):
+            return 'key'
+        for path in (self.config.get_ca_serial(name),
+                     self.config.get_ca_crlnumber(name),
+                     self.config.get_ca_database(name),
+                     self.config.get_ca_new_certs_dir(name)):
+            if not os.path.exists(path):
+                return 'configured'
+        return 'directories'
+
+    def __get_password(self, password, name):
+        if callable(password):
+            return password(name)
+        return password
+
+    def create_sections(self, names, base_dir):
+        '''
+        Adds a CA section for each name not yet in the config, the CA dir
+        being base_dir/name, and writes the config once, if changed
+
+        Returns the names of the sections added.
+        '''
+        added = [name for name in names if not self.config.has_section(name)]
+        for name in added:
+            self.config.create_ca(name, os.path.join(base_dir, name))
+        if added or not os.path.exists(self.config_path):
+            self.config.write_file(self.config_path)
+        return added
+
+    def create_directories(self, names):
+        '''
+        Creates the directory trees and the database, serial and crlnumber
+        files of the given CAs, skipping those that exist
+
+        All directories (and the directories holding CA dirs) are created
+        first, parents before children, and then all files.
+        '''
+        parents = set()
+        directories = set()
+        private = set()
+        files = []
+        config = self.config
+        for name in names:
+            parents.add(os.path.dirname(config.get_ca_dir(name)))
+            directories.update([config.get_ca_dir(name),
+                                config.get_ca_certs(name),
+                                config.get_ca_crl_dir(name),
+                                config.get_ca_new_certs_dir(name)])
+            private.add(config.get_ca_private(name))
+            files.extend([(config.get_ca_database(name), ''),
+                          (config.get_ca_serial(name), '01\n'),
+                          (config.get_ca_crlnumber(name), '01\n')])
+
+        for path in parents:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        # sorting puts parents ahead of their children
+        for path in sorted(directories | private):
+            if path in private:
+                mkdir_if_missing(path, 0700)
+            else:
+                mkdir_if_missing(path)
+        for path, buffer in files:
+            fileutil.create_file(path, buffer)
+
+    def create_keys(self, names, password=''):
+        '''
+        Generates the missing private keys of the given CAs, in parallel,
+        of each CA default key type and size
+
+        password may be a string or a function, called with a CA name,
+        returning the password of that CA key.
+
+        Returns the names of the CAs whose key was created.
+        '''
+        from ca import CertificateAuthority
+
+        specs = []
+        owners = {}
+        for name in names:
+            path = self.config.get_ca_private_key(name)
+            if os.path.exists(path):
+                continue
+            ca = CertificateAuthority(self.config, name, self.engine,
+                                      self.key_cache)
+            type, size = ca.get_key_type()
+            # a key left half written by an interrupted run is just
+            # overwritten
+            tmp_path = path + '.tmp'
+            specs.append((tmp_path, type, size,
+                          self.__get_password(password, name)))
+            owners[tmp_path] = name
+
+        created = []
+        def rename(tmp_path, seconds):
+            name = owners[tmp_path]
+            fileutil.rename(tmp_path, self.config.get_ca_private_key(name))
+            self.key_cache.flush(name)
+            created.append(name)
+
+        with tracing.span('provision.keys', count=len(specs)):
+            self.engine.create_private_keys(specs, self.workers, rename)
+        return created
+
+    def create_certificates(self, names, days=None, password='', parent=None,
+                            parent_password=None):
+        '''
+        Creates the missing certificates of the given CAs, self signed or,
+        if parent (a CertificateAuthority) is given, issued by parent
+
+        password is as for create_keys().
+
+        Returns the names of the CAs whose certificate was created.
+        '''
+        from ca import CertificateAuthority
+
+        created = []
+        for name in names:
+            if os.path.exists(self.config.get_ca_certificate(name)):
+                continue
+            ca = CertificateAuthority(self.config, name, self.engine,
+                                      self.key_cache)
+            try:
+                ca.create_ca_certificate(days,
+                                         self.__get_password(password, name),
+                                         parent, parent_password)
+            finally:
+                ca.close()
+            created.append(name)
+        return created
+
+    def provision(self, names, base_dir, days=None, password='', parent=None,
+                  parent_password=None, stats=None):
+        '''
+        Brings each of the named CAs up to the 'done' state, see the class
+        documentation. The CA dirs are created under base_dir.
+
+        If parent (a CertificateAuthority sharing this engine) is given,
+        the new CAs are intermediate CAs issued by it.
+
+        If a dict is given as stats, it is updated with the number of
+        'sections', 'keys' and 'certificates' created, the number of CAs
+        found 'done' beforehand, and the 'seconds' spent.
+
+        Returns the list of names, which are all provisioned by then.
+        '''
+        names = list(names)
+        if stats is None:
+            stats = {}
+
+        start = time.time()
+        with tracing.span('provision', count=len(names)):
+            done = [name for name in names
+                    if self.get_state(name) == 'done']
+            sections = self.create_sections(names, base_dir)
+
+            pending = [name for name in names
+                       if self.get_state(name) != 'done']
+            self.create_directories(pending)
+            keys = self.create_keys(pending, password)
+            certificates = self.create_certificates(pending, days, password,
+                                                    parent, parent_password)
+
+        stats.update({'sections' : len(sections), 'keys' : len(keys),
+                      'certificates' : len(certificates),
+                      'done' : len(done), 'seconds' : time.time() - start})
+        return names
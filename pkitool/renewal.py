@@ -0,0 +1,248 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+renewal.py
+
+    
+"""
+
+__all__ = ['RenewalEngine', 'RateLimiter']
+
+import os
+import time
+import itertools
+import threading
+
+import tracing
+import fileutil
+from database import normalize_serial
+
+DAY = 24 * 60 * 60
+
+class RateLimiter:
+    '''
+    Lets through rate operations per second on average, in bursts of at
+    most burst operations (a token bucket)
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(1, rate)
+        self.burst = burst
+        self.__tokens = burst
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self, count=1):
+        '''
+        Waits until count more operations may go through
+        '''
+        self.__lock.acquire()
+        try:
+            now = time.time()
+            self.__tokens = min(self.burst, self.__tokens +
+                                (now - self.__last) * self.rate)
+            self.__last = now
+            self.__tokens -= count
+            wait = -self.__tokens / self.rate
+        finally:
+            self.__lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+class RenewalEngine:
+    '''
+    Renews the certificates of a CA that are about to expire
+
+    Due certificates are looked up through the expiry index of the CA
+    database (see CertificateDatabase.find_renewable()), so a run only
+    reads the records of those due, and certificates already renewed are
+    left out of later runs.
+
+    Renewing re-keys: a new private key (of the given type and size, or
+    the CA defaults) is generated and a certificate with the old subject
+    issued for it, through CertificateAuthority.sign_requests(), so the
+    CA policy applies and new certificates are recorded as usual. Keys
+    are kept in key_dir, as <new serial>.key.
+
+    Certificates go through in batches of batch_size: the keys of a batch
+    are generated in parallel (on workers processes, see
+    create_private_keys() of the engine), and the batch is signed at
+    once. If rate is given, no more than rate certificates per second
+    are renewed.
+    '''
+
+    def __init__(self, ca, key_dir, batch_size=64, workers=None, rate=None,
+                 days=None, type=None, size=None, password='',
+                 revoke=False):
+        '''
+        days is the validity of the new certificates (by default, the CA
+        default_days), and password the one the new keys are encrypted
+        with. If revoke is True, renewed certificates are revoked (as
+        superseded).
+        '''
+        self.ca = ca
+        self.key_dir = key_dir
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = None
+        if rate is not None:
+            self.limiter = RateLimiter(rate, batch_size)
+        self.days = days
+        self.type, self.size = ca.get_key_type(type, size)
+        self.password = password
+        self.revoke = revoke
+
+        if not os.path.isdir(key_dir):
+            os.makedirs(key_dir, 0700)
+
+    def get_schedule(self, days=30, bucket=DAY):
+        '''
+        Returns how many valid certificates expire in each bucket (by
+        default, each day) of the next days, see
+        CertificateDatabase.count_expiring()
+        '''
+        now = int(time.time())
+        return self.ca.get_database().count_expiring(now, now + days * DAY,
+                                                     bucket)
+
+    def get_due(self, days=30):
+        '''
+        Iterates over the records of the certificates expiring within days
+        that have not been renewed yet, soonest first
+
+        Records are read batch_size at a time, each page starting after
+        the last record of the previous one, so renewing them meanwhile
+        is fine.
+        '''
+        database = self.ca.get_database()
+        before = int(time.time()) + days * DAY
+        start = None
+        while True:
+            # a page is read in full before it is handed out, as commits
+            # reset the cursors open on the database connection
+            records = list(database.find_renewable(before, start=start,
+                                                   limit=self.batch_size))
+            for record in records:
+                yield record
+            if len(records) < self.batch_size:
+                break
+            start = records[-1].expires, records[-1].serial
+
+    def __renew_batch(self, records, stats):
+        engine = self.ca.engine
+        digest = self.ca.config.get_ca_default_md(self.ca.ca)
+        database = self.ca.get_database()
+
+        tmp_paths = [os.path.join(self.key_dir, '.renew-%s.key' %
+                                  record.serial) for record in records]
+        with tracing.span('engine.create_private_keys', ca=self.ca.ca,
+                          count=len(records)):
+            engine.create_private_keys([(path, self.type, self.size,
+                                         self.password)
+                                        for path in tmp_paths],
+                                       self.workers)
+
+        # sign_requests() takes requests one at a time, so each
+        # certificate it yields is for the last request taken. Rejected
+        # requests are skipped, and just yield nothing, as do certificates
+        # that can't be loaded (their files missing, for instance): both
+        # are counted as failed
+        current = []
+        def requests():
+            for record, path in zip(records, tmp_paths):
+                try:
+                    cert = engine.load_certificate(
+                        self.ca.find_certificate_path(record.serial))
+                    key = engine.load_private_key(path, self.password)
+                    request = engine.create_request(
+                        key, engine.get_certificate_subject(cert), digest)
+                except Exception:
+                    continue
+                current[:] = [(record, path)]
+                yield request
+
+        renewed = []
+        try:
+            for serial, pem in self.ca.sign_requests(requests(), self.days,
+                                                     skip_invalid=True):
+                record, tmp_path = current[0]
+                serial = normalize_serial(serial)
+                path = os.path.join(self.key_dir, '%s.key' % serial)
+                fileutil.rename(tmp_path, path)
+                database.add_renewal(record.serial, serial, commit=False)
+                renewed.append((record.serial, serial, path))
+            database.commit()
+        finally:
+            for path in tmp_paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+        if self.revoke:
+            for old, new, path in renewed:
+                self.ca.revoke(old, 'superseded')
+
+        tracing.count('renewal.renewed', len(renewed), ca=self.ca.ca)
+        stats['renewed'] += len(renewed)
+        stats['failed'] += len(records) - len(renewed)
+        return renewed
+
+    def renew(self, records, stats=None):
+        '''
+        Renews the certificates of the given database records, yielding
+        an (old serial, new serial, key path) tuple for each one renewed
+
+        If a dict is given as stats, it is kept updated with the number of
+        certificates 'renewed' and 'failed', the 'seconds' spent and the
+        resulting 'rate' in certificates per second.
+        '''
+        if stats is None:
+            stats = {}
+        stats.update({'renewed' : 0, 'failed' : 0, 'seconds' : 0.0,
+                      'rate' : 0.0})
+
+        start = time.time()
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.batch_size))
+            if not batch:
+                break
+            if self.limiter is not None:
+                self.limiter.acquire(len(batch))
+            with tracing.span('renewal.batch', ca=self.ca.ca,
+                              count=len(batch)):
+                renewed = self.__renew_batch(batch, stats)
+            stats['seconds'] = time.time() - start
+            stats['rate'] = stats['renewed'] / stats['seconds']
+            for result in renewed:
+                yield result
+
+    def run(self, days=30, stats=None):
+        '''
+        Renews every certificate expiring within days that has not been
+        renewed yet, returning the list of renewals (see renew())
+        '''
+        return list(self.renew(self.get_due(days), stats))
@@ -0,0 +1,165 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+sectionstore.py
+
+    
+"""
+
+__all__ = ['Layout', 'CompactSection', 'EMPTY_LAYOUT']
+
+from itertools import izip
+from UserDict import DictMixin
+
+# values up to this long are interned, so that the many copies of values
+# such as '365' or '$dir/certs' found in a big config share storage
+INTERN_MAX = 64
+
+class Layout(object):
+    '''
+    An ordered set of option names, shared by all sections having the
+    same options, in the same order
+
+    Layouts form a tree rooted at EMPTY_LAYOUT: adding an option to a
+    section moves it to the child layout for that name, which is created
+    only once. Sections created the same way (as create_ca() does) thus
+    end up sharing a single layout, and option names are interned.
+    '''
+    __slots__ = ('names', 'index', 'children')
+
+    def __init__(self, names):
+        self.names = names
+        self.index = dict([(name, i) for i, name in enumerate(names)])
+        self.children = {}
+
+    def add(self, name):
+        '''
+        Returns the layout with name appended
+        '''
+        layout = self.children.get(name)
+        if layout is None:
+            if type(name) is str:
+                name = intern(name)
+            # setdefault, so that concurrent adds end up sharing a layout
+            layout = self.children.setdefault(name,
+                                              Layout(self.names + (name,)))
+        return layout
+
+    def remove(self, name):
+        '''
+        Returns the layout with name removed
+        '''
+        layout = EMPTY_LAYOUT
+        for other in self.names:
+            if other != name:
+                layout = layout.add(other)
+        return layout
+
+EMPTY_LAYOUT = Layout(())
+
+class CompactSection(object, DictMixin):
+    '''
+    A config section, behaving as a dict of option names to values
+
+    Values are kept in a plain list (the table), indexed through the
+    section's (shared) Layout, so a section costs a small object and a
+    list, instead of a dict and its own copies of the option names.
+
+    clone() copies a section by sharing its table, which is only
+    copied when either section is changed (copy on write).
+    '''
+    __slots__ = ('name', 'layout', 'table', 'shared')
+
+    def __init__(self, name, layout=EMPTY_LAYOUT, table=None, shared=False):
+        self.name = name
+        self.layout = layout
+        if table is None:
+            table = []
+        self.table = table
+        self.shared = shared
+
+    def __getitem__(self, key):
+        return self.table[self.layout.index[key]]
+
+    def __setitem__(self, key, value):
+        if type(value) is str and len(value) <= INTERN_MAX:
+            value = intern(value)
+        index = self.layout.index.get(key)
+        if index is not None and self.table[index] is value:
+            # a clone being set the (interned) value it already shares
+            return
+        if self.shared:
+            self.table = list(self.table)
+            self.shared = False
+        if index is None:
+            self.layout = self.layout.add(key)
+            self.table.append(value)
+        else:
+            self.table[index] = value
+
+    def __delitem__(self, key):
+        index = self.layout.index[key]
+        self.layout = self.layout.remove(key)
+        table = list(self.table)
+        del table[index]
+        self.table = table
+        self.shared = False
+
+    def __contains__(self, key):
+        return key in self.layout.index
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.layout.names)
+
+    def __len__(self):
+        return len(self.layout.names)
+
+    def keys(self):
+        return list(self.layout.names)
+
+    def values(self):
+        return list(self.table)
+
+    def iteritems(self):
+        return izip(self.layout.names, self.table)
+
+    def itervalues(self):
+        return iter(self.table)
+
+    def copy(self):
+        '''
+        Returns the options as a plain dict
+        '''
+        return dict(izip(self.layout.names, self.table))
+
+    def clone(self, name):
+        '''
+        Returns a copy of this section, named name, sharing its values
+        until either one is changed
+        '''
+        self.shared = True
+        return CompactSection(name, self.layout, self.table, True)
@@ -0,0 +1,142 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+serial.py
+
+    
+"""
+
+__all__ = ['SerialAllocator', 'RandomSerialAllocator',
+           'BadSerialFileException']
+
+import os
+import fcntl
+import threading
+
+import fileutil
+from database import normalize_serial
+
+class BadSerialFileException(Exception):
+    '''
+    A serial file that does not hold a hexadecimal serial number
+    '''
+    def __init__(self, path, text):
+        Exception.__init__(self,
+                           'Serial file %s holds %r, not a serial number' % \
+                           (path, text))
+
+class SerialAllocator:
+    '''
+    Hands out serial numbers from an openssl serial file
+
+    The serial file holds the next serial to be used. Instead of updating
+    it for every certificate, a whole block of block_size serials is
+    reserved at once, and serials are then handed out from memory.
+
+    The file is replaced atomically (see fileutil.AtomicFile), under an
+    exclusive lock on a separate <path>.lock file, so it never holds a
+    partly written serial, even after a crash. A missing, empty or
+    unreadable serial file is an error, rather than a reason to start
+    over from 1 and issue serials again. Several processes can share the same
+    file safely, each one working on its own blocks. Serials left unused
+    in a block are simply skipped.
+
+    Allocators are thread safe, and a forked child never reuses its
+    parent's block.
+    '''
+
+    def __init__(self, path, block_size=1024):
+        self.path = path
+        self.block_size = block_size
+        self.__lock = threading.Lock()
+        self.__next = None
+        self.__last = None
+        self.__pid = None
+
+    def reserve(self, count):
+        '''
+        Reserves count serials in the serial file, returning the first one
+        '''
+        # the serial file itself is replaced, so it can not hold the lock
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            fp = open(self.path)
+            try:
+                text = fp.read(1024).strip()
+            finally:
+                fp.close()
+            try:
+                first = long(text, 16)
+            except ValueError:
+                raise BadSerialFileException(self.path, text)
+            fileutil.write_file(self.path,
+                                normalize_serial(first + count) + '\n')
+        finally:
+            # closing the file also releases the lock
+            os.close(fd)
+        return first
+
+    def next(self):
+        '''
+        Returns a new serial number
+        '''
+        self.__lock.acquire()
+        try:
+            if self.__pid != os.getpid() or self.__next > self.__last:
+                self.__next = self.reserve(self.block_size)
+                self.__last = self.__next + self.block_size - 1
+                self.__pid = os.getpid()
+            serial = self.__next
+            self.__next = serial + 1
+            return serial
+        finally:
+            self.__lock.release()
+
+class RandomSerialAllocator:
+    '''
+    Hands out random serial numbers
+
+    Serials are 128 bit random numbers (with the top bit cleared so they
+    are always encoded as positive integers), checked for collisions
+    against the CA database, if one is given. No shared state is
+    involved, so any number of processes may allocate serials at once.
+    '''
+
+    def __init__(self, database=None, bits=128):
+        self.database = database
+        self.bits = bits
+
+    def next(self):
+        '''
+        Returns a new serial number
+        '''
+        while True:
+            serial = long(os.urandom(self.bits / 8).encode('hex'), 16)
+            serial = serial >> 1
+            if not serial:
+                continue
+            if self.database is None or self.database.get(serial) is None:
+                return serial
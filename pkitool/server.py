@@ -0,0 +1,627 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+server.py
+
+    
+"""
+
+__all__ = ['IssuanceServer', 'Signer', 'Enrollment', 'BusyException',
+           'EnrollmentTimeoutException']
+
+import os
+import sys
+import Queue
+import base64
+import urllib
+import optparse
+import threading
+import multiprocessing
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import tracing
+import pkcs7
+
+EST_PREFIX = '/.well-known/est'
+
+OCSP_PREFIX = '/ocsp'
+
+class BusyException(Exception):
+    '''
+    An enrollment was submitted while max_pending ones were already
+    waiting to be signed
+    '''
+    def __init__(self, max_pending):
+        Exception.__init__(self,
+                           'Already %d enrollments pending' % max_pending)
+
+class EnrollmentTimeoutException(Exception):
+    '''
+    An enrollment was not signed in time
+    '''
+    def __init__(self, timeout):
+        Exception.__init__(self,
+                           'Enrollment not signed within %s seconds' % timeout)
+
+class Enrollment:
+    '''
+    A certificate request waiting to be signed by a Signer
+
+    If reenroll is True, the request renews a certificate of the CA, see
+    CertificateAuthority.find_renewed_certificate(); renews is then the
+    serial of that certificate, once found.
+    '''
+
+    def __init__(self, ca, request, reenroll=False):
+        self.ca = ca
+        self.request = request
+        self.reenroll = reenroll
+        self.renews = None
+        self.certificate = None
+        self.error = None
+        # whether error is the request being turned down, rather than
+        # signing failing
+        self.rejected = False
+        self.__lock = threading.Lock()
+        # None while queued, then 'signing' or 'cancelled'
+        self.__state = None
+        self.__done = threading.Event()
+
+    def start(self):
+        '''
+        Takes the enrollment for signing, returning False if it was
+        cancelled
+        '''
+        self.__lock.acquire()
+        try:
+            if self.__state is None:
+                self.__state = 'signing'
+            return self.__state == 'signing'
+        finally:
+            self.__lock.release()
+
+    def cancel(self):
+        '''
+        Makes sure the enrollment is never signed, unless it already is
+        being signed, returning whether it was cancelled
+        '''
+        self.__lock.acquire()
+        try:
+            if self.__state is None:
+                self.__state = 'cancelled'
+            return self.__state == 'cancelled'
+        finally:
+            self.__lock.release()
+
+    def set_result(self, certificate=None, error=None, rejected=False):
+        self.certificate = certificate
+        self.error = error
+        self.rejected = rejected
+        self.__done.set()
+
+    def wait(self, timeout=None):
+        '''
+        Waits for the request to be signed, returning the PEM encoded
+        certificate. Raises the signing error, if any, or
+        EnrollmentTimeoutException if timeout seconds went by.
+        '''
+        if not self.__done.wait(timeout):
+            raise EnrollmentTimeoutException(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.certificate
+
+class Signer:
+    '''
+    Signs enrollments on a fixed number of worker threads
+
+    Enrollments wait in a queue of at most max_pending. Each worker takes
+    every enrollment waiting (up to batch_size) and signs those for the
+    same CA with a single CertificateAuthority.sign_requests() call, so
+    that under load the CA key is looked up and the database records
+    committed once per batch, not once per certificate. Certificate files
+    are still flushed one by one, but all at the end of the batch, along
+    with a single flush of their directory.
+
+    CAs come from manager (a manager.CAManager), which keeps them loaded.
+    '''
+
+    def __init__(self, manager, workers=None, max_pending=1024,
+                 batch_size=64, days=None):
+        self.manager = manager
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.days = days
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.__queue = Queue.Queue(max_pending)
+        self.__threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.__run,
+                                      name='pkitool-signer-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def __len__(self):
+        return self.__queue.qsize()
+
+    def submit(self, ca, request, reenroll=False):
+        '''
+        Queues a PEM encoded request to be signed by the named CA,
+        returning its Enrollment (see Enrollment for reenroll)
+
+        Never blocks: raises BusyException if max_pending enrollments are
+        already waiting. Enrollments cancelled meanwhile are dropped
+        unsigned.
+        '''
+        enrollment = Enrollment(ca, request, reenroll)
+        try:
+            self.__queue.put_nowait(enrollment)
+        except Queue.Full:
+            tracing.count('server.busy', ca=ca)
+            raise BusyException(self.max_pending)
+        return enrollment
+
+    def __run(self):
+        stopping = False
+        while not stopping:
+            enrollment = self.__queue.get()
+            if enrollment is None:
+                break
+            batches = {}
+            order = []
+            count = 0
+            while True:
+                if not batches.has_key(enrollment.ca):
+                    batches[enrollment.ca] = []
+                    order.append(enrollment.ca)
+                batches[enrollment.ca].append(enrollment)
+                count += 1
+                if count >= self.batch_size:
+                    break
+                try:
+                    enrollment = self.__queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if enrollment is None:
+                    stopping = True
+                    break
+            for ca in order:
+                self.__sign(ca, batches[ca])
+
+    def __sign(self, name, enrollments):
+        enrollments = [enrollment for enrollment in enrollments
+                       if enrollment.start()]
+        if not enrollments:
+            return
+        try:
+            ca = self.manager.acquire(name)
+        except Exception, e:
+            for enrollment in enrollments:
+                enrollment.set_result(error=e)
+            return
+
+        rejected = []
+        def reject(request, error):
+            rejected.append((current[0], error))
+
+        # sign_requests() takes requests one at a time, so each
+        # certificate it yields, or request it rejects, is for the last
+        # request taken
+        current = []
+        def requests():
+            for enrollment in enrollments:
+                current[:] = [enrollment]
+                if enrollment.reenroll:
+                    try:
+                        enrollment.renews = ca.find_renewed_certificate(
+                            enrollment.request)
+                    except Exception, e:
+                        reject(enrollment.request, e)
+                        continue
+                yield enrollment.request
+
+        # certificates are only handed out once sign_requests() is done,
+        # as they are not durable (and their serials may be issued again
+        # after a crash) until its final commit
+        signed = []
+        with tracing.span('server.sign', ca=name, count=len(enrollments)):
+            try:
+                for serial, pem in ca.sign_requests(requests(), self.days,
+                                                    skip_invalid=True,
+                                                    rejected=reject):
+                    enrollment = current[0]
+                    if enrollment.renews is not None:
+                        # committed along with the certificate
+                        ca.get_database().add_renewal(enrollment.renews,
+                                                      serial, commit=False)
+                    signed.append((enrollment, pem))
+            except Exception, e:
+                errors = dict(rejected)
+                for enrollment in enrollments:
+                    if errors.has_key(enrollment):
+                        enrollment.set_result(error=errors[enrollment],
+                                              rejected=True)
+                    else:
+                        enrollment.set_result(error=e)
+                return
+            finally:
+                self.manager.release(ca)
+
+        for enrollment, error in rejected:
+            enrollment.set_result(error=error, rejected=True)
+        for enrollment, pem in signed:
+            enrollment.set_result(pem)
+
+    def close(self):
+        '''
+        Signs the enrollments already queued and stops the workers
+        '''
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+class EnrollmentHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the EST (RFC 7030) cacerts, simpleenroll and simplereenroll
+    operations, and OCSP (RFC 6960) requests on /ocsp, if the server has
+    a responder
+
+    There is no TLS client authentication, so a simplereenroll request
+    has to be signed with the key of the valid certificate it renews
+    (with the same subject): rekeying takes a simpleenroll. Enrollments
+    not signed within the server enrollment_timeout are cancelled, and
+    answered with 503, unless already being signed, in which case the
+    certificate is still waited for and sent.
+
+    /.well-known/est/<operation> uses the default CA, and
+    /.well-known/est/<CA name>/<operation> the named one. Requests are
+    base64 encoded DER PKCS#10 (PEM is also accepted), and certificates
+    are sent back as base64 encoded certs-only PKCS#7.
+    '''
+
+    # keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    server_version = 'pkitool'
+
+    # seconds an idle connection is kept open
+    timeout = 30
+
+    # responses are buffered, and sent at once when complete
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def __send(self, code, body='', content_type='text/plain', headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_error(self, code, message):
+        headers = ()
+        if code == 503:
+            headers = [('Retry-After', str(self.server.retry_after))]
+        self.__send(code, message + '\n', headers=headers)
+
+    def __send_certificates(self, pem):
+        body = base64.encodestring(pkcs7.certs_only(pkcs7.pem_to_der(pem)))
+        self.__send(200, body,
+                    'application/pkcs7-mime; smime-type=certs-only',
+                    [('Content-Transfer-Encoding', 'base64')])
+
+    def __parse_path(self):
+        '''
+        Returns the (CA name, operation) of the request path, or None
+        '''
+        path = self.path.split('?', 1)[0]
+        if not path.startswith(EST_PREFIX + '/'):
+            return None
+        parts = path[len(EST_PREFIX) + 1:].split('/')
+        if len(parts) == 1:
+            return self.server.default_ca, parts[0]
+        if len(parts) == 2 and parts[0]:
+            return parts[0], parts[1]
+        return None
+
+    def __send_ocsp_response(self, request):
+        if self.server.ocsp is None:
+            return self.__send_error(404, 'Not found')
+        self.__send(200, self.server.ocsp.get_response(request),
+                    'application/ocsp-response')
+
+    def do_GET(self):
+        if self.path.startswith(OCSP_PREFIX + '/'):
+            # the request is base64 encoded, and then url encoded, into the
+            # path (RFC 6960, appendix A.1)
+            encoded = urllib.unquote(self.path[len(OCSP_PREFIX) + 1:])
+            try:
+                request = base64.b64decode(encoded)
+            except TypeError:
+                return self.__send_error(400, 'Bad base64 encoding')
+            return self.__send_ocsp_response(request)
+
+        target = self.__parse_path()
+        if target is None or target[1] != 'cacerts':
+            return self.__send_error(404, 'Not found')
+        name = target[0]
+        if name not in self.server.manager:
+            return self.__send_error(404, 'Unknown CA: %s' % name)
+        path = self.server.manager.config.get_ca_certificate(name)
+        fp = open(path)
+        try:
+            pem = fp.read()
+        finally:
+            fp.close()
+        self.__send_certificates(pem)
+
+    def __read_body(self):
+        '''
+        Returns the request body, or None (having sent an error and closed
+        the connection) if it can not be read
+        '''
+        length = self.headers.getheader('Content-Length')
+        if length is None:
+            error = 411, 'Content-Length required'
+        else:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                error = 400, 'Bad Content-Length'
+            elif length > self.server.max_request_size:
+                error = 413, 'Request too large'
+            else:
+                return self.rfile.read(length)
+        # the body is left unread, so the connection can not be reused
+        self.__send(error[0], error[1] + '\n',
+                    headers=[('Connection', 'close')])
+
+    def do_POST(self):
+        # the body is always read, so the connection can be kept alive
+        # whatever the outcome
+        body = self.__read_body()
+        if body is None:
+            return
+        if self.path == OCSP_PREFIX:
+            return self.__send_ocsp_response(body)
+
+        target = self.__parse_path()
+        if target is None or \
+               target[1] not in ('simpleenroll', 'simplereenroll'):
+            return self.__send_error(404, 'Not found')
+        name = target[0]
+        if name not in self.server.manager:
+            return self.__send_error(404, 'Unknown CA: %s' % name)
+
+        if '-----BEGIN' not in body:
+            try:
+                der = base64.b64decode(''.join(body.split()))
+            except TypeError:
+                return self.__send_error(400, 'Bad base64 encoding')
+            body = pkcs7.der_to_pem(der, 'CERTIFICATE REQUEST')
+
+        try:
+            enrollment = self.server.signer.submit(
+                name, body, target[1] == 'simplereenroll')
+        except BusyException, e:
+            return self.__send_error(503, str(e))
+        try:
+            try:
+                pem = enrollment.wait(self.server.enrollment_timeout)
+            except EnrollmentTimeoutException, e:
+                if enrollment.cancel():
+                    tracing.count('server.timeouts', ca=name)
+                    return self.__send_error(503, str(e))
+                # too late: the certificate is being issued, and must not
+                # be lost to the client
+                pem = enrollment.wait()
+        except Exception, e:
+            if enrollment.rejected:
+                tracing.count('server.rejected', ca=name)
+                return self.__send_error(400, 'Request rejected: %s' % e)
+            tracing.count('server.errors', ca=name)
+            return self.__send_error(500, 'Signing failed: %s' % e)
+        tracing.count('server.enrolled', ca=name)
+        self.__send_certificates(pem)
+
+class IssuanceServer(HTTPServer):
+    '''
+    An HTTP server issuing certificates from the CAs of a manager (see
+    manager.CAManager), which keeps CAs, keys and config loaded
+
+    Connections are served by a fixed pool of connections threads, and
+    kept alive between requests. Accepted connections wait for a free
+    thread in a queue of the same size; once that is full, no more
+    connections are accepted for a while, and the kernel listen backlog
+    holds new ones. Signing happens on a Signer: when more than
+    max_pending requests are waiting to be signed, new ones are answered
+    with 503 (Service Unavailable) and a Retry-After header.
+    '''
+
+    # sized for many keep-alive clients
+    request_queue_size = 128
+
+    allow_reuse_address = True
+
+    # requests bodies (certificate requests) larger than this are refused
+    max_request_size = 64 * 1024
+
+    # seconds a client waits for its certificate before getting a 503
+    enrollment_timeout = 60
+
+    # seconds clients are told to wait before retrying, when busy
+    retry_after = 1
+
+    def __init__(self, manager, address=('localhost', 8080), connections=64,
+                 signer=None, default_ca=None, verbose=False, ocsp=None):
+        '''
+        If signer (a Signer) is not given, one with the default settings
+        is created. default_ca is the CA used when requests name none
+        (by default, the config default CA). If an ocsp.OCSPResponder is
+        given as ocsp, OCSP requests are answered by it.
+        '''
+        self.manager = manager
+        self.verbose = verbose
+        self.ocsp = ocsp
+        self.__own_signer = signer is None
+        if signer is None:
+            signer = Signer(manager)
+        self.signer = signer
+        if default_ca is None:
+            default_ca = manager.config.get_default_ca()
+        self.default_ca = default_ca
+
+        HTTPServer.__init__(self, address, EnrollmentHandler)
+
+        self.__connections = Queue.Queue(connections)
+        self.__threads = []
+        for i in range(connections):
+            thread = threading.Thread(target=self.__serve_connections,
+                                      name='pkitool-http-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def process_request(self, request, client_address):
+        # blocks while all connection threads are busy
+        self.__connections.put((request, client_address))
+
+    def __serve_connections(self):
+        while True:
+            item = self.__connections.get()
+            if item is None:
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def close(self):
+        '''
+        Stops the connection threads (once their clients disconnect) and
+        the signer, if created by the server, and closes the socket
+        '''
+        for thread in self.__threads:
+            self.__connections.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+        if self.__own_signer:
+            self.signer.close()
+        self.server_close()
+
+def main(args=None):
+    from configparser import OpenSSLConfigParser
+    from manager import CAManager
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] CONFIG',
+        description='Serves EST enrollment (simpleenroll) for the CAs '
+                    'defined in an openssl config')
+    parser.add_option('-a', '--address', default='localhost',
+                      help='address to listen on [%default]')
+    parser.add_option('-p', '--port', type='int', default=8080,
+                      help='port to listen on [%default]')
+    parser.add_option('-c', '--connections', type='int', default=64,
+                      help='connections served at once [%default]')
+    parser.add_option('-w', '--workers', type='int', default=None,
+                      help='signing threads [number of CPUs]')
+    parser.add_option('-q', '--max-pending', type='int', default=1024,
+                      help='requests waiting to be signed before new ones '
+                           'are refused [%default]')
+    parser.add_option('-b', '--batch-size', type='int', default=64,
+                      help='requests signed per batch [%default]')
+    parser.add_option('-d', '--days', type='int', default=None,
+                      help='certificate validity [CA default_days]')
+    parser.add_option('-P', '--password-file', default=None,
+                      help='file holding the CA key password')
+    parser.add_option('-o', '--ocsp', action='store_true', default=False,
+                      help='answer OCSP requests on /ocsp')
+    parser.add_option('-H', '--ocsp-hours', type='int', default=24,
+                      help='OCSP response validity [%default]')
+    parser.add_option('-s', '--ocsp-snapshot', default=None,
+                      help='file the OCSP responses are saved to on exit, '
+                           'and loaded from on start')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='log every request')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('a config file is required')
+
+    config = OpenSSLConfigParser()
+    config.read_cached(args[0])
+    manager = CAManager(config)
+    if options.password_file:
+        fp = open(options.password_file)
+        try:
+            password = fp.readline().rstrip('\n')
+        finally:
+            fp.close()
+        manager.register_callback('get_ca_key_password', lambda: password)
+
+    responder = None
+    if options.ocsp:
+        from ocsp import OCSPResponder
+        responder = OCSPResponder(manager, options.ocsp_hours)
+        if options.ocsp_snapshot and os.path.exists(options.ocsp_snapshot):
+            responder.load(options.ocsp_snapshot)
+        responder.start()
+
+    signer = Signer(manager, options.workers, options.max_pending,
+                    options.batch_size, options.days)
+    server = IssuanceServer(manager, (options.address, options.port),
+                            options.connections, signer,
+                            verbose=options.verbose, ocsp=responder)
+    sys.stderr.write('Serving on %s:%d\n' % server.server_address)
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        signer.close()
+        if responder is not None:
+            responder.stop()
+            if options.ocsp_snapshot:
+                responder.save(options.ocsp_snapshot)
+        manager.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+tracing.py
+
+    
+"""
+
+__all__ = ['Span', 'Sink', 'MetricsSink', 'SpanSink', 'add_sink',
+           'remove_sink', 'span', 'count', 'traced']
+
+import sys
+import time
+import random
+import threading
+from collections import deque
+
+# whether any sink is registered. Instrumented code only checks this
+# (through span(), count() or traced()) when tracing is disabled
+enabled = False
+
+_sinks = ()
+_lock = threading.Lock()
+_local = threading.local()
+
+class Sink:
+    '''
+    Receives finished spans and counter increments
+
+    Sinks are called from whatever thread did the work, so they must be
+    thread safe. Subclasses override span() and/or count().
+    '''
+
+    def span(self, span):
+        '''
+        Called with every finished Span
+        '''
+        pass
+
+    def count(self, name, value, labels):
+        '''
+        Called when counter name is incremented by value. labels is a
+        (possibly empty) dict
+        '''
+        pass
+
+def add_sink(sink):
+    '''
+    Registers a sink, enabling tracing
+    '''
+    global _sinks, enabled
+    _lock.acquire()
+    try:
+        _sinks = _sinks + (sink,)
+        enabled = True
+    finally:
+        _lock.release()
+
+def remove_sink(sink):
+    '''
+    Unregisters a sink. Tracing is disabled when no sink is left
+    '''
+    global _sinks, enabled
+    _lock.acquire()
+    try:
+        _sinks = tuple([s for s in _sinks if s is not sink])
+        enabled = bool(_sinks)
+    finally:
+        _lock.release()
+
+class NullSpan(object):
+    '''
+    What span() returns while tracing is disabled
+    '''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    '''
+    A timed operation
+
+    Spans nest: a span started while another one is running, in the same
+    thread, becomes its child and shares its trace_id. Times are seconds
+    since the epoch. error is None, or a description of the exception
+    the span ended with.
+    '''
+    __slots__ = ('name', 'attributes', 'trace_id', 'span_id', 'parent_id',
+                 'start', 'end', 'error')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.trace_id = None
+        self.span_id = None
+        self.parent_id = None
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def duration(self):
+        return self.end - self.start
+
+    def __enter__(self):
+        try:
+            stack = _local.stack
+        except AttributeError:
+            stack = _local.stack = []
+        if stack:
+            parent = stack[-1]
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        else:
+            self.trace_id = random.getrandbits(128)
+        self.span_id = random.getrandbits(64)
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.end = time.time()
+        _local.stack.pop()
+        if type is not None:
+            self.error = '%s: %s' % (type.__name__, value)
+        for sink in _sinks:
+            sink.span(self)
+        return False
+
+def span(name, **attributes):
+    '''
+    Returns a context manager timing the code it wraps as a span:
+
+        with tracing.span('engine.sign_request', ca=name):
+            ...
+
+    While tracing is disabled, this is a shared object doing nothing.
+    '''
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, attributes)
+
+def count(name, value=1, **labels):
+    '''
+    Increments counter name by value
+    '''
+    if not enabled:
+        return
+    for sink in _sinks:
+        sink.count(name, value, labels)
+
+def traced(name):
+    '''
+    Decorator running every call of a function in a span
+    '''
+    def decorator(function):
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            span = Span(name, {})
+            span.__enter__()
+            try:
+                result = function(*args, **kwargs)
+            except:
+                span.__exit__(*sys.exc_info())
+                raise
+            span.__exit__(None, None, None)
+            return result
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    items = labels.items()
+    items.sort()
+    return '{%s}' % ','.join(['%s="%s"' % (key, str(value)
+                                           .replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+                              for key, value in items])
+
+def metric_name(name):
+    return ''.join([(c.isalnum() and c) or '_' for c in name])
+
+class MetricsSink(Sink):
+    '''
+    Aggregates spans into duration histograms (and failure counts) per
+    span name, and keeps counter totals, for Prometheus
+
+    prometheus_text() renders everything in the Prometheus text
+    exposition format, to be served on a /metrics endpoint or written to
+    a node exporter textfile.
+    '''
+
+    # histogram bucket upper bounds, in seconds
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, prefix='pkitool', buckets=None):
+        self.prefix = prefix
+        if buckets is None:
+            buckets = self.BUCKETS
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        # span name -> [count, failures, sum, bucket counts]
+        self.__spans = {}
+        # (name, sorted label items) -> total
+        self.__counters = {}
+
+    def span(self, span):
+        duration = span.duration()
+        self.__lock.acquire()
+        try:
+            stats = self.__spans.get(span.name)
+            if stats is None:
+                stats = self.__spans[span.name] = [0, 0, 0.0,
+                                                   [0] * len(self.buckets)]
+            stats[0] += 1
+            if span.error is not None:
+                stats[1] += 1
+            stats[2] += duration
+            buckets = stats[3]
+            for i in range(len(self.buckets)):
+                if duration <= self.buckets[i]:
+                    buckets[i] += 1
+                    break
+        finally:
+            self.__lock.release()
+
+    def count(self, name, value, labels):
+        items = labels.items()
+        items.sort()
+        key = (name, tuple(items))
+        self.__lock.acquire()
+        try:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+        finally:
+            self.__lock.release()
+
+    def get_counter(self, name, **labels):
+        items = labels.items()
+        items.sort()
+        return self.__counters.get((name, tuple(items)), 0)
+
+    def get_span_stats(self, name):
+        '''
+        Returns a (count, failures, total seconds) tuple for span name
+        '''
+        stats = self.__spans.get(name, (0, 0, 0.0))
+        return tuple(stats[:3])
+
+    def prometheus_text(self):
+        self.__lock.acquire()
+        try:
+            spans = [(name, stats[:3] + [list(stats[3])])
+                     for name, stats in self.__spans.items()]
+            counters = self.__counters.items()
+        finally:
+            self.__lock.release()
+        spans.sort()
+        counters.sort()
+
+        lines = []
+        if spans:
+            seconds = '%s_span_seconds' % self.prefix
+            failures = '%s_span_failures_total' % self.prefix
+            lines.append('# HELP %s Duration of pkitool operations' % seconds)
+            lines.append('# TYPE %s histogram' % seconds)
+            for name, (total, failed, sum, buckets) in spans:
+                cumulative = 0
+                for bound, hits in zip(self.buckets, buckets):
+                    cumulative += hits
+                    lines.append('%s_bucket%s %d' %
+                                 (seconds, format_labels({'span' : name,
+                                                          'le' : repr(bound)}),
+                                  cumulative))
+                lines.append('%s_bucket%s %d' %
+                             (seconds, format_labels({'span' : name,
+                                                      'le' : '+Inf'}), total))
+                lines.append('%s_sum%s %r' %
+                             (seconds, format_labels({'span' : name}), sum))
+                lines.append('%s_count%s %d' %
+                             (seconds, format_labels({'span' : name}), total))
+            lines.append('# HELP %s Failed pkitool operations' % failures)
+            lines.append('# TYPE %s counter' % failures)
+            for name, (total, failed, sum, buckets) in spans:
+                lines.append('%s%s %d' %
+                             (failures, format_labels({'span' : name}),
+                              failed))
+
+        typed = {}
+        for (name, labels), value in counters:
+            metric = '%s_%s_total' % (self.prefix, metric_name(name))
+            if not typed.has_key(metric):
+                typed[metric] = True
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s%s %s' % (metric, format_labels(dict(labels)),
+                                      value))
+        return '\n'.join(lines) + '\n'
+
+class SpanSink(Sink):
+    '''
+    Turns spans into dicts shaped as OpenTelemetry (OTLP JSON) spans
+
+    Every span dict is passed to export, if given (to forward it to an
+    OpenTelemetry collector, for instance), and the last max_spans ones
+    are kept in the spans attribute.
+    '''
+
+    def __init__(self, export=None, max_spans=1024, service='pkitool'):
+        self.export = export
+        self.service = service
+        self.spans = deque(maxlen=max_spans)
+
+    def span(self, span):
+        if span.error is None:
+            status = {'code' : 'STATUS_CODE_OK'}
+        else:
+            status = {'code' : 'STATUS_CODE_ERROR', 'message' : span.error}
+        attributes = []
+        for key, value in span.attributes.items():
+            attributes.append({'key' : key,
+                               'value' : {'stringValue' : str(value)}})
+        record = {'traceId' : '%032x' % span.trace_id,
+                  'spanId' : '%016x' % span.span_id,
+                  'name' : span.name,
+                  'kind' : 'SPAN_KIND_INTERNAL',
+                  'startTimeUnixNano' : int(span.start * 1e9),
+                  'endTimeUnixNano' : int(span.end * 1e9),
+                  'attributes' : attributes,
+                  'status' : status,
+                  'resource' : {'attributes' :
+                                [{'key' : 'service.name',
+                                  'value' : {'stringValue' : self.service}}]}}
+        if span.parent_id is not None:
+            record['parentSpanId'] = '%016x' % span.parent_id
+        self.spans.append(record)
+        if self.export is not None:
+            self.export(record)
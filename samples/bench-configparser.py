@@ -0,0 +1,120 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+bench-configparser.py
+
+    
+"""
+import os
+import sys
+import time
+import tempfile
+
+from ConfigParser import ParsingError
+
+from pkitool.configparser import OpenSSLRawConfigParser
+from pkitool.bench import write_config
+
+class LegacyConfigParser(OpenSSLRawConfigParser):
+    '''
+    The readline based reader, as it was before the single pass one
+    '''
+
+    def _read(self, fp, fpname):
+        global_options = self._OpenSSLRawConfigParser__global_options
+        cursect = None
+        optname = None
+        lineno = 0
+        e = None
+        while True:
+            line = fp.readline()
+            if not line:
+                break
+            lineno = lineno + 1
+            if line.strip() == '' or line[0] in '#;':
+                continue
+            if self.COMMENTCRE.match(line):
+                continue
+            if line[0].isspace() and cursect is not None and optname:
+                value = line.strip()
+                if value:
+                    cursect[optname] = "%s\n%s" % (cursect[optname], value)
+            else:
+                mo = self.SECTCRE.match(line)
+                if mo:
+                    sectname = mo.group('header').strip()
+                    if sectname in self._sections:
+                        cursect = self._sections[sectname]
+                    else:
+                        cursect = {'__name__': sectname}
+                        self._sections[sectname] = cursect
+                    optname = None
+                else:
+                    mo = self.OPTCRE.match(line)
+                    if mo:
+                        optname, optval = mo.group('option', 'value')
+                        optname = optname.strip()
+                        optval = optval.strip()
+                        if optval == '""':
+                            optval = ''
+                        if cursect == None:
+                            global_options[optname] = optval
+                        else:
+                            cursect[optname] = optval
+                    else:
+                        if not e:
+                            e = ParsingError(fpname)
+                        e.append(lineno, repr(line))
+        if e:
+            raise e
+
+def time_read(cls, path, repeat):
+    best = None
+    for i in range(repeat):
+        parser = cls()
+        start = time.time()
+        parser.read(path)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, parser
+
+if __name__ == '__main__':
+    for lines in (1000, 10000, 100000):
+        fd, path = tempfile.mkstemp(suffix='.cnf')
+        fp = os.fdopen(fd, 'w')
+        write_config(fp, lines)
+        fp.close()
+        try:
+            repeat = max(3, 300000 / lines)
+            legacy, legacy_parser = time_read(LegacyConfigParser, path, repeat)
+            new, new_parser = time_read(OpenSSLRawConfigParser, path, repeat)
+            assert legacy_parser._sections == new_parser._sections
+            assert legacy_parser._OpenSSLRawConfigParser__global_options == \
+                   new_parser._OpenSSLRawConfigParser__global_options
+            print '%6d lines: legacy %8.2f ms, single pass %8.2f ms (%.1fx)' % \
+                  (lines, legacy * 1000, new * 1000, legacy / new)
+        finally:
+            os.unlink(path)
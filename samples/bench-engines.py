@@ -0,0 +1,120 @@
+# -*- Mode: Python; coding: iso-8859-1 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2006 Cleber Rosa <cleber@tallawa.org>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+## USA.
+##
+## Author(s): Cleber Rosa <cleber@tallawa.org>
+##
+"""
+bench-engines.py
+
+    
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from pkitool.configparser import OpenSSLConfigParser
+from pkitool.ca import CertificateAuthority
+from pkitool.backends.openssl import OpenSSLEngine, get_version
+
+def make_requests(binary, workdir, count):
+    '''
+    Creates count certificate requests with the openssl command line tool
+    '''
+    key_path = os.path.join(workdir, 'request.key')
+    subprocess.check_call([binary, 'genpkey', '-algorithm', 'RSA',
+                           '-pkeyopt', 'rsa_keygen_bits:1024',
+                           '-out', key_path])
+    requests = []
+    for i in range(count):
+        process = subprocess.Popen([binary, 'req', '-new', '-key', key_path,
+                                    '-subj', '/C=US/CN=host%d' % i],
+                                   stdout=subprocess.PIPE)
+        requests.append(process.communicate()[0])
+    return requests
+
+def bench_engine(engine, workdir, requests, keys):
+    '''
+    Returns keys/s and signatures/s for engine
+    '''
+    config = OpenSSLConfigParser()
+    config.create_default_config()
+    config.set(config.get_default_ca(), 'dir', os.path.join(workdir, 'ca'))
+    config.set(config.get_default_ca(), 'default_md', 'sha256')
+    ca = CertificateAuthority(config, engine=engine)
+    ca.register_callback('get_ca_key_password', lambda: 'secret')
+    try:
+        ca.create_directory_structure()
+        ca.init()
+
+        start = time.time()
+        engine.create_private_keys([os.path.join(workdir, 'key%d.pem' % i)
+                                    for i in range(keys)])
+        key_rate = keys / (time.time() - start)
+
+        stats = {}
+        for serial, pem in ca.sign_requests(requests, stats=stats):
+            pass
+        return key_rate, stats['rate']
+    finally:
+        ca.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        binary = sys.argv[1]
+    else:
+        binary = os.environ.get('PKITOOL_OPENSSL', 'openssl')
+
+    engines = []
+    try:
+        from pkitool.backends.pyopenssl import OpenSSLEngine as PyOpenSSLEngine
+        engines.append(('pyopenssl', PyOpenSSLEngine))
+    except ImportError:
+        pass
+    # interactive mode is gone since openssl 3.0
+    if get_version(binary) < (3,):
+        engines.append(('openssl persistent',
+                        lambda: OpenSSLEngine(binary, persistent=True)))
+    engines.append(('openssl spawn',
+                    lambda: OpenSSLEngine(binary, persistent=False)))
+
+    workdir = tempfile.mkdtemp()
+    try:
+        requests = make_requests(binary, workdir, 200)
+        for name, factory in engines:
+            engine_dir = tempfile.mkdtemp(dir=workdir)
+            try:
+                engine = factory()
+            except Exception, e:
+                print '%-20s unavailable: %s' % (name, e)
+                continue
+            try:
+                key_rate, sign_rate = bench_engine(engine, engine_dir,
+                                                   requests, 32)
+            finally:
+                engine.close()
+            print '%-20s %8.1f keys/s %8.1f signatures/s' % \
+                  (name, key_rate, sign_rate)
+    finally:
+        shutil.rmtree(workdir, True)